@@ -0,0 +1,180 @@
+import math
+import numpy as np
+from retrieval import select_top_k
+from typing import List, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from vectorization import Vector, VectorMatrix
+
+# Recall/latency knobs: more tables and probes find more neighbors,
+# more bits make buckets smaller and queries faster
+LSH_TABLES = 16
+LSH_BITS = 10
+LSH_PROBES = 2
+
+LSH_SEED = 0
+
+# Rows projected together while building the tables
+PROJECTION_BLOCK_SIZE = 1024
+
+
+class LSHIndex():
+    '''
+        Approximate nearest neighbour index with signed random projections (SimHash).
+
+        Description and genre vectors of a book are normalized, scaled by the square roots of
+        their weights and concatenated, so that the dot product of two books is their combined
+        similarity. Every table hashes a book into a bucket with the signs of its projections on
+        bits random +1/-1 hyperplanes. Books with a small angle between them are likely to share
+        a bucket in at least one table.
+
+        A query visits its own bucket in every table, and with probes > 0 also the buckets that
+        differ in one of its probes least certain bits (multi-probe). Candidates are reranked
+        with their exact similarities.
+    '''
+
+    def __init__(self, description_vectors: 'VectorMatrix', genre_vectors: 'VectorMatrix', description_weight: float, genre_weight: float,
+                 tables: int = LSH_TABLES, bits: int = LSH_BITS, probes: int = LSH_PROBES, seed: int = LSH_SEED):
+        if bits > 62:
+            raise ValueError("An LSH table can have at most 62 bits")
+        self.description_vectors = description_vectors
+        self.genre_vectors = genre_vectors
+        self.description_weight = description_weight
+        self.genre_weight = genre_weight
+        self.tables = tables
+        self.bits = bits
+        self.probes = probes
+
+        random_generator = np.random.default_rng(seed)
+        plane_count = tables * bits
+        self.description_planes = self.create_planes(
+            random_generator, description_vectors.vocabulary_size, plane_count)
+        self.genre_planes = self.create_planes(
+            random_generator, genre_vectors.vocabulary_size, plane_count)
+        self.bit_values = np.left_shift(
+            np.uint64(1), np.arange(bits, dtype=np.uint64))
+
+        # Bucket keys of every table in sorted order, with the rows in the same order
+        self.table_keys: List[np.ndarray] = []
+        self.table_rows: List[np.ndarray] = []
+        keys = self.get_keys(self.project_rows())
+        for table in range(tables):
+            order = np.argsort(keys[:, table], kind="stable")
+            self.table_keys.append(keys[order, table])
+            self.table_rows.append(order.astype(np.int32))
+
+    def create_planes(self, random_generator: np.random.Generator, vocabulary_size: int, plane_count: int) -> np.ndarray:
+        '''
+            Returns vocabulary_size x plane_count random +1/-1 hyperplane coordinates
+        '''
+        return (random_generator.integers(0, 2, size=(vocabulary_size, plane_count), dtype=np.int8) * 2 - 1).astype(np.int8)
+
+    def project_matrix(self, matrix: 'VectorMatrix', planes: np.ndarray, field_weight: float) -> np.ndarray:
+        '''
+            Returns the projections of the normalized rows of the matrix on the planes
+        '''
+        row_count = len(matrix.book_urls)
+        projections = np.zeros((row_count, planes.shape[1]), dtype=np.float32)
+        scales = np.zeros(row_count, dtype=np.float64)
+        np.divide(math.sqrt(field_weight), matrix.norms, out=scales,
+                  where=matrix.norms != 0)
+        for start in range(0, row_count, PROJECTION_BLOCK_SIZE):
+            end = min(start + PROJECTION_BLOCK_SIZE, row_count)
+            first, last = matrix.indptr[start], matrix.indptr[end]
+            if first == last:
+                continue
+            contributions = matrix.data[first:last, None] * \
+                planes[matrix.indices[first:last]]
+            # Sum the contributions of each non-empty row
+            row_lengths = np.diff(matrix.indptr[start:end + 1])
+            non_empty = np.flatnonzero(row_lengths > 0)
+            row_starts = matrix.indptr[start:end][non_empty] - first
+            projections[start + non_empty] = np.add.reduceat(
+                contributions, row_starts, axis=0)
+        projections *= scales[:, None].astype(np.float32)
+        return projections
+
+    def project_rows(self) -> np.ndarray:
+        return self.project_matrix(self.description_vectors, self.description_planes, self.description_weight) + \
+            self.project_matrix(self.genre_vectors,
+                                self.genre_planes, self.genre_weight)
+
+    def project_query(self, description_vector: 'Vector', genre_vector: 'Vector') -> np.ndarray:
+        projection = np.zeros(self.tables * self.bits, dtype=np.float64)
+        for vector, planes, field_weight in [(description_vector, self.description_planes, self.description_weight),
+                                             (genre_vector, self.genre_planes, self.genre_weight)]:
+            size = vector.get_size()
+            if size == 0:
+                continue
+            indices = np.fromiter(vector.weight_dict.keys(),
+                                  dtype=np.int64, count=len(vector.weight_dict))
+            weights = np.fromiter(vector.weight_dict.values(),
+                                  dtype=np.float64, count=len(vector.weight_dict))
+            projection += math.sqrt(field_weight) / size * \
+                (weights @ planes[indices])
+        return projection
+
+    def get_keys(self, projections: np.ndarray) -> np.ndarray:
+        '''
+            Returns the bucket key of every projection in every table as a (count, tables) array
+        '''
+        signs = (projections > 0).reshape(-1, self.tables, self.bits)
+        return (signs * self.bit_values).sum(axis=2, dtype=np.uint64)
+
+    def get_candidates(self, projection: np.ndarray) -> np.ndarray:
+        '''
+            Returns the sorted rows in the probed buckets of the projection
+        '''
+        keys = self.get_keys(projection[None, :])[0]
+        margins = np.abs(projection).reshape(self.tables, self.bits)
+        candidates = []
+        for table in range(self.tables):
+            probe_keys = [keys[table]]
+            # Flip the bits whose projections are closest to 0
+            for bit in np.argsort(margins[table], kind="stable")[:self.probes]:
+                probe_keys.append(keys[table] ^ self.bit_values[bit])
+            table_keys = self.table_keys[table]
+            for key in probe_keys:
+                left = np.searchsorted(table_keys, key, side="left")
+                right = np.searchsorted(table_keys, key, side="right")
+                candidates.append(self.table_rows[table][left:right])
+        return np.unique(np.concatenate(candidates)).astype(np.int64)
+
+    def score_rows(self, matrix: 'VectorMatrix', vector: 'Vector', rows: np.ndarray) -> np.ndarray:
+        '''
+            Returns the exact cosine similarities of the rows with the vector
+            It walks the non-zeros of the rows, so it costs in proportion to the candidates,
+            not to the postings of the query terms
+        '''
+        query_weights = np.zeros(matrix.vocabulary_size, dtype=np.float64)
+        for index, weight in vector.weight_dict.items():
+            query_weights[index] = weight
+
+        row_starts = matrix.indptr[rows]
+        row_lengths = matrix.indptr[rows + 1] - row_starts
+        entry_count = int(row_lengths.sum())
+        entry_offsets = np.cumsum(row_lengths) - row_lengths
+        positions = np.arange(entry_count, dtype=np.int64) + \
+            np.repeat(row_starts - entry_offsets, row_lengths)
+        products = matrix.data[positions].astype(
+            np.float64) * query_weights[matrix.indices[positions]]
+        dot_products = np.bincount(np.repeat(np.arange(len(rows)), row_lengths),
+                                   weights=products, minlength=len(rows))
+
+        size_products = matrix.norms[rows] * vector.get_size()
+        similarities = np.zeros(len(rows), dtype=np.float64)
+        np.divide(dot_products, size_products,
+                  out=similarities, where=size_products != 0)
+        return similarities
+
+    def retrieve(self, description_vector: 'Vector', genre_vector: 'Vector', k: int, excluded_rows=()) -> List[Tuple[float, str]]:
+        '''
+            Returns the k best (similarity, book_url) pairs among the candidates in descending order
+            There may be less than k pairs if there are less candidates
+        '''
+        candidate_rows = self.get_candidates(
+            self.project_query(description_vector, genre_vector))
+        scores = self.description_weight * self.score_rows(self.description_vectors, description_vector, candidate_rows) + \
+            self.genre_weight * \
+            self.score_rows(self.genre_vectors, genre_vector, candidate_rows)
+        return select_top_k(scores, self.description_vectors.book_urls, k, excluded_rows, rows=candidate_rows)
@@ -0,0 +1,449 @@
+import os
+import pickle
+import random
+import sys
+import time
+import tracemalloc
+import numpy as np
+import utils
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from download import extract_book_page
+import evaluation
+from ann import LSH_TABLES, LSH_BITS, LSH_PROBES
+from lsa import LSA_RANK
+from index import INDEX_FILE
+from sharding import ShardCoordinator
+from pagestore import PageStore, PAGE_STORE_FILE
+from vectorization import BookData, BookPreprocessor, BookVectorizer, SegmentedIndex, QUANTIZATIONS
+from hashing import FeatureHasher, DESCRIPTION_HASH_BITS, GENRE_HASH_BITS
+
+
+def benchmark_extraction(page_store_file: str = PAGE_STORE_FILE, processes: int = os.cpu_count()):
+    '''
+        Extracts every saved page in the page store, first in this process then with
+        an extraction process pool, and prints pages/second of both
+    '''
+    page_store = PageStore(page_store_file)
+    book_urls, pages = [], []
+    for book_url, book_html in page_store.iterate_pages():
+        book_urls.append(book_url)
+        pages.append(book_html)
+    page_store.close()
+    print(f"Extracting {len(pages)} pages in {page_store_file}...")
+
+    start_time = time.time()
+    for book_url, book_html in zip(book_urls, pages):
+        extract_book_page(book_url, book_html)
+    elapsed = time.time() - start_time
+    print(f"1 process: {len(pages) / elapsed:.1f} pages/second")
+
+    with ProcessPoolExecutor(processes) as extraction_pool:
+        start_time = time.time()
+        list(extraction_pool.map(extract_book_page,
+             book_urls, pages, chunksize=16))
+        elapsed = time.time() - start_time
+    print(f"{processes} processes: {len(pages) / elapsed:.1f} pages/second")
+
+
+def build_legacy_book_data(book_tokens: dict) -> tuple:
+    '''
+        Builds the string keyed layout BookData had before the term ids:
+        (vocabulary, inverted_index, term_frequency, doc_frequency)
+    '''
+    vocabulary, inverted_index, term_frequency, doc_frequency = set(), {}, {}, {}
+    for book_url, tokens in book_tokens.items():
+        for token in tokens:
+            vocabulary.add(token)
+            inverted_index.setdefault(token, set()).add(book_url)
+            word_book_pair = (token, book_url)
+            if word_book_pair not in term_frequency:
+                term_frequency[word_book_pair] = 1
+                doc_frequency[token] = doc_frequency.get(token, 0) + 1
+            else:
+                term_frequency[word_book_pair] += 1
+    return (vocabulary, inverted_index, term_frequency, doc_frequency)
+
+
+def build_book_data(book_tokens: dict) -> BookData:
+    book_data = BookData('description')
+    for book_url, tokens in book_tokens.items():
+        book_data.add_book_tokens(book_url, tokens)
+    return book_data
+
+
+def measure_memory(build, book_tokens: dict):
+    '''
+        Returns (result, allocated bytes, seconds) of build(book_tokens)
+    '''
+    tracemalloc.start()
+    start_time = time.time()
+    result = build(book_tokens)
+    elapsed = time.time() - start_time
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (result, allocated, elapsed)
+
+
+def benchmark_book_data_memory(books_pickle: str = "out/pickle/books.pickle"):
+    '''
+        Builds the description BookData of the pickled books with the legacy string keyed
+        layout and with the term id layout, and prints the memory, time and pickle size of both
+    '''
+    books_dict = utils.unpickle_object(books_pickle)
+    book_preprocessor = BookPreprocessor()
+    book_tokens = {book_url: book_preprocessor.tokenize_description(book)
+                   for book_url, book in books_dict.items()}
+    print(f"Building the description data of {len(book_tokens)} books...")
+
+    for name, build in [("dict/set layout", build_legacy_book_data),
+                        ("term id layout", build_book_data)]:
+        result, allocated, elapsed = measure_memory(build, book_tokens)
+        pickle_size = len(pickle.dumps(
+            result, protocol=pickle.HIGHEST_PROTOCOL))
+        print(f"{name}: {allocated / 2**20:.1f} MiB in memory, {pickle_size / 2**20:.1f} MiB pickled, "
+              f"built in {elapsed:.2f} seconds")
+        del result
+
+
+def get_sample_queries(book_vectorizer: BookVectorizer, books_pickle: str, sample_size: int) -> list:
+    '''
+        Returns a sample of the indexed books
+    '''
+    books_dict = utils.unpickle_object(books_pickle)
+    book_urls = [book_url for book_url in books_dict
+                 if book_url in book_vectorizer.description_vectors.url_index]
+    book_urls = random.Random(0).sample(
+        book_urls, min(sample_size, len(book_urls)))
+    return [books_dict[book_url] for book_url in book_urls]
+
+
+def compare_with_exhaustive(book_vectorizer: BookVectorizer, books: list, engine: str, k: int = 18):
+    '''
+        Queries the books with the exhaustive engine and the approximate engine,
+        and prints recall@k of the engine against the exact ranking with the latencies of both
+    '''
+    recalls = []
+    latencies = {'exhaustive': [], engine: []}
+    for book in books:
+        results = {}
+        for query_engine in latencies:
+            start_time = time.time()
+            results[query_engine] = book_vectorizer.calculate_top_k_similarities(
+                book, k=k, excluded_urls=[book.url], engine=query_engine)
+            latencies[query_engine].append(time.time() - start_time)
+        exact_urls = [url for _, url in results['exhaustive']]
+        recalls.append(evaluation.evaluate_recall(
+            exact_urls, [url for _, url in results[engine]]))
+
+    print(f"recall@{k} of {len(books)} queries: {sum(recalls) / len(recalls):.4f}")
+    for query_engine, engine_latencies in latencies.items():
+        engine_latencies.sort()
+        print(f"{query_engine}: p50 {evaluation.get_percentile(engine_latencies, 50) * 1000:.2f} ms, "
+              f"p99 {evaluation.get_percentile(engine_latencies, 99) * 1000:.2f} ms")
+
+
+def benchmark_lsh(tables: int = LSH_TABLES, bits: int = LSH_BITS, probes: int = LSH_PROBES, sample_size: int = 1000,
+                  index_file: str = INDEX_FILE, books_pickle: str = "out/pickle/books.pickle"):
+    book_vectorizer = BookVectorizer(index_file=index_file)
+    books = get_sample_queries(book_vectorizer, books_pickle, sample_size)
+
+    start_time = time.time()
+    book_vectorizer.build_lsh_index(tables, bits, probes)
+    print(f"Built LSH index with {tables} tables, {bits} bits, {probes} probes in "
+          f"{time.time() - start_time:.2f} seconds")
+    compare_with_exhaustive(book_vectorizer, books, 'lsh')
+
+
+def benchmark_lsa(rank: int = LSA_RANK, sample_size: int = 1000,
+                  index_file: str = INDEX_FILE, books_pickle: str = "out/pickle/books.pickle"):
+    book_vectorizer = BookVectorizer(index_file=index_file)
+    books = get_sample_queries(book_vectorizer, books_pickle, sample_size)
+
+    start_time = time.time()
+    lsa_model = book_vectorizer.build_lsa_model(rank)
+    print(f"Fitted LSA model with {lsa_model.get_rank()} dimensions in {time.time() - start_time:.2f} seconds, "
+          f"embeddings use {lsa_model.embeddings.nbytes / 2**20:.1f} MiB")
+    compare_with_exhaustive(book_vectorizer, books, 'lsa')
+
+
+def benchmark_shards(shard_count: int = os.cpu_count(), sample_size: int = 1000, engine: str = 'exhaustive',
+                     index_file: str = INDEX_FILE, books_pickle: str = "out/pickle/books.pickle"):
+    '''
+        Queries a sample of books in this process and with shard_count shard workers,
+        checks that the results are the same and prints the throughput of both
+    '''
+    book_vectorizer = BookVectorizer(index_file=index_file)
+    books = get_sample_queries(book_vectorizer, books_pickle, sample_size)
+
+    start_time = time.time()
+    expected = [book_vectorizer.calculate_top_k_similarities(book, k=18, excluded_urls=[book.url], engine=engine)
+                for book in books]
+    elapsed = time.time() - start_time
+    print(f"1 process: {len(books) / elapsed:.1f} queries/second")
+
+    shard_coordinator = ShardCoordinator(index_file, shard_count=shard_count)
+    try:
+        # Queries are sent concurrently, like the threads of the server
+        with ThreadPoolExecutor(shard_count) as query_pool:
+            start_time = time.time()
+            results = list(query_pool.map(lambda book: shard_coordinator.calculate_top_k_similarities(
+                book, k=18, excluded_urls=[book.url], engine=engine), books))
+            elapsed = time.time() - start_time
+        print(f"{shard_count} shards: {len(books) / elapsed:.1f} queries/second, "
+              f"{sum(result == expected_result for result, expected_result in zip(results, expected))}/{len(books)} results are the same")
+        for shard_stats in shard_coordinator.get_stats():
+            print(shard_stats)
+    finally:
+        shard_coordinator.close()
+
+
+def get_column_weight_bytes(book_vectorizer: BookVectorizer) -> int:
+    '''
+        Returns the bytes of the column-wise weights and their scales of both fields, the arrays read by scoring
+    '''
+    size = 0
+    for vector_matrix in (book_vectorizer.description_vectors, book_vectorizer.genre_vectors):
+        size += vector_matrix.column_data.nbytes
+        if vector_matrix.column_scales is not None:
+            size += vector_matrix.column_scales.nbytes
+    return size
+
+
+def benchmark_quantization(sample_size: int = 1000, engine: str = 'exhaustive', index_file: str = INDEX_FILE,
+                           books_pickle: str = "out/pickle/books.pickle", k: int = 18):
+    '''
+        Writes the index with every quantization next to index_file, then prints the size of the
+        column-wise weights and of the file, overlap@k with the float32 ranking with and without
+        the float32 rerank, and the query latencies of each
+    '''
+    book_vectorizer = BookVectorizer(index_file=index_file)
+    books = get_sample_queries(book_vectorizer, books_pickle, sample_size)
+    quantized_files = {}
+    for quantization in QUANTIZATIONS:
+        quantized_files[quantization] = f"{os.path.splitext(index_file)[0]}.{quantization}.index"
+        book_vectorizer.write_index(quantized_files[quantization], quantization)
+
+    expected_urls = None
+    for quantization in QUANTIZATIONS:
+        quantized_vectorizer = BookVectorizer(
+            index_file=quantized_files[quantization])
+        column_bytes = get_column_weight_bytes(quantized_vectorizer)
+        file_size = os.path.getsize(
+            utils.get_file_path(quantized_files[quantization]))
+        print(f"{quantization}: column-wise weights {column_bytes / 2**20:.2f} MiB, "
+              f"index file {file_size / 2**20:.2f} MiB")
+
+        # A rerank factor of 1 rescores only the k quantized results, so their set is not changed
+        rerank_factors = (1, quantized_vectorizer.rerank_factor) if quantization != 'float32' else (1,)
+        for rerank_factor in rerank_factors:
+            quantized_vectorizer.rerank_factor = rerank_factor
+            latencies = []
+            results = []
+            for book in books:
+                start_time = time.time()
+                results.append([url for _, url in quantized_vectorizer.calculate_top_k_similarities(
+                    book, k=k, excluded_urls=[book.url], engine=engine)])
+                latencies.append(time.time() - start_time)
+            if expected_urls is None:
+                expected_urls = results
+            overlaps = [evaluation.evaluate_recall(expected, result)
+                        for expected, result in zip(expected_urls, results)]
+            latencies.sort()
+            print(f"    rerank factor {rerank_factor}: overlap@{k} {sum(overlaps) / len(overlaps):.4f}, "
+                  f"{sum(result == expected for result, expected in zip(results, expected_urls))}/{len(books)} "
+                  f"rankings are the same, p50 {evaluation.get_percentile(latencies, 50) * 1000:.2f} ms, "
+                  f"p99 {evaluation.get_percentile(latencies, 99) * 1000:.2f} ms")
+
+
+def benchmark_genres(min_genre_overlap: int = 1, sample_size: int = 1000, index_file: str = INDEX_FILE,
+                     books_pickle: str = "out/pickle/books.pickle", k: int = 18):
+    '''
+        Compares the genre similarities of the genre bitsets with the genre vectors, then queries a sample
+        of books with and without the genre filter, and prints the candidates, overlap@k and latencies
+    '''
+    book_vectorizer = BookVectorizer(index_file=index_file)
+    books = get_sample_queries(book_vectorizer, books_pickle, sample_size)
+
+    start_time = time.time()
+    genre_index = book_vectorizer.build_genre_index()
+    print(f"Built genre index of {genre_index.genre_count} genres in {time.time() - start_time:.2f} seconds, "
+          f"bitsets use {genre_index.book_bitsets.nbytes / 2**20:.2f} MiB, "
+          f"posting bitmaps use {genre_index.genre_postings.nbytes / 2**20:.2f} MiB")
+
+    all_rows = np.arange(len(book_vectorizer.genre_vectors), dtype=np.int64)
+    latencies = {'vectors': [], 'bitsets': []}
+    differences = []
+    for book in books:
+        _, genre_vector = book_vectorizer.vectorize_query(book)
+        start_time = time.time()
+        vector_similarities = book_vectorizer.genre_vectors.calculate_similarities(
+            genre_vector)
+        latencies['vectors'].append(time.time() - start_time)
+        start_time = time.time()
+        bitset_similarities = genre_index.calculate_similarities(
+            genre_index.get_genre_ids(genre_vector), all_rows)
+        latencies['bitsets'].append(time.time() - start_time)
+        differences.append(
+            float(np.abs(vector_similarities - bitset_similarities).max()))
+    print(f"Genre similarities of all books, largest difference {max(differences):.2e}")
+    for name, name_latencies in latencies.items():
+        name_latencies.sort()
+        print(f"{name}: p50 {evaluation.get_percentile(name_latencies, 50) * 1000:.2f} ms, "
+              f"p99 {evaluation.get_percentile(name_latencies, 99) * 1000:.2f} ms")
+
+    candidate_counts = []
+    overlaps = []
+    latencies = {'exhaustive': [], f"genres={min_genre_overlap}": []}
+    for book in books:
+        description_vector, genre_vector = book_vectorizer.vectorize_query(
+            book)
+        results = []
+        for overlap in (0, min_genre_overlap):
+            start_time = time.time()
+            results.append([url for _, url in book_vectorizer.calculate_top_k_of_vectors(
+                description_vector, genre_vector, k, [book.url], min_genre_overlap=overlap)])
+            latencies['exhaustive' if overlap == 0 else f"genres={min_genre_overlap}"].append(
+                time.time() - start_time)
+        candidate_counts.append(len(genre_index.find_candidates(
+            genre_index.get_genre_ids(genre_vector), min_genre_overlap)))
+        overlaps.append(evaluation.evaluate_recall(results[0], results[1]))
+    print(f"{min_genre_overlap} shared genres: {sum(candidate_counts) / len(candidate_counts) / len(all_rows) * 100:.1f}% "
+          f"of books are candidates, overlap@{k} with the unfiltered ranking {sum(overlaps) / len(overlaps):.4f}")
+    for name, name_latencies in latencies.items():
+        name_latencies.sort()
+        print(f"{name}: p50 {evaluation.get_percentile(name_latencies, 50) * 1000:.2f} ms, "
+              f"p99 {evaluation.get_percentile(name_latencies, 99) * 1000:.2f} ms")
+
+
+def benchmark_threshold(sample_size: int = 1000, index_file: str = INDEX_FILE,
+                        books_pickle: str = "out/pickle/books.pickle", k: int = 18):
+    '''
+        Queries a sample of books with the exhaustive and threshold engines for several field weights,
+        and prints how many rankings are the same and their latencies
+    '''
+    book_vectorizer = BookVectorizer(index_file=index_file)
+    books = get_sample_queries(book_vectorizer, books_pickle, sample_size)
+    for field_weights in (book_vectorizer.get_field_weights(), (0.8, 0.2), (0.2, 0.8), (1.0, 0.0)):
+        latencies = {'exhaustive': [], 'threshold': []}
+        same_count = 0
+        for book in books:
+            description_vector, genre_vector = book_vectorizer.vectorize_query(
+                book)
+            results = []
+            for engine in latencies:
+                start_time = time.time()
+                results.append(book_vectorizer.calculate_top_k_of_vectors(
+                    description_vector, genre_vector, k, [book.url], engine, field_weights=field_weights))
+                latencies[engine].append(time.time() - start_time)
+            same_count += results[0] == results[1]
+        print(f"Weights {field_weights}: {same_count}/{len(books)} threshold rankings are the same as exhaustive")
+        for name, name_latencies in latencies.items():
+            name_latencies.sort()
+            print(f"{name}: p50 {evaluation.get_percentile(name_latencies, 50) * 1000:.2f} ms, "
+                  f"p99 {evaluation.get_percentile(name_latencies, 99) * 1000:.2f} ms")
+
+
+def benchmark_hashing(description_bits: int = DESCRIPTION_HASH_BITS, genre_bits: int = GENRE_HASH_BITS, sample_size: int = 1000,
+                      books_pickle: str = "out/pickle/books.pickle", k: int = 18):
+    '''
+        Builds the vocabulary and the hashed vectors of the books in memory, and prints their build times,
+        the memory needed to vectorize queries, the colliding terms, and overlap@k with the vocabulary
+        ranking, precision against goodreads and latencies of a sample of queries
+    '''
+    books_dict = utils.unpickle_object(books_pickle)
+
+    start_time = time.time()
+    exact_vectorizer = BookVectorizer()
+    exact_vectorizer.segmented_index = SegmentedIndex()
+    exact_vectorizer.segmented_index.add_books(books_dict)
+    exact_vectorizer.update_from_segments()
+    exact_vectorizer.load_vectors()
+    print(f"vocabulary: built in {time.time() - start_time:.2f} seconds")
+    start_time = time.time()
+    hashed_vectorizer = BookVectorizer()
+    hashed_vectorizer.hash_book_dict(
+        books_dict, description_bits=description_bits, genre_bits=genre_bits)
+    print(f"hashed: built in {time.time() - start_time:.2f} seconds")
+
+    for field, hash_bits in (('description', description_bits), ('genre', genre_bits)):
+        exact_data = getattr(exact_vectorizer, f"{field}_data")
+        hashed_data = getattr(hashed_vectorizer, f"{field}_data")
+        terms = list(exact_data.vocabulary)
+        feature_hasher = FeatureHasher(hash_bits)
+        features = {feature_hasher.get_feature(term)[0] for term in terms}
+        vocabulary_size = len(pickle.dumps(list(terms), protocol=pickle.HIGHEST_PROTOCOL)) + \
+            exact_vectorizer.segmented_index.doc_frequencies[field].nbytes
+        print(f"{field}: {len(terms)} terms in {len(features)} of {feature_hasher.feature_count} features, "
+              f"vocabulary and document frequencies {vocabulary_size / 2**20:.2f} MiB, "
+              f"hashed document frequencies {hashed_data.doc_frequencies.nbytes / 2**20:.2f} MiB")
+
+    books = random.Random(0).sample(
+        list(books_dict.values()), min(sample_size, len(books_dict)))
+    overlaps = []
+    precisions = {'vocabulary': [], 'hashed': []}
+    latencies = {'vocabulary': [], 'hashed': []}
+    for book in books:
+        results = {}
+        for name, book_vectorizer in (('vocabulary', exact_vectorizer), ('hashed', hashed_vectorizer)):
+            start_time = time.time()
+            results[name] = [url for _, url in book_vectorizer.calculate_top_k_similarities(
+                book, k=k, excluded_urls=[book.url])]
+            latencies[name].append(time.time() - start_time)
+            precisions[name].append(evaluation.evaluate_precision(
+                book.recommendations[:k], results[name])[1])
+        overlaps.append(evaluation.evaluate_recall(
+            results['vocabulary'], results['hashed']))
+    print(f"overlap@{k} of the hashed ranking with the vocabulary ranking: {sum(overlaps) / len(overlaps):.4f}")
+    for name, name_latencies in latencies.items():
+        name_latencies.sort()
+        print(f"{name}: average precision {sum(precisions[name]) / len(books):.4f}, "
+              f"p50 {evaluation.get_percentile(name_latencies, 50) * 1000:.2f} ms, "
+              f"p99 {evaluation.get_percentile(name_latencies, 99) * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("These are the valid options:")
+        print("benchmark.py extraction [page-store] [processes] ----> Measures pages/second of the extractor on saved pages")
+        print("benchmark.py memory [books-pickle] ----> Compares the memory of the old and the new BookData layouts")
+        print("benchmark.py lsh [tables] [bits] [probes] [sample-size] ----> Measures recall@18 and latency of the lsh engine")
+        print("benchmark.py lsa [rank] [sample-size] ----> Measures recall@18 and latency of the lsa engine")
+        print("benchmark.py shards [shard-count] [sample-size] [engine] ----> Compares the query throughput of shard workers with one process")
+        print("benchmark.py genres [min-genre-overlap] [sample-size] ----> Measures the genre bitsets and the genre filter against the vectors")
+        print("benchmark.py quantization [sample-size] [engine] ----> Measures memory, overlap@18 and latency of float16 and int8 weights")
+        print("benchmark.py hashing [description-bits] [genre-bits] [sample-size] ----> Compares the quality, memory and speed of hashed features with the vocabulary")
+        print("benchmark.py threshold [sample-size] ----> Compares the threshold engine with exhaustive for several field weights")
+    elif sys.argv[1] == "extraction":
+        page_store_file = sys.argv[2] if len(sys.argv) > 2 else PAGE_STORE_FILE
+        processes = int(sys.argv[3]) if len(
+            sys.argv) > 3 else os.cpu_count()
+        benchmark_extraction(page_store_file, processes)
+    elif sys.argv[1] == "memory":
+        books_pickle = sys.argv[2] if len(
+            sys.argv) > 2 else "out/pickle/books.pickle"
+        benchmark_book_data_memory(books_pickle)
+    elif sys.argv[1] == "lsh":
+        arguments = [int(argument) for argument in sys.argv[2:6]]
+        benchmark_lsh(*arguments)
+    elif sys.argv[1] == "lsa":
+        arguments = [int(argument) for argument in sys.argv[2:4]]
+        benchmark_lsa(*arguments)
+    elif sys.argv[1] == "shards":
+        shard_count = int(sys.argv[2]) if len(
+            sys.argv) > 2 else os.cpu_count()
+        sample_size = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+        engine = sys.argv[4] if len(sys.argv) > 4 else 'exhaustive'
+        benchmark_shards(shard_count, sample_size, engine)
+    elif sys.argv[1] == "quantization":
+        sample_size = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+        engine = sys.argv[3] if len(sys.argv) > 3 else 'exhaustive'
+        benchmark_quantization(sample_size, engine)
+    elif sys.argv[1] == "genres":
+        arguments = [int(argument) for argument in sys.argv[2:4]]
+        benchmark_genres(*arguments)
+    elif sys.argv[1] == "hashing":
+        arguments = [int(argument) for argument in sys.argv[2:5]]
+        benchmark_hashing(*arguments)
+    elif sys.argv[1] == "threshold":
+        arguments = [int(argument) for argument in sys.argv[2:3]]
+        benchmark_threshold(*arguments)
@@ -0,0 +1,124 @@
+import os
+import random
+import time
+import utils
+import evaluation
+from concurrent.futures import ProcessPoolExecutor
+from index import INDEX_FILE
+from neighbors import NEIGHBORS_FILE
+from pagestore import BookStore, BOOK_STORE_FILE
+from recommender import Recommender, BOOKS_PICKLE, RECOMMENDATION_COUNT, RECOMMENDER_ENGINES
+from typing import List
+
+# Recommender of the pool processes, loaded once per process
+worker_recommender: Recommender = None
+
+
+def init_evaluation_worker(books_dict_file: str, index_file: str, neighbors_file: str, book_store_file: str):
+    global worker_recommender
+    worker_recommender = Recommender(books_dict_file=books_dict_file, index_file=index_file,
+                                     neighbors_file=neighbors_file, book_store_file=book_store_file)
+
+
+def evaluate_query(book_url: str, k: int, engine: str) -> dict:
+    '''
+        Queries the book with the recommender of the process,
+        returns the metrics of the query against its goodreads recommendations
+    '''
+    result = worker_recommender.get_recommendations(
+        book_url, k=k, engine=engine)
+    if "error" in result:
+        return None
+    goodreads_recommendations = result["goodreads_recommendations"]
+    calculated_recommendations = result["calculated_recommendations"]
+    return {
+        "precision": result["precision"],
+        "average_precision": result["average_precision"],
+        "recall": evaluation.evaluate_recall(goodreads_recommendations, calculated_recommendations),
+        "ndcg": evaluation.evaluate_ndcg(goodreads_recommendations, calculated_recommendations),
+        "latency": result["latency"]
+    }
+
+
+class CorpusEvaluator():
+    '''
+        Queries every book of the book store, or of books_dict if there is no book store,
+        or a sample of them, against the index and compares the results with their goodreads recommendations.
+        No book is downloaded, the query books come from the book store or books_dict.
+    '''
+
+    def __init__(self, books_dict_file: str = BOOKS_PICKLE, index_file: str = INDEX_FILE,
+                 neighbors_file: str = NEIGHBORS_FILE, processes: int = os.cpu_count(),
+                 book_store_file: str = BOOK_STORE_FILE):
+        self.books_dict_file = books_dict_file
+        self.book_store_file = book_store_file
+        self.index_file = index_file
+        self.neighbors_file = neighbors_file
+        self.processes = processes or 1
+
+    def get_query_urls(self, sample_size: int = None, seed: int = 0) -> List[str]:
+        '''
+            Returns urls of the books with goodreads recommendations, sampled if sample_size is given
+        '''
+        if utils.file_exists(self.book_store_file):
+            # Books are read one by one, indexes built by the stream command have no books_dict
+            book_store = BookStore(self.book_store_file, read_only=True)
+            books = book_store.iterate_books()
+        else:
+            book_store = None
+            books = utils.unpickle_object(self.books_dict_file).items()
+        book_urls = [book_url for book_url, book in books
+                     if book.recommendations]
+        if book_store is not None:
+            book_store.close()
+        if sample_size is not None and sample_size < len(book_urls):
+            book_urls = random.Random(seed).sample(book_urls, sample_size)
+        return book_urls
+
+    def evaluate(self, k: int = RECOMMENDATION_COUNT, engine: str = 'exhaustive', sample_size: int = None, seed: int = 0) -> dict:
+        '''
+            Returns MAP, mean precision@k, recall@k, nDCG@k and p50/p95/p99 latencies
+            of the queries in seconds
+        '''
+        # Fail before loading anything, the report must not name another engine than the one scored
+        if engine not in RECOMMENDER_ENGINES:
+            raise ValueError(
+                f"Unknown engine {engine}, expected one of {RECOMMENDER_ENGINES}")
+        book_urls = self.get_query_urls(sample_size, seed)
+        print(f"Evaluating {len(book_urls)} queries with engine={engine}, k={k} in {self.processes} processes...")
+
+        start_time = time.time()
+        initargs = (self.books_dict_file, self.index_file,
+                    self.neighbors_file, self.book_store_file)
+        if self.processes == 1:
+            init_evaluation_worker(*initargs)
+            query_results = [evaluate_query(book_url, k, engine)
+                             for book_url in book_urls]
+        else:
+            with ProcessPoolExecutor(self.processes, initializer=init_evaluation_worker, initargs=initargs) as pool:
+                query_results = list(pool.map(evaluate_query, book_urls, [k] * len(book_urls),
+                                              [engine] * len(book_urls), chunksize=16))
+        elapsed = time.time() - start_time
+
+        query_results = [
+            query_result for query_result in query_results if query_result is not None]
+        query_count = len(query_results)
+        report = {"engine": engine, "k": k, "queries": query_count,
+                  "elapsed": elapsed}
+        for metric, name in [("average_precision", "map"), ("precision", f"precision@{k}"),
+                             ("recall", f"recall@{k}"), ("ndcg", f"ndcg@{k}")]:
+            report[name] = sum(query_result[metric]
+                               for query_result in query_results) / query_count if query_count > 0 else 0
+        latencies = sorted(query_result["latency"]
+                           for query_result in query_results)
+        for percentile in (50, 95, 99):
+            report[f"p{percentile}_latency"] = evaluation.get_percentile(
+                latencies, percentile)
+        return report
+
+
+def print_report(report: dict):
+    print("---------------------------")
+    for name, value in report.items():
+        print(f"{name}: {value}")
+    print("---------------------------")
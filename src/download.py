@@ -1,10 +1,62 @@
-from typing import List
+from typing import Iterator, List, Tuple
 from book import Book
 import utils
+import hashlib
+import heapq
+import math
+import os
 import time
 import threading
+import queue
+import random
 import re
+import http.client
+import urllib.parse
 import urllib.request
+from pagestore import PageStore, PAGE_STORE_FILE
+from metrics import metrics, BufferedLogWriter
+from concurrent.futures import Future, ProcessPoolExecutor
+
+
+# Patterns are compiled once, '.' also matches new lines so the page is not rewritten before matching
+TITLE_PATTERN = re.compile(r'<h1 id="bookTitle".*?>(.*?)<\/h1>', re.DOTALL)
+AUTHOR_PATTERN = re.compile(
+    r'<div class=\'authorName__container\'.*?>.*?<a class="authorName".*?><span.*?>(.*?)<\/div>', re.DOTALL)
+DESCRIPTION_PATTERN = re.compile(
+    r'<div id="descriptionContainer".*?<\/div>', re.DOTALL)
+FREE_TEXT_PATTERN = re.compile(r'<span id="freeText\d+".*?>(.*?)<\/span>')
+FREE_TEXT_CONTAINER_PATTERN = re.compile(
+    r'<span id="freeTextContainer\d+".*?>(.*?)<\/span>')
+RECOMMENDATION_PATTERN = re.compile(
+    r'<li class=\'cover\'.*?<a.*?href="(.*?)".*?<\/a>', re.DOTALL)
+GENRE_PATTERN = re.compile(
+    r'<div class="elementList ">.*?<div class="left">.*?<a.*?>(.*?)<\/a>', re.DOTALL)
+HTML_TAG_PATTERN = re.compile(r'<.*?>')
+SPACES_PATTERN = re.compile(r'\s{2,}')
+PARENTHESIS_PATTERN = re.compile(r'\(.*?\)')
+
+# New lines inside the extracted parts are replaced with spaces
+NEW_LINE_TRANSLATION = str.maketrans('\n\r', '  ')
+
+# Urls waiting for a download thread, per thread
+URL_QUEUE_SIZE_PER_THREAD = 4
+
+# Extracted books waiting for the consumer of stream_books
+BOOK_QUEUE_SIZE = 256
+
+CRAWL_FRONTIER_FILE = "out/crawl_frontier.pickle"
+
+# Urls seen by a crawl are kept in a Bloom filter of a fixed size,
+# more urls than its capacity raise the rate of urls wrongly skipped as seen
+CRAWL_SEEN_CAPACITY = 2000000
+CRAWL_SEEN_ERROR_RATE = 0.001
+
+# Seconds between the checkpoints of the crawl frontier
+CRAWL_CHECKPOINT_INTERVAL = 30.0
+
+# The priority heap is rebuilt from the waiting urls when it has more entries than this
+# and more than twice the waiting urls, old entries of urls recommended again pile up in it
+CRAWL_HEAP_COMPACTION_SIZE = 1024
 
 
 class BookExtractor():
@@ -18,55 +70,52 @@ class BookExtractor():
             Replaces multiple spaces with single space
             Returns the cleared text
         '''
-        cleared_text = re.sub(r'<.*?>', '', text)
-        cleared_text = re.sub(r'\s{2,}', ' ', cleared_text).strip()
+        cleared_text = HTML_TAG_PATTERN.sub('', text)
+        cleared_text = SPACES_PATTERN.sub(' ', cleared_text).strip()
         return cleared_text
 
     def __extract_title(self, book_html: str) -> str:
         '''
             Extracts and returns the title from book_html
         '''
-        title_match = re.findall(
-            r'<h1 id="bookTitle".*?>(.*?)<\/h1>', book_html)
-        if len(title_match) > 0:
-            return self.__clear_html_text(title_match[0])
+        title_match = TITLE_PATTERN.search(book_html)
+        if title_match:
+            return self.__clear_html_text(title_match.group(1).translate(NEW_LINE_TRANSLATION))
         return ''
 
     def __extract_authors(self, book_html: str) -> List[str]:
         '''
             Extracts and returns the authors from book_html
         '''
-        authors_match = re.findall(
-            r'<div class=\'authorName__container\'.*?>.*?<a class="authorName".*?><span.*?>(.*?)<\/div>', book_html)
+        authors_match = AUTHOR_PATTERN.findall(book_html)
         # Clear html inside text
-        authors = [self.__clear_html_text(author_match)
+        authors = [self.__clear_html_text(author_match.translate(NEW_LINE_TRANSLATION))
                    for author_match in authors_match]
         # Remove paranthesis descripiton of authors
-        authors = [re.sub('\(.*?\)', '', author).strip() for author in authors]
+        authors = [PARENTHESIS_PATTERN.sub('', author).strip()
+                   for author in authors]
         return authors
 
     def __extract_description(self, book_html: str) -> str:
         '''
             Extracts and returns the description from book_html
         '''
-        description_match = re.findall(
-            r'<div id="descriptionContainer".*?<\/div>', book_html)
-        if len(description_match) > 0:
-            description = description_match[0]
-            # freeText11251655968315975519
-            free_text_match = re.findall(
-                r'<span id="freeText\d+".*?>(.*?)<\/span>', description)
+        description_match = DESCRIPTION_PATTERN.search(book_html)
+        if description_match:
+            description = description_match.group(
+                0).translate(NEW_LINE_TRANSLATION)
+            # freeText11251655968315975519
+            free_text_match = FREE_TEXT_PATTERN.search(description)
             span_text = ''
-            if len(free_text_match) > 0:
+            if free_text_match:
                 # Take long version
-                span_text = free_text_match[0]
-                pass
+                span_text = free_text_match.group(1)
             else:
                 # Take short version
-                free_text_container_match = re.findall(
-                    r'<span id="freeTextContainer\d+".*?>(.*?)<\/span>', description)
-                if len(free_text_container_match) > 0:
-                    span_text = free_text_container_match[0]
+                free_text_container_match = FREE_TEXT_CONTAINER_PATTERN.search(
+                    description)
+                if free_text_container_match:
+                    span_text = free_text_container_match.group(1)
             # Remove internal html elements in the span text
             return self.__clear_html_text(span_text)
         return ''
@@ -75,24 +124,22 @@ class BookExtractor():
         '''
             Extracts and returns the recommendations from book_html
         '''
-        recommendations_match = re.findall(
-            r'<li class=\'cover\'.*?<a.*?href="(.*?)".*?<\/a>', book_html)
-        return [utils.compress_book_url(str(recommendation)) for recommendation in recommendations_match]
+        recommendations_match = RECOMMENDATION_PATTERN.findall(book_html)
+        return [utils.compress_book_url(recommendation.translate(NEW_LINE_TRANSLATION)) for recommendation in recommendations_match]
 
     def __extract_genres(self, book_html: str) -> List[str]:
         '''
             Extracts and returns the genres from book_html
+            Duplicates are removed, genres keep the order of their first occurrence
         '''
-        genres_match = re.findall(
-            r'<div class="elementList ">.*?<div class="left">.*?<a.*?>(.*?)<\/a>', book_html)
-        return list(set([self.__clear_html_text(genre) for genre in genres_match]))
+        genres_match = GENRE_PATTERN.findall(book_html)
+        return list(dict.fromkeys([self.__clear_html_text(genre.translate(NEW_LINE_TRANSLATION)) for genre in genres_match]))
 
     def extract_book(self, book_url: str, book_html: str) -> Book:
         '''
             Extracts and returns the book from book_html
         '''
         compressed_url = utils.compress_book_url(book_url)
-        book_html = re.sub(r'\n|\r', ' ', book_html)
         return Book(
             url=compressed_url,
             title=self.__extract_title(book_html),
@@ -103,63 +150,627 @@ class BookExtractor():
         )
 
 
+def extract_book_page(book_url: str, book_html: str) -> Book:
+    '''
+        Extracts the book from book_html, used by extraction processes
+    '''
+    return BookExtractor().extract_book(book_url=book_url, book_html=book_html)
+
+
+class FetchError(Exception):
+    '''
+        Raised when a page cannot be fetched
+        retryable is False for errors that will not go away by trying again, e.g. 404
+    '''
+
+    def __init__(self, message: str, retryable: bool = True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class RateLimiter():
+    '''
+        Spaces the requests to the same host at least 1 / requests_per_second seconds apart
+        It is shared by all download threads
+    '''
+
+    def __init__(self, requests_per_second: float):
+        self.interval = 1 / requests_per_second if requests_per_second else 0
+        self.next_request_times = {}
+        self.lock = threading.Lock()
+
+    def wait(self, host: str):
+        with self.lock:
+            now = time.monotonic()
+            request_time = max(now, self.next_request_times.get(host, now))
+            self.next_request_times[host] = request_time + self.interval
+        if request_time > now:
+            time.sleep(request_time - now)
+
+
+class PageFetcher():
+    '''
+        Fetches pages over keep-alive connections, one connection per host
+        Each download thread has its own PageFetcher
+    '''
+    MAX_REDIRECTS = 5
+
+    def __init__(self, rate_limiter: RateLimiter, timeout: float = 60):
+        self.rate_limiter = rate_limiter
+        self.timeout = timeout
+        self.connections: dict[tuple, http.client.HTTPConnection] = {}
+
+    def get_connection(self, scheme: str, host: str) -> http.client.HTTPConnection:
+        key = (scheme, host)
+        if key not in self.connections:
+            if scheme == "https":
+                self.connections[key] = http.client.HTTPSConnection(
+                    host, timeout=self.timeout)
+            else:
+                self.connections[key] = http.client.HTTPConnection(
+                    host, timeout=self.timeout)
+        return self.connections[key]
+
+    def close_connection(self, scheme: str, host: str):
+        connection = self.connections.pop((scheme, host), None)
+        if connection:
+            connection.close()
+
+    def fetch(self, url: str) -> str:
+        '''
+            Returns the page in url, follows redirects
+            Raises FetchError if the page cannot be fetched
+        '''
+        for _ in range(self.MAX_REDIRECTS + 1):
+            parsed_url = urllib.parse.urlsplit(url)
+            path = parsed_url.path or "/"
+            if parsed_url.query:
+                path += f"?{parsed_url.query}"
+
+            self.rate_limiter.wait(parsed_url.netloc)
+            connection = self.get_connection(
+                parsed_url.scheme, parsed_url.netloc)
+            try:
+                connection.request("GET", path, headers={
+                                   "Connection": "keep-alive"})
+                response = connection.getresponse()
+                body = response.read()
+                metrics.increment("bytes_downloaded_total", len(body))
+            except (OSError, http.client.HTTPException) as e:
+                # The connection is broken, open a new one next time
+                self.close_connection(parsed_url.scheme, parsed_url.netloc)
+                raise FetchError(f"{type(e).__name__}: {e}")
+
+            if response.will_close:
+                self.close_connection(parsed_url.scheme, parsed_url.netloc)
+
+            if response.status in (301, 302, 303, 307, 308) and response.getheader("Location"):
+                url = urllib.parse.urljoin(url, response.getheader("Location"))
+                continue
+            if response.status != 200:
+                retryable = response.status == 429 or response.status >= 500
+                raise FetchError(
+                    f"HTTP {response.status} {response.reason}", retryable)
+            try:
+                return body.decode("utf-8")
+            except UnicodeDecodeError as e:
+                # The same bytes come back again
+                raise FetchError(f"{type(e).__name__}: {e}", retryable=False)
+
+        raise FetchError("Too many redirects", retryable=False)
+
+    def close(self):
+        for connection in self.connections.values():
+            connection.close()
+        self.connections.clear()
+
+
+class DownloadProgress():
+    '''
+        Counts finished, failed and retried downloads and reports the throughput
+    '''
+
+    def __init__(self, total: int):
+        self.total = total
+        self.completed = 0
+        self.failed = 0
+        self.retries = 0
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+
+    def add(self, completed: int = 0, failed: int = 0, retries: int = 0):
+        with self.lock:
+            self.completed += completed
+            self.failed += failed
+            self.retries += retries
+
+    def report(self):
+        elapsed = time.time() - self.start_time
+        finished = self.completed + self.failed
+        throughput = finished / elapsed if elapsed > 0 else 0
+        total = f"out of {self.total} documents" if self.total is not None else "documents"
+        print(f"{self.completed} completed, {self.failed} failed, {self.retries} retries, {total}. "
+              f"{throughput:.1f} documents/second")
+
+    def report_periodically(self, interval: float, stop_event: threading.Event):
+        while not stop_event.wait(interval):
+            self.report()
+
+
+class BloomFilter():
+    '''
+        Set of strings in a fixed number of bits, so its memory does not grow with the strings added.
+        A string sets hash_count bits found with double hashing of its blake2b hash, a string whose
+        bits are all set is probably in the set. Strings that were not added are reported as added
+        with error_rate probability once capacity strings are added, and more often after that.
+    '''
+
+    def __init__(self, capacity: int = CRAWL_SEEN_CAPACITY, error_rate: float = CRAWL_SEEN_ERROR_RATE):
+        self.bit_count = max(8, math.ceil(-capacity *
+                             math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.bit_count / capacity * math.log(2)))
+        self.bits = bytearray((self.bit_count + 7) // 8)
+        self.count = 0
+
+    def get_positions(self, item: str) -> List[int]:
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        # An odd step visits different bits
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.bit_count for i in range(self.hash_count)]
+
+    def add(self, item: str) -> bool:
+        '''
+            Adds the item, returns False if it was probably added before
+        '''
+        added = False
+        for position in self.get_positions(item):
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                self.bits[position >> 3] |= mask
+                added = True
+        self.count += added
+        return added
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.get_positions(item))
+
+
+class CrawlFrontier():
+    '''
+        Urls waiting to be crawled, shared by the download threads of a crawl.
+
+        Every url is queued once, urls are deduplicated with a BloomFilter of the urls seen so far.
+        Urls are taken in breadth-first order (by depth, then in the order they were found), or with
+        priority, by the number of crawled books recommending them, then breadth-first. A url that is
+        recommended again while it waits gets a new heap entry, its old entry is skipped when popped,
+        and the heap is rebuilt from the waiting urls when the old entries outnumber them.
+
+        Crawling stops when max_books urls are taken, or when no url is waiting and no download is in flight.
+        Urls deeper than max_depth are not queued. The frontier is pickled into a checkpoint with the urls
+        in flight queued again, so a stopped crawl is resumed from its last checkpoint.
+    '''
+
+    def __init__(self, max_books: int = None, max_depth: int = None, priority: bool = False,
+                 seen_capacity: int = CRAWL_SEEN_CAPACITY, seen_error_rate: float = CRAWL_SEEN_ERROR_RATE):
+        self.max_books = max_books
+        self.max_depth = max_depth
+        self.priority = priority
+        self.seen = BloomFilter(seen_capacity, seen_error_rate)
+        # (-recommendation count if priority else 0, depth, sequence, url)
+        self.heap: List[Tuple[int, int, int, str]] = []
+        # Waiting url -> (recommendation count, depth, sequence of the url when it was queued)
+        self.waiting: dict[str, Tuple[int, int, int]] = {}
+        # Url in flight -> depth
+        self.in_flight: dict[str, int] = {}
+        self.sequence = 0
+        self.taken = 0
+        self.condition = threading.Condition()
+
+    def __getstate__(self) -> dict:
+        with self.condition:
+            state = dict(self.__dict__)
+            del state["condition"]
+            # Urls in flight are downloaded first again after a restart
+            state["heap"] = list(self.heap)
+            state["waiting"] = dict(self.waiting)
+            for url, depth in self.in_flight.items():
+                state["waiting"][url] = (math.inf, depth, -1)
+                heapq.heappush(state["heap"], (-math.inf, depth, -1, url))
+            state["taken"] = self.taken - len(self.in_flight)
+            state["in_flight"] = {}
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self.condition = threading.Condition()
+
+    def get_waiting_count(self) -> int:
+        return len(self.waiting)
+
+    def __get_entry(self, url: str) -> Tuple[int, int, int, str]:
+        count, depth, sequence = self.waiting[url]
+        return (-count if self.priority else 0, depth, sequence, url)
+
+    def __push(self, url: str):
+        heapq.heappush(self.heap, self.__get_entry(url))
+        if len(self.heap) > max(CRAWL_HEAP_COMPACTION_SIZE, 2 * len(self.waiting)):
+            self.heap = [self.__get_entry(url) for url in self.waiting]
+            heapq.heapify(self.heap)
+
+    def add(self, url: str, depth: int = 0) -> bool:
+        '''
+            Queues the url if it was not seen before, returns whether it is queued
+        '''
+        if self.max_depth is not None and depth > self.max_depth:
+            return False
+        with self.condition:
+            if not self.seen.add(url):
+                if self.priority and url in self.waiting:
+                    count, waiting_depth, sequence = self.waiting[url]
+                    self.waiting[url] = (count + 1, waiting_depth, sequence)
+                    self.__push(url)
+                return False
+            self.waiting[url] = (1, depth, self.sequence)
+            self.sequence += 1
+            self.__push(url)
+            self.condition.notify()
+            metrics.increment("crawl_urls_queued_total")
+            return True
+
+    def take(self) -> Tuple[int, int, str]:
+        '''
+            Returns (order, depth, url) of the next url, waits while the frontier is empty and
+            downloads are in flight, since they can add urls. Returns None when the crawl is over.
+        '''
+        with self.condition:
+            while True:
+                if self.max_books is not None and self.taken >= self.max_books:
+                    return None
+                while self.heap:
+                    key, depth, _, url = heapq.heappop(self.heap)
+                    waiting = self.waiting.get(url)
+                    # Skip the old entries of urls that are taken or recommended again
+                    if waiting is None or (self.priority and -key != waiting[0]):
+                        continue
+                    del self.waiting[url]
+                    self.in_flight[url] = depth
+                    self.taken += 1
+                    return (self.taken - 1, depth, url)
+                if not self.in_flight:
+                    return None
+                self.condition.wait()
+
+    def complete(self, url: str, recommendations: List[str]):
+        '''
+            Finishes the url taken from the frontier and queues its recommendations one level deeper
+        '''
+        with self.condition:
+            depth = self.in_flight[url]
+            for recommendation in recommendations:
+                self.add(recommendation, depth + 1)
+            del self.in_flight[url]
+            # Threads waiting for urls may be able to stop
+            self.condition.notify_all()
+
+    def save(self, location: str = CRAWL_FRONTIER_FILE):
+        '''
+            Pickles the frontier into location, the old checkpoint is replaced at once
+        '''
+        utils.create_dir(os.path.dirname(location))
+        temporary_location = f"{location}.tmp"
+        utils.pickle_object(self, temporary_location)
+        os.replace(utils.get_file_path(temporary_location),
+                   utils.get_file_path(location))
+
+    def save_periodically(self, location: str, interval: float, stop_event: threading.Event):
+        while not stop_event.wait(interval):
+            self.save(location)
+
+
 class BookDownloader():
 
     def __init__(self,
-                 download_dir="out/books",
+                 page_store_file=PAGE_STORE_FILE,
                  logs_file="out/download_logs.txt",
-                 errors_file="out/download_errors.txt"
+                 errors_file="out/download_errors.txt",
+                 concurrency=16,
+                 requests_per_second=8,
+                 max_retries=5,
+                 backoff_base=1.0,
+                 backoff_cap=60.0,
+                 report_interval=10.0,
+                 extraction_processes=0,
+                 url_filter=utils.is_book_url
                  ):
-        self.download_dir = download_dir
+        '''
+            concurrency is the number of download threads
+            requests_per_second limits the requests sent to each host
+            max_retries is the retry budget of each url, retries wait
+            a random time up to backoff_base * 2^retry seconds, at most backoff_cap
+            extraction_processes is the number of processes extracting downloaded pages,
+            if it is 0 pages are extracted in the download threads
+            url_filter decides which lines of the books file are book urls
+            page_store_file is the pack file of the saved pages
+        '''
+        self.page_store_file = page_store_file
+        self.page_store: PageStore = None
+        # Buffered writers of the log and error files while downloading
+        self.log_writer: BufferedLogWriter = None
+        self.error_writer: BufferedLogWriter = None
         self.logs_file = logs_file
         self.errors_file = errors_file
+        self.concurrency = concurrency
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.report_interval = report_interval
+        self.extraction_processes = extraction_processes
+        self.extraction_pool: ProcessPoolExecutor = None
+        # Limits the pages waiting for extraction, so that downloads cannot run far ahead
+        self.extraction_slots = threading.Semaphore(
+            max(1, 4 * extraction_processes))
+        self.url_filter = url_filter
         self.books_dict = {}
+        # Extracted books are put into book_queue instead of books_dict while streaming
+        self.book_queue: queue.Queue = None
         self.failed_downloads = []
         self.extractor = BookExtractor()
 
-    def __download_book(self, index: int, url: str, save_into_file=False):
+    def get_backoff(self, retry: int) -> float:
+        '''
+            Returns the waiting time before the retry, exponential backoff with full jitter
+        '''
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** retry))
+
+    def __add_failed_download(self, index: int, url: str, progress: DownloadProgress):
+        '''
+            Adds the (index, url) tuple into failed_downloads
+        '''
+        self.failed_downloads.append((index, url))
+        progress.add(failed=1)
+
+    def __try_download_book(self, index: int, url: str, fetcher: PageFetcher, progress: DownloadProgress, save_into_file=False) -> Book:
+        '''
+            Downloads a single book like __download_book, any other error of the url fails the url,
+            so that a bad page cannot stop the download thread
+        '''
+        try:
+            return self.__download_book(index, url, fetcher, progress, save_into_file)
+        except Exception as e:
+            print(
+                f"Error while downloading book: {url}, {type(e).__name__}: {e}", file=self.error_writer)
+            metrics.increment("download_errors_total")
+            # The connections may be in the middle of a response
+            fetcher.close()
+            self.__add_failed_download(index, url, progress)
+            return None
+
+    def __download_book(self, index: int, url: str, fetcher: PageFetcher, progress: DownloadProgress, save_into_file=False) -> Book:
         '''
             Downloads a single book if it hasn't been downloaded before,
-            If download is failed, adds the (index, url) tuple into failed_downloads
+            Retries failed downloads up to max_retries times with exponential backoff,
+            If download is still failed, adds the (index, url) tuple into failed_downloads
             index is positional index of the url in books.txt file
             url is the full url of the book
+            Returns the book if it is extracted in this thread, None otherwise
         '''
-        with open(utils.get_file_path(self.logs_file), "a+") as log_file:
-            with open(utils.get_file_path(self.errors_file), "a+") as error_file:
-                if not utils.is_book_url(url):
-                    print(f"Bad url: {url}", file=log_file)
-                    return
-                file_name = f"{self.download_dir}/{index}.html"
-                book_html = ''
-                if utils.file_exists(file_name):
-                    print(f"Book already exists: {file_name}", file=log_file)
-                    with open(utils.get_file_path(file_name), "r") as book_file:
-                        book_html = book_file.read()
-                else:
-                    try:
-                        req = urllib.request.Request(url)
-                        with urllib.request.urlopen(req, timeout=60) as response:
-                            book_html = response.read().decode("utf-8")
-                            if save_into_file:
-                                print(
-                                    f"Book is saved into: {file_name}", file=log_file)
-                                # Save book into file
-                                with open(utils.get_file_path(file_name), "w+") as f_out:
-                                    print(book_html, file=f_out)
-                    except Exception as e:
-                        print(
-                            f"Error while downloading book: {url}, {e}", file=error_file)
+        log_file, error_file = self.log_writer, self.error_writer
+        if not self.url_filter(url):
+            print(f"Bad url: {url}", file=log_file)
+            metrics.increment("bad_urls_total")
+            progress.add(failed=1)
+            return
+        book_html = self.page_store.get(
+            url) if self.page_store else None
+        if book_html is not None:
+            print(f"Book already exists: {url}", file=log_file)
+            metrics.increment("pages_stored_total")
+        else:
+            retry = 0
+            while True:
+                try:
+                    with metrics.time("fetch"):
+                        book_html = fetcher.fetch(url)
+                    break
+                except FetchError as e:
+                    print(
+                        f"Error while downloading book: {url}, {e}", file=error_file)
+                    metrics.increment("fetch_errors_total")
+                    if not e.retryable or retry >= self.max_retries:
                         # Add book into failed downloads
-                        self.failed_downloads.append((index, url))
-                if book_html and book_html != '':
-                    try:
-                        # Extract book and save into books
-                        compressed_url = utils.compress_book_url(url)
-                        self.books_dict[compressed_url] = self.extractor.extract_book(
-                            book_url=url, book_html=book_html)
-                    except Exception as e:
-                        print(
-                            f"Error while extracting book: {url}, {e}", file=error_file)
+                        self.__add_failed_download(index, url, progress)
+                        return
+                    time.sleep(self.get_backoff(retry))
+                    retry += 1
+                    progress.add(retries=1)
+                    metrics.increment("fetch_retries_total")
+            metrics.increment("pages_downloaded_total")
+            if save_into_file:
+                print(
+                    f"Book is saved into: {self.page_store_file}", file=log_file)
+                self.page_store.put(url, book_html)
+        book = None
+        if book_html and book_html != '':
+            if self.extraction_pool:
+                self.__submit_extraction(url, book_html)
+            else:
+                book = self.__extract_book(url, book_html)
+        progress.add(completed=1)
+        return book
+
+    def __extract_book(self, url: str, book_html: str) -> Book:
+        '''
+            Extracts the book in this thread and saves it into books
+            Returns the book, None if it cannot be extracted
+        '''
+        try:
+            with metrics.time("extract"):
+                book = self.extractor.extract_book(
+                    book_url=url, book_html=book_html)
+        except Exception as e:
+            print(
+                f"Error while extracting book: {url}, {e}", file=self.error_writer)
+            metrics.increment("extraction_errors_total")
+            return None
+        self.__save_book(url, book)
+        return book
+
+    def __open_logs(self):
+        self.log_writer = BufferedLogWriter(self.logs_file)
+        self.error_writer = BufferedLogWriter(self.errors_file)
+
+    def __close_logs(self):
+        self.log_writer.close()
+        self.error_writer.close()
+        self.log_writer = self.error_writer = None
+
+    def __save_book(self, url: str, book: Book):
+        '''
+            Saves the book into books, or passes it to the consumer while streaming,
+            waits while the consumer is behind
+        '''
+        compressed_url = utils.compress_book_url(url)
+        metrics.increment("books_extracted_total")
+        if self.book_queue is not None:
+            self.book_queue.put((compressed_url, book))
+        else:
+            self.books_dict[compressed_url] = book
+
+    def __submit_extraction(self, url: str, book_html: str):
+        '''
+            Sends the page to the extraction processes,
+            waits if too many pages are already waiting
+        '''
+        self.extraction_slots.acquire()
+        future = self.extraction_pool.submit(extract_book_page, url, book_html)
+        future.add_done_callback(
+            lambda done_future: self.__save_extracted_book(url, done_future))
+
+    def __save_extracted_book(self, url: str, future: Future):
+        '''
+            Saves the book extracted by an extraction process into books
+        '''
+        self.extraction_slots.release()
+        try:
+            book = future.result()
+        except Exception as e:
+            print(
+                f"Error while extracting book: {url}, {e}", file=self.error_writer)
+            metrics.increment("extraction_errors_total")
+        else:
+            self.__save_book(url, book)
+
+    def __download_worker(self, url_queue: queue.Queue, progress: DownloadProgress, save_into_file=False):
+        '''
+            Downloads books from the queue until it gets None, reusing its connections
+        '''
+        fetcher = PageFetcher(self.rate_limiter)
+        try:
+            while True:
+                item = url_queue.get()
+                if item is None:
+                    return
+                index, url = item
+                self.__try_download_book(
+                    index, url, fetcher, progress, save_into_file)
+        finally:
+            fetcher.close()
+
+    def __crawl_worker(self, frontier: CrawlFrontier, base_url: str, progress: DownloadProgress, save_into_file=False):
+        '''
+            Downloads the urls of the frontier until the crawl is over, and queues the recommendations of their books
+        '''
+        fetcher = PageFetcher(self.rate_limiter)
+        try:
+            while True:
+                item = frontier.take()
+                if item is None:
+                    return
+                order, _, url = item
+                book = None
+                try:
+                    book = self.__try_download_book(
+                        order, url, fetcher, progress, save_into_file)
+                finally:
+                    # Recommendations are compressed urls, they are crawled from base_url
+                    frontier.complete(url, [f"{base_url}{recommendation}"
+                                            for recommendation in book.recommendations] if book else [])
+        finally:
+            fetcher.close()
+
+    def crawl_books(self, books_file="data/books.txt", max_books: int = None, max_depth: int = None, priority: bool = False,
+                    frontier_file: str = CRAWL_FRONTIER_FILE, base_url: str = utils.BOOKS_BASE_URL,
+                    save_into_file=True, checkpoint_interval: float = CRAWL_CHECKPOINT_INTERVAL) -> dict[str, Book]:
+        '''
+            Crawls the recommendation graph from the books of books_file (depth 0), breadth-first
+            or by priority (see CrawlFrontier), until max_books books are downloaded or no book within
+            max_depth recommendations is left. Recommendations are downloaded from base_url.
+            Pages are extracted in the download threads, since their recommendations are needed for the crawl.
+
+            The frontier is saved into frontier_file every checkpoint_interval seconds and at the end.
+            If frontier_file exists, the crawl is resumed from it with the new budgets (max_books also
+            counts the books crawled before), and ValueError is raised if priority is not the order
+            of the crawl. Saved pages are not downloaded again. Books of a resumed crawl that were
+            crawled before are only in the page store, see extract_saved_books.
+
+            Returns the book dictionary of the books crawled in this run
+        '''
+        print("Crawling the books, please wait...")
+        if save_into_file or utils.file_exists(self.page_store_file):
+            self.page_store = PageStore(self.page_store_file)
+
+        if utils.file_exists(frontier_file):
+            frontier: CrawlFrontier = utils.unpickle_object(frontier_file)
+            if frontier.priority != priority:
+                orders = {True: "priority", False: "bfs"}
+                raise ValueError(f"The crawl in '{frontier_file}' is crawled in {orders[frontier.priority]} order, "
+                                 f"not {orders[priority]}. Resume it in that order or remove the file to start a new crawl")
+            print(f"Resuming the crawl in '{frontier_file}', {frontier.taken} books are crawled, "
+                  f"{frontier.get_waiting_count()} are waiting")
+            frontier.max_books, frontier.max_depth = max_books, max_depth
+        else:
+            frontier = CrawlFrontier(max_books, max_depth, priority)
+        # Seeds that were seen before are skipped
+        for _, url in self.__read_book_urls(books_file):
+            if self.url_filter(url):
+                frontier.add(url, 0)
+
+        start_time = time.time()
+        self.__open_logs()
+        progress = DownloadProgress(max_books)
+        stop_reporting = threading.Event()
+        reporter = threading.Thread(target=progress.report_periodically, args=(
+            self.report_interval, stop_reporting), daemon=True)
+        reporter.start()
+        checkpointer = threading.Thread(target=frontier.save_periodically, args=(
+            frontier_file, checkpoint_interval, stop_reporting), daemon=True)
+        checkpointer.start()
+
+        workers = [threading.Thread(target=self.__crawl_worker, args=(
+            frontier, base_url, progress, save_into_file)) for _ in range(max(1, self.concurrency))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        stop_reporting.set()
+        checkpointer.join()
+        frontier.save(frontier_file)
+        if self.page_store:
+            self.page_store.close()
+            self.page_store = None
+        self.__close_logs()
+        progress.report()
+
+        print(f"{frontier.taken} books are crawled, {frontier.get_waiting_count()} are waiting, "
+              f"{frontier.seen.count} urls are seen. It took {time.time() - start_time} seconds, "
+              f"the frontier is saved into '{frontier_file}'")
+        if len(self.failed_downloads) > 0:
+            print(
+                f"{len(self.failed_downloads)} documents could not be downloaded, see {self.errors_file}")
+        return self.books_dict
 
     def download_single_book(self, book_url) -> Book:
         '''
@@ -185,50 +796,184 @@ class BookDownloader():
                     f"Error while extracting book: {book_url}, {e}")
         return book
 
-    def download_books(self, books_file="data/books.txt", save_into_file = False) -> dict[str, Book]:
+    def download_books(self, books_file="data/books.txt", save_into_file=False) -> dict[str, Book]:
         '''
             Downloads books with their url in the books_file, 
             stores them in books dictionary.
+            At most concurrency books are downloaded at the same time.
 
             Returns the book dictionary
         '''
-        print("Downloading the books, please wait...")
+        self.__download_books_file(books_file, save_into_file)
+        return self.books_dict
+
+    def stream_books(self, books_file="data/books.txt", save_into_file=False) -> Iterator[Tuple[str, Book]]:
+        '''
+            Downloads books with their url in the books_file like download_books,
+            but yields (compressed_url, book) pairs as they are extracted instead of storing them.
+            Urls are read lazily and downloads wait while BOOK_QUEUE_SIZE books are not consumed,
+            so memory does not grow with the number of books.
+            The generator has to be consumed to the end, otherwise the downloads stop waiting.
+        '''
+        self.book_queue = queue.Queue(BOOK_QUEUE_SIZE)
+        downloader = threading.Thread(target=self.__stream_books_file, args=(
+            books_file, save_into_file), daemon=True)
+        downloader.start()
+        try:
+            while True:
+                item = self.book_queue.get()
+                if item is None:
+                    break
+                yield item
+        finally:
+            downloader.join()
+            self.book_queue = None
+
+    def __stream_books_file(self, books_file: str, save_into_file: bool):
+        try:
+            self.__download_books_file(books_file, save_into_file)
+        finally:
+            # Tell the consumer that there are no more books
+            self.book_queue.put(None)
+
+    def __read_book_urls(self, books_file: str) -> Iterator[Tuple[int, str]]:
+        '''
+            Yields (index, url) pairs of the lines of books_file without reading it at once
+        '''
+        with open(utils.get_file_path(books_file)) as f:
+            for index, line in enumerate(f):
+                yield (index, line.rstrip("\r\n"))
+
+    def __put_url(self, url_queue: queue.Queue, item: Tuple[int, str], workers: List[threading.Thread]):
+        '''
+            Puts the item into url_queue, waits while it is full
+            Raises RuntimeError if no download thread is left to empty it
+        '''
+        while True:
+            try:
+                url_queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                if not any(worker.is_alive() for worker in workers):
+                    raise RuntimeError("All download threads have stopped")
+
+    def __stop_download_workers(self, url_queue: queue.Queue, workers: List[threading.Thread]):
+        '''
+            Drops the urls that are not taken yet and waits for the download threads
+            to finish their current download
+        '''
+        if not any(worker.is_alive() for worker in workers):
+            return
+        while True:
+            try:
+                url_queue.get_nowait()
+            except queue.Empty:
+                break
+        for _ in workers:
+            url_queue.put(None)
+        for worker in workers:
+            worker.join()
 
-        if save_into_file:
-            # Create books directory
-            utils.create_dir("out/books")
+    def __download_books_file(self, books_file: str, save_into_file: bool):
+        '''
+            Downloads the books of books_file with concurrency threads, 
+            urls are fed into a bounded queue, so only a few of them are in memory
+        '''
+        print("Downloading the books, please wait...")
+        start_time = time.time()
 
-        # Read book urls from data/books.txt and download into books/{id}.html
+        # Count the urls for the progress reports, the file is read again for the downloads
         with open(utils.get_file_path(books_file)) as f:
-            start_time = time.time()
+            books_count = sum(1 for _ in f)
 
-            book_urls = f.read().splitlines()
-            books_count = len(book_urls)
+        self.__open_logs()
+        stop_reporting = threading.Event()
+        url_queue, workers = None, []
+        try:
+            if save_into_file or utils.file_exists(self.page_store_file):
+                # Saved pages are not downloaded again
+                self.page_store = PageStore(self.page_store_file)
 
-            # Create one thread to download a book
-            initial_threads = [threading.Thread(target=self.__download_book, args=(
-                index, url, save_into_file)) for index, url in enumerate(book_urls)]
+            progress = DownloadProgress(books_count)
+            reporter = threading.Thread(target=progress.report_periodically, args=(
+                self.report_interval, stop_reporting), daemon=True)
+            reporter.start()
 
-            # Run threads to download the books
-            utils.run_threads_and_wait(initial_threads)
+            if self.extraction_processes > 0:
+                self.extraction_pool = ProcessPoolExecutor(
+                    self.extraction_processes)
 
-            # As long as there are some books which failed to download, try again to download
-            while len(self.failed_downloads) > 0:
-                failed = len(self.failed_downloads)
-                print(
-                    f"{books_count - failed} completed, {failed} failed, out of {books_count} documents. Waiting 1 minute to try again...")
-                time.sleep(60)
-                print("Downloading the books, please wait...")
-                trial_threads = [threading.Thread(target=self.__download_book, args=(
-                    index, url,)) for index, url in self.failed_downloads]
-                self.failed_downloads.clear()
-                utils.run_threads_and_wait(trial_threads)
-
-            end_time = time.time()
+            # Run a fixed number of threads to download the books
+            thread_count = max(1, min(self.concurrency, books_count))
+            url_queue = queue.Queue(URL_QUEUE_SIZE_PER_THREAD * thread_count)
+            workers = [threading.Thread(target=self.__download_worker, args=(
+                url_queue, progress, save_into_file)) for _ in range(thread_count)]
+            for worker in workers:
+                worker.start()
+            # Read book urls from the books file and download them,
+            # put waits while the threads are busy
+            for index, url in self.__read_book_urls(books_file):
+                self.__put_url(url_queue, (index, url), workers)
+            for _ in workers:
+                self.__put_url(url_queue, None, workers)
+            for worker in workers:
+                worker.join()
+        finally:
+            # Also when the urls could not be read or no download thread is left,
+            # so that the saved pages are flushed and no thread or process keeps running
+            self.__stop_download_workers(url_queue, workers)
+            if self.extraction_pool:
+                # Wait for the pages waiting for extraction
+                self.extraction_pool.shutdown(wait=True)
+                self.extraction_pool = None
+
+            if self.page_store:
+                self.page_store.close()
+                self.page_store = None
+            self.__close_logs()
+
+            stop_reporting.set()
+        progress.report()
+
+        end_time = time.time()
+        print(
+            f"{books_count} documents has been downloaded and extracted in {end_time-start_time} seconds.")
+        if len(self.failed_downloads) > 0:
             print(
-                f"{books_count} documents has been downloaded and extracted in {end_time-start_time} seconds.")
+                f"{len(self.failed_downloads)} documents could not be downloaded, see {self.errors_file}")
+
+    def extract_saved_books(self) -> dict[str, Book]:
+        '''
+            Extracts the books of all saved pages again, e.g. after a fix in BookExtractor,
+            stores them in books dictionary. Nothing is downloaded,
+            the page store is read sequentially.
+
+            Returns the book dictionary
+        '''
+        print(f"Extracting the pages in '{self.page_store_file}'...")
+        start_time = time.time()
+        page_store = PageStore(self.page_store_file)
+        self.__open_logs()
+        if self.extraction_processes > 0:
+            self.extraction_pool = ProcessPoolExecutor(
+                self.extraction_processes)
+
+        page_count = 0
+        for url, book_html in page_store.iterate_pages():
+            page_count += 1
+            if self.extraction_pool:
+                self.__submit_extraction(url, book_html)
+            else:
+                self.__extract_book(url, book_html)
 
-            return self.books_dict
+        if self.extraction_pool:
+            self.extraction_pool.shutdown(wait=True)
+            self.extraction_pool = None
+        page_store.close()
+        self.__close_logs()
+        print(
+            f"{page_count} pages has been extracted in {time.time()-start_time} seconds.")
+        return self.books_dict
 
     def pickle_books(self, file_name: str = "out/books.pickle"):
         '''
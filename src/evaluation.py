@@ -1,3 +1,4 @@
+import math
 from typing import List
 
 
@@ -6,14 +7,50 @@ def evaluate_precision(original_list: List, calculated_list: List):
     relevant_count = 0
     precision = 0
     precision_sum = 0
+    original_set = set(original_list)
     for index, book_url in enumerate(calculated_list):
-        if book_url in original_list:
+        if book_url in original_set:
             relevant_count += 1
         precision = relevant_count / (index + 1)
-        if book_url in original_list:
+        if book_url in original_set:
             precision_sum += precision
 
     if relevant_count > 0:
         average_precision = precision_sum / relevant_count
 
     return (precision, average_precision)
+
+
+def evaluate_recall(original_list: List, calculated_list: List) -> float:
+    '''
+        Returns the fraction of original_list found in calculated_list
+    '''
+    original_set = set(original_list)
+    if len(original_set) == 0:
+        return 0
+    return len(original_set.intersection(calculated_list)) / len(original_set)
+
+
+def evaluate_ndcg(original_list: List, calculated_list: List) -> float:
+    '''
+        Returns the normalized discounted cumulative gain of calculated_list,
+        books of original_list have relevance 1 and other books 0
+    '''
+    original_set = set(original_list)
+    dcg = sum(1 / math.log2(index + 2) for index, book_url in enumerate(calculated_list)
+              if book_url in original_set)
+    ideal_count = min(len(original_set), len(calculated_list))
+    ideal_dcg = sum(1 / math.log2(index + 2) for index in range(ideal_count))
+    if ideal_dcg == 0:
+        return 0
+    return dcg / ideal_dcg
+
+
+def get_percentile(sorted_values: List[float], percentile: float) -> float:
+    '''
+        Returns the percentile of sorted_values with the nearest-rank method
+    '''
+    if len(sorted_values) == 0:
+        return 0
+    rank = math.ceil(percentile / 100 * len(sorted_values))
+    return sorted_values[max(rank, 1) - 1]
@@ -0,0 +1,136 @@
+import numpy as np
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from vectorization import Vector, VectorMatrix
+
+WORD_BITS = 64
+
+# Set bits of every byte value, for numpy versions without bitwise_count
+BYTE_BIT_COUNTS = np.array([bin(value).count("1")
+                           for value in range(256)], dtype=np.uint8)
+
+
+def count_bits(words: np.ndarray) -> np.ndarray:
+    '''
+        Returns the number of set bits of every uint64 word
+    '''
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words)
+    words = np.ascontiguousarray(words, dtype="<u8")
+    return BYTE_BIT_COUNTS[words.view(np.uint8)].reshape(words.shape + (8,)).sum(axis=-1)
+
+
+def get_word_count(bit_count: int) -> int:
+    return max((bit_count + WORD_BITS - 1) // WORD_BITS, 1)
+
+
+class GenreIndex():
+    '''
+        Genres of the books as bits. Genre ids are the ranks of the genre terms (or hashed features)
+        of the books among all of them, so there are bits only for the genres of some book.
+
+        Every book has a packed bitset of its genres (row x genre words) and every genre has
+        a posting bitmap of its books (genre x row words). Genres are a set, a genre weighs
+        its idf squared, so the similarity of two books is the cosine of their idf weighted
+        genre sets: the weighted popcount of the intersection of their bitsets divided by
+        the square roots of their own weighted popcounts. It is the cosine of the genre
+        vectors when no genre of a book is repeated.
+
+        The posting bitmaps find the books sharing at least some number of genres with
+        a query with word-wide AND and OR operations, before anything else is scored.
+    '''
+
+    def __init__(self, genre_vectors: 'VectorMatrix', idf_weights: np.ndarray):
+        self.genre_vectors = genre_vectors
+        self.row_count = len(genre_vectors.book_urls)
+        # Term ids of the genres in genre id order
+        self.genre_terms = np.unique(genre_vectors.indices).astype(np.int64)
+        self.genre_count = len(self.genre_terms)
+        self.genre_weights = np.zeros(self.genre_count, dtype=np.float64)
+        known = self.genre_terms < len(idf_weights)
+        self.genre_weights[known] = np.asarray(
+            idf_weights, dtype=np.float64)[self.genre_terms[known]] ** 2
+
+        rows = genre_vectors.get_row_ids().astype(np.int64)
+        genre_ids = np.searchsorted(self.genre_terms, genre_vectors.indices)
+        self.book_bitsets = np.zeros(
+            (self.row_count, get_word_count(self.genre_count)), dtype=np.uint64)
+        np.bitwise_or.at(self.book_bitsets, (rows, genre_ids // WORD_BITS),
+                         np.left_shift(np.uint64(1), (genre_ids % WORD_BITS).astype(np.uint64)))
+        self.genre_postings = np.zeros(
+            (self.genre_count, get_word_count(self.row_count)), dtype=np.uint64)
+        np.bitwise_or.at(self.genre_postings, (genre_ids, rows // WORD_BITS),
+                         np.left_shift(np.uint64(1), (rows % WORD_BITS).astype(np.uint64)))
+
+        # Square roots of the weighted popcounts of the books
+        self.book_norms = np.sqrt(np.bincount(
+            rows, weights=self.genre_weights[genre_ids], minlength=self.row_count))
+
+    def get_genre_ids(self, genre_vector: 'Vector') -> np.ndarray:
+        '''
+            Returns the sorted genre ids of the query's genre vector, genres of no indexed book are skipped
+        '''
+        terms = np.array(sorted(genre_vector.weight_dict), dtype=np.int64)
+        genre_ids = np.minimum(np.searchsorted(
+            self.genre_terms, terms), max(self.genre_count - 1, 0))
+        if self.genre_count == 0:
+            return genre_ids[:0]
+        return genre_ids[self.genre_terms[genre_ids] == terms]
+
+    def get_bitset(self, genre_ids: np.ndarray) -> np.ndarray:
+        '''
+            Returns the packed bitset of genre_ids
+        '''
+        bitset = np.zeros(get_word_count(self.genre_count), dtype=np.uint64)
+        np.bitwise_or.at(bitset, genre_ids // WORD_BITS,
+                         np.left_shift(np.uint64(1), (genre_ids % WORD_BITS).astype(np.uint64)))
+        return bitset
+
+    def calculate_weighted_overlaps(self, genre_ids: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        '''
+            Returns the idf weighted size of the intersection of genre_ids with the genres of the rows.
+            Genres of the same weight are counted together with a popcount of the words they are in.
+        '''
+        overlaps = np.zeros(len(rows), dtype=np.float64)
+        book_bitsets = self.book_bitsets[rows]
+        genre_ids = genre_ids[self.genre_weights[genre_ids] > 0]
+        group_weights, groups = np.unique(
+            self.genre_weights[genre_ids], return_inverse=True)
+        for group, group_weight in enumerate(group_weights.tolist()):
+            bitset = self.get_bitset(genre_ids[groups == group])
+            for word in np.flatnonzero(bitset).tolist():
+                overlaps += group_weight * \
+                    count_bits(book_bitsets[:, word] & bitset[word])
+        return overlaps
+
+    def calculate_similarities(self, genre_ids: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        '''
+            Returns the genre similarities of the rows with the query genres
+        '''
+        size_products = self.book_norms[rows] * \
+            np.sqrt(self.genre_weights[genre_ids].sum())
+        similarities = np.zeros(len(rows), dtype=np.float64)
+        np.divide(self.calculate_weighted_overlaps(genre_ids, rows), size_products,
+                  out=similarities, where=size_products != 0)
+        return similarities
+
+    def find_candidates(self, genre_ids: np.ndarray, min_overlap: int) -> np.ndarray:
+        '''
+            Returns the rows sharing at least min_overlap genres with genre_ids in increasing order.
+            at_least[j] is the bitmap of the rows found in at least j of the posting bitmaps seen so far.
+        '''
+        if min_overlap <= 0:
+            return np.arange(self.row_count, dtype=np.int64)
+        if min_overlap > len(genre_ids):
+            return np.zeros(0, dtype=np.int64)
+        word_count = self.genre_postings.shape[1]
+        at_least = [np.full(word_count, np.iinfo(np.uint64).max, dtype=np.uint64)] + \
+            [np.zeros(word_count, dtype=np.uint64) for _ in range(min_overlap)]
+        for genre_id in genre_ids.tolist():
+            posting = self.genre_postings[genre_id]
+            for count in range(min_overlap, 0, -1):
+                at_least[count] |= at_least[count - 1] & posting
+        bits = np.unpackbits(at_least[min_overlap].astype(
+            "<u8").view(np.uint8), count=self.row_count, bitorder="little")
+        return np.flatnonzero(bits).astype(np.int64)
@@ -0,0 +1,88 @@
+import hashlib
+import numpy as np
+from collections import Counter
+from typing import Tuple
+
+# Features of the fields are 2 ** bits hash buckets
+DESCRIPTION_HASH_BITS = 18
+GENRE_HASH_BITS = 12
+
+# The highest bit of a term's hash is its sign
+SIGN_BIT = 63
+
+# Features of recently hashed terms, the cache is cleared when it grows larger
+FEATURE_CACHE_SIZE = 2 ** 16
+
+
+def hash_term(term: str) -> int:
+    '''
+        Returns a 64 bit hash of the term, the same in every process and run
+        (hash() of str is randomized per process)
+    '''
+    return int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class FeatureHasher():
+    '''
+        Maps terms into a fixed space of 2 ** hash_bits features with signed hashing:
+        the low bits of a term's hash are its feature, the highest bit is its sign.
+        Terms colliding in a feature add their signed frequencies, so collisions
+        cancel out instead of adding up in the dot products.
+    '''
+
+    def __init__(self, hash_bits: int):
+        self.hash_bits = hash_bits
+        self.feature_count = 1 << hash_bits
+        # term -> (feature, sign), it is not pickled
+        self.feature_cache: dict[str, Tuple[int, int]] = {}
+
+    def __getstate__(self) -> dict:
+        return {"hash_bits": self.hash_bits}
+
+    def __setstate__(self, state: dict):
+        self.__init__(state["hash_bits"])
+
+    def get_feature(self, term: str) -> Tuple[int, int]:
+        '''
+            Returns (feature, sign) of the term
+        '''
+        feature = self.feature_cache.get(term)
+        if feature is None:
+            if len(self.feature_cache) >= FEATURE_CACHE_SIZE:
+                self.feature_cache.clear()
+            term_hash = hash_term(term)
+            feature = (term_hash & (self.feature_count - 1),
+                       -1 if term_hash >> SIGN_BIT else 1)
+            self.feature_cache[term] = feature
+        return feature
+
+    def hash_term_frequencies(self, term_frequencies: Counter) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+            Returns (features, signed frequencies) of the terms in increasing feature order,
+            features whose terms cancel out are dropped
+        '''
+        counts = {}
+        for term, frequency in term_frequencies.items():
+            feature, sign = self.get_feature(term)
+            counts[feature] = counts.get(feature, 0) + sign * frequency
+        features = np.array(sorted(feature for feature, count in counts.items() if count != 0),
+                            dtype=np.int32)
+        return (features, np.array([counts[feature] for feature in features.tolist()], dtype=np.int32))
+
+
+class HashedBookData():
+    '''
+        Document frequencies of a content type in a fixed feature space, there is no vocabulary.
+        Memory is bounded by the number of features, not by the terms of the corpus.
+    '''
+
+    def __init__(self, content_type: str, hash_bits: int, doc_frequencies: np.ndarray = None):
+        self.content_type = content_type
+        self.feature_hasher = FeatureHasher(hash_bits)
+        if doc_frequencies is None:
+            doc_frequencies = np.zeros(
+                self.feature_hasher.feature_count, dtype=np.int64)
+        self.doc_frequencies = doc_frequencies
+
+    def get_vocabulary_size(self) -> int:
+        return self.feature_hasher.feature_count
@@ -0,0 +1,313 @@
+import mmap
+import os
+import struct
+import zlib
+import numpy as np
+from collections.abc import Mapping, Sequence
+from typing import List
+
+INDEX_FILE = "out/index/books.index"
+
+INDEX_MAGIC = b"GRBOOKIX"
+INDEX_VERSION = 1
+
+# magic, version, checksum of everything after the header, section count
+HEADER_FORMAT = "<8sIIQ"
+# Longest utf-8 encoded section name
+SECTION_NAME_SIZE = 32
+# name, numpy dtype, offset from the beginning of the file, element count
+SECTION_FORMAT = f"<{SECTION_NAME_SIZE}s8sQQ"
+
+# Sections start at multiples of this, so that arrays are aligned in memory
+SECTION_ALIGNMENT = 64
+
+# Bytes of an ArrayFile copied into the index file at once
+ARRAY_FILE_CHUNK_SIZE = 1 << 24
+
+
+class ArrayFile():
+    '''
+        Array in a raw binary file, appended and read in chunks, so that it is never in memory at once.
+        It can be added to an IndexWriter like an array, it is copied into the index file in chunks.
+    '''
+
+    def __init__(self, location: str, dtype):
+        self.location = location
+        self.dtype = np.dtype(dtype)
+        self.count = 0
+        self.file = open(location, "wb")
+
+    def append(self, array: np.ndarray):
+        array = np.ascontiguousarray(array, dtype=self.dtype)
+        self.file.write(array.tobytes())
+        self.count += len(array)
+
+    def close(self):
+        self.file.close()
+
+    def remove(self):
+        self.close()
+        os.remove(self.location)
+
+    def read(self, start: int, count: int) -> np.ndarray:
+        '''
+            Returns count elements from start, fewer at the end of the array
+        '''
+        if not self.file.closed:
+            self.file.flush()
+        count = max(0, min(count, self.count - start))
+        return np.fromfile(self.location, dtype=self.dtype, count=count, offset=start * self.dtype.itemsize)
+
+    def iterate_bytes(self, chunk_size: int = ARRAY_FILE_CHUNK_SIZE):
+        chunk_count = max(1, chunk_size // self.dtype.itemsize)
+        for start in range(0, self.count, chunk_count):
+            yield self.read(start, chunk_count).tobytes()
+
+    @property
+    def nbytes(self) -> int:
+        return self.count * self.dtype.itemsize
+
+    def __len__(self) -> int:
+        return self.count
+
+
+class IndexWriter():
+    '''
+        Collects named arrays (or ArrayFiles) and writes them into a versioned binary index file:
+
+            header | section table | aligned section data ...
+
+        The header holds the magic bytes, the format version, a crc32 checksum of
+        everything after the header and the number of sections.
+    '''
+
+    def __init__(self):
+        self.sections: dict[str, np.ndarray] = {}
+
+    def add_array(self, name: str, array: np.ndarray):
+        # struct.pack would cut longer names, and two of them could end up with the same name
+        if len(name.encode("utf-8")) > SECTION_NAME_SIZE:
+            raise ValueError(
+                f"Section name {name} is longer than {SECTION_NAME_SIZE} bytes")
+        self.sections[name] = array if isinstance(
+            array, ArrayFile) else np.ascontiguousarray(array)
+
+    def add_strings(self, name: str, strings: List[str]):
+        '''
+            Stores strings as one utf-8 blob and the offsets of each string in it
+        '''
+        encoded = [string.encode("utf-8") for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(string) for string in encoded], out=offsets[1:])
+        self.add_array(f"{name}.blob", np.frombuffer(
+            b"".join(encoded), dtype=np.uint8))
+        self.add_array(f"{name}.offsets", offsets)
+
+    def add_term_dictionary(self, name: str, terms: List[str]):
+        '''
+            Stores terms in their id order, along with the ids sorted by term,
+            so that a term can be found with binary search without loading all terms
+        '''
+        self.add_strings(name, terms)
+        sorted_ids = sorted(range(len(terms)),
+                            key=lambda term_id: terms[term_id].encode("utf-8"))
+        self.add_array(f"{name}.sorted_ids",
+                       np.array(sorted_ids, dtype=np.int32))
+
+    def write(self, location: str):
+        table_size = struct.calcsize(SECTION_FORMAT) * len(self.sections)
+        offset = align(struct.calcsize(HEADER_FORMAT) + table_size)
+
+        table = b""
+        for name, array in self.sections.items():
+            table += struct.pack(SECTION_FORMAT, name.encode("utf-8"),
+                                 array.dtype.str.encode("ascii"), offset, len(array))
+            offset = align(offset + array.nbytes)
+
+        # Write sections after the header and the table, then write the header with the checksum
+        with open(location, "wb") as file:
+            file.write(b"\0" * struct.calcsize(HEADER_FORMAT))
+            file.write(table)
+            checksum = zlib.crc32(table)
+            for array in self.sections.values():
+                checksum = write_padding(file, checksum)
+                chunks = array.iterate_bytes() if isinstance(
+                    array, ArrayFile) else [array.tobytes()]
+                for data in chunks:
+                    file.write(data)
+                    checksum = zlib.crc32(data, checksum)
+            checksum = write_padding(file, checksum)
+
+            file.seek(0)
+            file.write(struct.pack(HEADER_FORMAT, INDEX_MAGIC,
+                                   INDEX_VERSION, checksum, len(self.sections)))
+
+
+class IndexReader():
+    '''
+        Opens an index file written by IndexWriter with mmap.
+        Arrays are read-only views of the mapped file, nothing is copied,
+        and processes opening the same file share its pages.
+    '''
+
+    def __init__(self, location: str, verify: bool = False):
+        self.location = location
+        with open(location, "rb") as file:
+            self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header_size = struct.calcsize(HEADER_FORMAT)
+        magic, version, self.checksum, section_count = struct.unpack_from(
+            HEADER_FORMAT, self.mmap, 0)
+        if magic != INDEX_MAGIC:
+            raise ValueError(f"{location} is not a book index file")
+        if version != INDEX_VERSION:
+            raise ValueError(
+                f"{location} has index version {version}, expected {INDEX_VERSION}")
+
+        self.sections: dict[str, np.ndarray] = {}
+        section_size = struct.calcsize(SECTION_FORMAT)
+        for index in range(section_count):
+            name, dtype, offset, count = struct.unpack_from(
+                SECTION_FORMAT, self.mmap, header_size + index * section_size)
+            dtype = np.dtype(dtype.rstrip(b"\0").decode("ascii"))
+            if count == 0:
+                array = np.zeros(0, dtype=dtype)
+            else:
+                array = np.frombuffer(
+                    self.mmap, dtype=dtype, count=count, offset=offset)
+            self.sections[name.rstrip(b"\0").decode("utf-8")] = array
+
+        if verify:
+            self.verify()
+
+    def verify(self):
+        '''
+            Raises ValueError if the checksum of the file does not match its header
+            This reads the whole file
+        '''
+        checksum = zlib.crc32(memoryview(self.mmap)[
+                              struct.calcsize(HEADER_FORMAT):])
+        if checksum != self.checksum:
+            raise ValueError(f"{self.location} is corrupted, checksum mismatch")
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.sections
+
+    def get_array(self, name: str) -> np.ndarray:
+        return self.sections[name]
+
+    def get_strings(self, name: str) -> List[str]:
+        blob = self.get_array(f"{name}.blob").tobytes().decode("utf-8")
+        offsets = self.get_array(f"{name}.offsets")
+        if len(blob) == offsets[-1]:
+            # Only ascii characters, character offsets are the same as byte offsets
+            offsets = offsets.tolist()
+            return [blob[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+        return list(StringTable(self.get_array(f"{name}.blob"), offsets))
+
+    def get_term_dictionary(self, name: str) -> 'TermDictionary':
+        return TermDictionary(self.get_array(f"{name}.blob"), self.get_array(f"{name}.offsets"), self.get_array(f"{name}.sorted_ids"))
+
+
+class StringTable(Sequence):
+    '''
+        Decodes strings of a blob on access
+    '''
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray):
+        self.blob = blob
+        self.offsets = offsets
+
+    def get_bytes(self, index: int) -> bytes:
+        return self.blob[self.offsets[index]:self.offsets[index + 1]].tobytes()
+
+    def __getitem__(self, index: int) -> str:
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError(index)
+        return self.get_bytes(index).decode("utf-8")
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+
+class TermDictionary(StringTable):
+    '''
+        Terms in their id order, terms are found with binary search over sorted ids
+    '''
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray, sorted_ids: np.ndarray):
+        super().__init__(blob, offsets)
+        self.sorted_ids = sorted_ids
+
+    def get(self, term: str, default=None):
+        '''
+            Returns the id of the term
+        '''
+        encoded = term.encode("utf-8")
+        low, high = 0, len(self.sorted_ids)
+        while low < high:
+            middle = (low + high) // 2
+            if self.get_bytes(self.sorted_ids[middle]) < encoded:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.sorted_ids) and self.get_bytes(self.sorted_ids[low]) == encoded:
+            return int(self.sorted_ids[low])
+        return default
+
+    def __contains__(self, term) -> bool:
+        return isinstance(term, str) and self.get(term) is not None
+
+
+class DocFrequencies(Mapping):
+    '''
+        Maps terms of the dictionary to their document frequencies
+    '''
+
+    def __init__(self, term_dictionary: TermDictionary, doc_frequencies: np.ndarray):
+        self.term_dictionary = term_dictionary
+        self.doc_frequencies = doc_frequencies
+
+    def __getitem__(self, term: str) -> int:
+        term_id = self.term_dictionary.get(term)
+        if term_id is None:
+            raise KeyError(term)
+        return int(self.doc_frequencies[term_id])
+
+    def __contains__(self, term) -> bool:
+        # Terms of removed books stay in the dictionary with 0 frequency
+        term_id = self.term_dictionary.get(term)
+        return term_id is not None and self.doc_frequencies[term_id] > 0
+
+    def __iter__(self):
+        return iter(self.term_dictionary)
+
+    def __len__(self) -> int:
+        return len(self.term_dictionary)
+
+
+class IndexedBookData():
+    '''
+        Read-only BookData of a field, loaded from an index file
+        It has the vocabulary and the document frequencies needed to vectorize queries
+    '''
+
+    def __init__(self, content_type: str, vocabulary: TermDictionary, doc_frequencies: np.ndarray):
+        self.content_type = content_type
+        self.vocabulary = vocabulary
+        self.doc_frequency = DocFrequencies(vocabulary, doc_frequencies)
+
+
+def align(offset: int) -> int:
+    return (offset + SECTION_ALIGNMENT - 1) // SECTION_ALIGNMENT * SECTION_ALIGNMENT
+
+
+def write_padding(file, checksum: int) -> int:
+    '''
+        Pads the file up to the next section boundary, returns the updated checksum
+    '''
+    padding = b"\0" * (align(file.tell()) - file.tell())
+    file.write(padding)
+    return zlib.crc32(padding, checksum)
@@ -0,0 +1,175 @@
+import math
+import numpy as np
+from retrieval import select_top_k
+from typing import List, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from vectorization import Vector, VectorMatrix
+
+# Dimensions of the dense space
+LSA_RANK = 200
+
+# Extra random directions and power iterations make the randomized SVD more accurate
+LSA_OVERSAMPLES = 10
+LSA_POWER_ITERATIONS = 2
+
+LSA_SEED = 0
+
+# Rows multiplied together in the sparse-dense products
+PRODUCT_BLOCK_SIZE = 1024
+
+
+def multiply_dense(matrix: 'VectorMatrix', dense: np.ndarray) -> np.ndarray:
+    '''
+        Returns matrix @ dense, a row count x dense.shape[1] array
+        Rows are multiplied in blocks, so that the products of a block fit in memory
+    '''
+    row_count = len(matrix.book_urls)
+    result = np.zeros((row_count, dense.shape[1]), dtype=np.float32)
+    for start in range(0, row_count, PRODUCT_BLOCK_SIZE):
+        end = min(start + PRODUCT_BLOCK_SIZE, row_count)
+        first, last = matrix.indptr[start], matrix.indptr[end]
+        if first == last:
+            continue
+        products = matrix.data[first:last, None] * \
+            dense[matrix.indices[first:last]]
+        # Sum the products of each non-empty row
+        non_empty = np.flatnonzero(np.diff(matrix.indptr[start:end + 1]) > 0)
+        result[start + non_empty] = np.add.reduceat(
+            products, matrix.indptr[start:end][non_empty] - first, axis=0)
+    return result
+
+
+def multiply_transposed_dense(matrix: 'VectorMatrix', dense: np.ndarray) -> np.ndarray:
+    '''
+        Returns matrix.T @ dense, a vocabulary size x dense.shape[1] array
+    '''
+    result = np.zeros((matrix.vocabulary_size, dense.shape[1]), dtype=np.float32)
+    row_count = len(matrix.book_urls)
+    for start in range(0, row_count, PRODUCT_BLOCK_SIZE):
+        end = min(start + PRODUCT_BLOCK_SIZE, row_count)
+        first, last = matrix.indptr[start], matrix.indptr[end]
+        if first == last:
+            continue
+        entry_rows = np.repeat(np.arange(start, end),
+                               np.diff(matrix.indptr[start:end + 1]))
+        products = matrix.data[first:last, None] * dense[entry_rows]
+        # Sum the products of each column of the block
+        indices = matrix.indices[first:last]
+        order = np.argsort(indices, kind="stable")
+        columns, column_starts = np.unique(indices[order], return_index=True)
+        result[columns] += np.add.reduceat(products[order],
+                                           column_starts, axis=0)
+    return result
+
+
+def orthonormalize(matrix: np.ndarray) -> np.ndarray:
+    return np.linalg.qr(matrix)[0].astype(np.float32)
+
+
+class LSAModel():
+    '''
+        Dense embeddings of the books in a rank dimensional space (latent semantic analysis).
+
+        Description and genre vectors of a book are normalized, scaled by the square roots of
+        their weights and concatenated, so that their dot product is the combined similarity.
+        components are the top right singular vectors of the matrix of these concatenated rows,
+        and the embedding of a book is its row projected on them. A query is folded in
+        with the same projection, and all books are scored with one matrix-vector product.
+    '''
+
+    def __init__(self, description_vectors: 'VectorMatrix', genre_vectors: 'VectorMatrix', components: np.ndarray, embeddings: np.ndarray,
+                 description_weight: float, genre_weight: float):
+        self.description_vectors = description_vectors
+        self.genre_vectors = genre_vectors
+        self.components = components
+        self.embeddings = embeddings
+        self.description_weight = description_weight
+        self.genre_weight = genre_weight
+
+    def get_rank(self) -> int:
+        return self.components.shape[1]
+
+    def fold_in(self, description_vector: 'Vector', genre_vector: 'Vector') -> np.ndarray:
+        '''
+            Returns the embedding of a query
+        '''
+        embedding = np.zeros(self.get_rank(), dtype=np.float64)
+        fields = [(description_vector, 0, self.description_weight),
+                  (genre_vector, self.description_vectors.vocabulary_size, self.genre_weight)]
+        for vector, offset, field_weight in fields:
+            size = vector.get_size()
+            if size == 0:
+                continue
+            indices = np.fromiter(vector.weight_dict.keys(),
+                                  dtype=np.int64, count=len(vector.weight_dict))
+            weights = np.fromiter(vector.weight_dict.values(),
+                                  dtype=np.float64, count=len(vector.weight_dict))
+            embedding += math.sqrt(field_weight) / size * \
+                (weights @ self.components[offset + indices])
+        return embedding.astype(np.float32)
+
+    def retrieve(self, description_vector: 'Vector', genre_vector: 'Vector', k: int, excluded_rows=()) -> List[Tuple[float, str]]:
+        '''
+            Returns the k best (similarity, book_url) pairs in the dense space in descending order
+        '''
+        scores = self.embeddings @ self.fold_in(description_vector, genre_vector)
+        return select_top_k(scores, self.description_vectors.book_urls, k, excluded_rows)
+
+
+def fit_lsa_model(description_vectors: 'VectorMatrix', genre_vectors: 'VectorMatrix', description_weight: float, genre_weight: float,
+                  rank: int = LSA_RANK, oversamples: int = LSA_OVERSAMPLES, power_iterations: int = LSA_POWER_ITERATIONS,
+                  seed: int = LSA_SEED) -> LSAModel:
+    '''
+        Fits an LSAModel with a randomized truncated SVD (Halko, Martinsson and Tropp):
+        the range of the matrix is sampled with random directions, refined with power iterations,
+        and the small projected matrix is decomposed exactly.
+        Only products of the sparse matrix with dense blocks are calculated.
+    '''
+    # Rows of both fields are normalized and scaled by the square roots of their weights
+    fields = []
+    for matrix, field_weight in [(description_vectors, description_weight), (genre_vectors, genre_weight)]:
+        row_scales = np.zeros(len(matrix.book_urls), dtype=np.float32)
+        np.divide(math.sqrt(field_weight), matrix.norms, out=row_scales,
+                  where=matrix.norms != 0)
+        fields.append((matrix, row_scales))
+    vocabulary_size = description_vectors.vocabulary_size + \
+        genre_vectors.vocabulary_size
+
+    def multiply(dense: np.ndarray) -> np.ndarray:
+        # (concatenated rows) @ dense
+        result = np.zeros(
+            (len(description_vectors.book_urls), dense.shape[1]), dtype=np.float32)
+        offset = 0
+        for matrix, row_scales in fields:
+            result += row_scales[:, None] * multiply_dense(
+                matrix, dense[offset:offset + matrix.vocabulary_size])
+            offset += matrix.vocabulary_size
+        return result
+
+    def multiply_transposed(dense: np.ndarray) -> np.ndarray:
+        # (concatenated rows).T @ dense
+        return np.concatenate([multiply_transposed_dense(matrix, row_scales[:, None] * dense)
+                               for matrix, row_scales in fields])
+
+    rank = min(rank, vocabulary_size, len(description_vectors.book_urls))
+    sample_count = min(rank + oversamples, vocabulary_size,
+                       len(description_vectors.book_urls))
+    random_generator = np.random.default_rng(seed)
+    random_directions = random_generator.standard_normal(
+        (vocabulary_size, sample_count), dtype=np.float32)
+
+    basis = orthonormalize(multiply(random_directions))
+    for _ in range(power_iterations):
+        basis = orthonormalize(
+            multiply(orthonormalize(multiply_transposed(basis))))
+
+    # The projected matrix is basis.T @ rows, decomposed through its transpose
+    left_vectors, singular_values, right_vectors = np.linalg.svd(
+        multiply_transposed(basis), full_matrices=False)
+    components = np.ascontiguousarray(left_vectors[:, :rank], dtype=np.float32)
+    # Embeddings are the rows projected on the components
+    embeddings = np.ascontiguousarray(
+        basis @ (right_vectors[:rank].T * singular_values[:rank]), dtype=np.float32)
+    return LSAModel(description_vectors, genre_vectors, components, embeddings,
+                    description_weight, genre_weight)
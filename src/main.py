@@ -1,75 +1,311 @@
+import os
+import re
 import sys
 import utils
 from download import BookDownloader
-from vectorization import BookVectorizer
-import evaluation
+from vectorization import BookVectorizer, get_index_quantization, SEGMENTS_PICKLE
+from hashing import DESCRIPTION_HASH_BITS, GENRE_HASH_BITS
+from index import IndexReader, INDEX_FILE
+from recommender import Recommender, BOOKS_PICKLE
+from pagestore import write_book_store
+from lsa import LSA_RANK
+from neighbors import NeighborTableBuilder, NEIGHBOR_COUNT
+from corpus_evaluation import CorpusEvaluator, print_report
+from pipeline import StreamingIndexer, SHARD_SIZE
+from metrics import metrics, run_profiled
+from sharding import run_shard_worker, SHARD_PORT
+import server
 
-utils.create_dir("out/pickle")
+# Commands of run_command, besides books files and book urls
+COMMANDS = ("serve", "shard-worker", "stream", "extract", "crawl", "hash", "add", "remove", "verify",
+            "neighbors", "lsa", "quantize", "evaluate")
 
-BOOKS_PICKLE = "out/pickle/books.pickle"
+utils.create_dir("out/pickle")
 
 
 def vectorize_books(books_file: str):
-    # Download and pickle the books
+    # Download and pickle the books, pages are saved for extract_saved_books
+    book_downloader = BookDownloader()
+    books_dict = book_downloader.download_books(
+        books_file, save_into_file=True)
+    save_books(books_dict)
+    index_books_dict(books_dict)
+
+
+def extract_saved_books():
+    # Extract the saved pages again and rebuild the index, nothing is downloaded
+    book_downloader = BookDownloader(extraction_processes=os.cpu_count() or 1)
+    books_dict = book_downloader.extract_saved_books()
+    save_books(books_dict)
+    index_books_dict(books_dict)
+
+
+def crawl_books(books_file: str, max_books: int = None, max_depth: int = None, priority: bool = False):
+    # Crawl the recommendations of the books, then extract all saved pages, also of earlier runs, and rebuild the index
     book_downloader = BookDownloader()
-    books_dict = book_downloader.download_books(books_file)
-    book_downloader.pickle_books(file_name=BOOKS_PICKLE)
+    book_downloader.crawl_books(
+        books_file, max_books=max_books, max_depth=max_depth, priority=priority)
+    extract_saved_books()
 
+
+def save_books(books_dict: dict):
+    # Pickle the books and write them into the book store, queries read single books from it
+    utils.pickle_object(books_dict, BOOKS_PICKLE)
+    write_book_store(books_dict.items())
+
+
+def index_books_dict(books_dict: dict):
     # Calculate and pickle vectors of all books
     book_vectorizer = BookVectorizer()
-    book_vectorizer.vectorize_book_dict(books_dict)
-    book_vectorizer.pickle_vectors()
+    book_vectorizer.vectorize_book_dict(
+        books_dict, processes=os.cpu_count() or 1)
+    book_vectorizer.create_segments()
+    book_vectorizer.pickle_segments()
+    book_vectorizer.write_index()
 
 
-def get_recommendations_of_book(book_url: str):
-    compressed_url = utils.compress_book_url(arg)
-    print(f"Calculating recommendations for {compressed_url}...")
+def hash_books(description_bits: int = DESCRIPTION_HASH_BITS, genre_bits: int = GENRE_HASH_BITS):
+    # Rebuild the index of the pickled books with hashed features instead of a vocabulary
+    if not has_saved_books((BOOKS_PICKLE,)):
+        return
+    books_dict = utils.unpickle_object(BOOKS_PICKLE)
+    book_vectorizer = BookVectorizer()
+    book_vectorizer.hash_book_dict(books_dict, processes=os.cpu_count() or 1,
+                                   description_bits=description_bits, genre_bits=genre_bits)
+    book_vectorizer.pickle_segments()
+    book_vectorizer.write_index()
 
-    # Download book
+
+def stream_books(books_file: str, shard_size: int = SHARD_SIZE):
+    # Download and index the books shard by shard, books are written into the book store
+    streaming_indexer = StreamingIndexer(
+        shard_size=shard_size, processes=os.cpu_count() or 1)
+    streaming_indexer.index_books(books_file)
+    # books_dict and the segments of an earlier index do not match the new index, add and remove would mix them up
+    for location in (BOOKS_PICKLE, SEGMENTS_PICKLE):
+        if utils.file_exists(location):
+            os.remove(utils.get_file_path(location))
+
+
+def has_saved_books(locations: tuple = (BOOKS_PICKLE, SEGMENTS_PICKLE)) -> bool:
+    # Indexes built by the stream command have no books_dict and no segments to update
+    for location in locations:
+        if not utils.file_exists(location):
+            print(f"'{location}' does not exist, build the index with 'main.py path-to-books-txt' or 'main.py extract' first")
+            return False
+    return True
+
+
+def add_books(books_file: str):
+    if not has_saved_books():
+        return
+
+    # Download new or changed books
     book_downloader = BookDownloader()
-    book = book_downloader.download_single_book(book_url)
+    new_books_dict = book_downloader.download_books(books_file)
 
-    # Preprocess description and genres
-    book_vectorizer = BookVectorizer(books_dict_file=BOOKS_PICKLE)
-    similarities = book_vectorizer.calculate_similarities(book)
+    books_dict = utils.unpickle_object(BOOKS_PICKLE)
+    books_dict.update(new_books_dict)
+    save_books(books_dict)
 
-    # Get calculated_recommendations
-    ranked_similarities = sorted(similarities, reverse=True)
-    calculated_recommendations = [url for rank, url in ranked_similarities if url != compressed_url][:18]
+    # Append them to the index as a new segment
+    book_vectorizer = BookVectorizer()
+    book_vectorizer.load_segments()
+    book_vectorizer.add_books(new_books_dict)
+    book_vectorizer.pickle_segments()
+    book_vectorizer.write_index(quantization=get_index_quantization())
+
+
+def remove_books(books_file: str):
+    if not has_saved_books():
+        return
 
-    # Get goodread's recommendations
-    goodreads_recommendations = book.recommendations[:18]
+    with open(utils.get_file_path(books_file)) as f:
+        book_urls = [utils.compress_book_url(url)
+                     for url in f.read().splitlines() if utils.is_book_url(url)]
+
+    books_dict = utils.unpickle_object(BOOKS_PICKLE)
+    for book_url in book_urls:
+        books_dict.pop(book_url, None)
+    save_books(books_dict)
+
+    # Tombstone them in the index
+    book_vectorizer = BookVectorizer()
+    book_vectorizer.load_segments()
+    book_vectorizer.remove_books(book_urls)
+    book_vectorizer.pickle_segments()
+    book_vectorizer.write_index(quantization=get_index_quantization())
+
+
+def build_lsa_model(rank: int = LSA_RANK):
+    # Fit dense embeddings to the indexed vectors and write them into the index
+    book_vectorizer = BookVectorizer(index_file=INDEX_FILE)
+    book_vectorizer.build_lsa_model(rank)
+    book_vectorizer.write_index()
+
+
+def quantize_index(quantization: str):
+    # Rewrite the index with quantized column-wise weights, the float32 rows are kept for reranking
+    book_vectorizer = BookVectorizer(index_file=INDEX_FILE)
+    book_vectorizer.write_index(quantization=quantization)
+
+
+def verify_index(location: str = INDEX_FILE):
+    # Compare the checksum of the whole index file with its header
+    try:
+        IndexReader(utils.get_file_path(location), verify=True)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    print(f"Index file {location} is intact")
+
+
+def build_neighbor_table(k: int = NEIGHBOR_COUNT):
+    # Calculate top-k neighbors of every indexed book
+    neighbor_table_builder = NeighborTableBuilder(
+        k=k, processes=os.cpu_count() or 1)
+    neighbor_table_builder.build()
+
+
+def evaluate_corpus(engine: str = 'exhaustive', sample_size: int = None):
+    # Query the books against the index and compare with goodreads recommendations
+    corpus_evaluator = CorpusEvaluator(processes=os.cpu_count() or 1)
+    print_report(corpus_evaluator.evaluate(
+        engine=engine, sample_size=sample_size))
+
+
+def print_recommendations(result: dict):
+    if "error" in result:
+        print(result["error"])
+        return
 
     print("---------------------------")
     print("Goodread's recommendations:")
     print("---------------------------")
-    for book_url in goodreads_recommendations:
+    for book_url in result["goodreads_recommendations"]:
         print(utils.decompress_book_url(book_url))
 
     print("---------------------------")
     print("Calculated recommendations:")
     print("---------------------------")
-    for book_url in calculated_recommendations:
+    for book_url in result["calculated_recommendations"]:
         print(utils.decompress_book_url(book_url))
 
-    precision, average_precision = evaluation.evaluate_precision(
-        goodreads_recommendations, calculated_recommendations)
-
     print("---------------------------")
-    print("Precision:", precision)
-    print("Average precision:", average_precision)
+    print("Precision:", result["precision"])
+    print("Average precision:", result["average_precision"])
+    print("Latency:", result["latency"], "seconds")
     print("---------------------------")
 
 
+def get_recommendations_of_book(book_url: str):
+    compressed_url = utils.compress_book_url(book_url)
+    print(f"Calculating recommendations for {compressed_url}...")
+
+    if server.is_server_running():
+        # Let the running server answer the query
+        result = server.request_recommendations(book_url)
+    else:
+        recommender = Recommender(books_dict_file=BOOKS_PICKLE)
+        result = recommender.get_recommendations(book_url)
+
+    print_recommendations(result)
+
+
+def run_command(arguments: list):
+    arg = arguments[0]
+    if arg == "serve":
+        port = int(arguments[1]) if len(arguments) > 1 else server.SERVER_PORT
+        shards = int(arguments[2]) if len(arguments) > 2 else 0
+        server.run_server(port=port, shards=shards)
+    elif arg == "shard-worker":
+        port = int(arguments[1]) if len(arguments) > 1 else SHARD_PORT
+        run_shard_worker(INDEX_FILE, host="0.0.0.0", port=port)
+    elif arg == "stream" and len(arguments) > 1:
+        shard_size = int(arguments[2]) if len(arguments) > 2 else SHARD_SIZE
+        stream_books(arguments[1], shard_size)
+    elif arg == "extract":
+        extract_saved_books()
+    elif arg == "crawl" and len(arguments) > 1:
+        max_books = int(arguments[2]) if len(arguments) > 2 else None
+        max_depth = int(arguments[3]) if len(arguments) > 3 else None
+        priority = len(arguments) > 4 and arguments[4] == "priority"
+        crawl_books(arguments[1], max_books, max_depth, priority)
+    elif arg == "hash":
+        description_bits = int(arguments[1]) if len(
+            arguments) > 1 else DESCRIPTION_HASH_BITS
+        genre_bits = int(arguments[2]) if len(
+            arguments) > 2 else GENRE_HASH_BITS
+        hash_books(description_bits, genre_bits)
+    elif arg == "add" and len(arguments) > 1:
+        add_books(arguments[1])
+    elif arg == "remove" and len(arguments) > 1:
+        remove_books(arguments[1])
+    elif arg == "verify":
+        verify_index(arguments[1] if len(arguments) > 1 else INDEX_FILE)
+    elif arg == "neighbors":
+        k = int(arguments[1]) if len(arguments) > 1 else NEIGHBOR_COUNT
+        build_neighbor_table(k)
+    elif arg == "lsa":
+        rank = int(arguments[1]) if len(arguments) > 1 else LSA_RANK
+        build_lsa_model(rank)
+    elif arg == "quantize" and len(arguments) > 1:
+        quantize_index(arguments[1])
+    elif arg == "evaluate":
+        engine = arguments[1] if len(arguments) > 1 else 'exhaustive'
+        sample_size = int(arguments[2]) if len(arguments) > 2 else None
+        evaluate_corpus(engine, sample_size)
+    elif utils.is_book_url(arg):
+        get_recommendations_of_book(arg)
+    else:
+        vectorize_books(arg)
+
+
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
+    arguments = sys.argv[1:]
+    # Options can be given after any command
+    profile = "--profile" in arguments
+    if profile:
+        arguments.remove("--profile")
+    metrics_file = None
+    if "--metrics" in arguments:
+        position = arguments.index("--metrics")
+        metrics_file = arguments[position + 1] if position + 1 < len(
+            arguments) else None
+        # The command or another option is not taken as the file
+        if metrics_file is None or metrics_file.startswith("--") or metrics_file in COMMANDS or \
+                utils.is_book_url(metrics_file):
+            print("--metrics needs a file, e.g. main.py evaluate --metrics out/metrics.json")
+            sys.exit(1)
+        del arguments[position:position + 2]
+
+    if len(arguments) < 1:
         print("No arugments provided.")
         print("These are the valid options:")
         print("main.py path-to-books-txt-file   ----> Downloads books in the books.txt file and creates tf-idf vectors")
         print("main.py url-of-the-book-to-query ----> Calculates 18 recommendations for given book")
+        print("main.py serve [port] [shards]    ----> Loads vectors once and serves recommendations over HTTP, optionally with shard worker processes")
+        print("main.py shard-worker [port]      ----> Serves a shard of the index to a coordinator on another node")
+        print("main.py stream path-to-books-txt [shard-size] ----> Like path-to-books-txt-file, with memory bounded by the shard size")
+        print("main.py crawl path-to-books-txt [max-books] [max-depth] [bfs|priority] ----> Crawls the recommendations of the books breadth-first or by priority, resumes a stopped crawl")
+        print("main.py extract                  ----> Extracts the saved pages again and rebuilds the index")
+        print("main.py hash [description-bits] [genre-bits] ----> Rebuilds the index of the pickled books with hashed features instead of a vocabulary")
+        print("main.py add path-to-books-txt    ----> Downloads new or changed books and adds them to the index")
+        print("main.py remove path-to-books-txt ----> Removes books from the index")
+        print("main.py verify [index-file]      ----> Checks the checksum of the index file")
+        print("main.py neighbors [k]            ----> Calculates top-k neighbors of every book into a neighbor table")
+        print("main.py lsa [rank]               ----> Fits dense embeddings of the books for engine=lsa into the index")
+        print("main.py quantize float16|int8|float32 ----> Stores the column-wise weights of the index as float16 or int8, float32 undoes it")
+        print("main.py evaluate [engine] [n]    ----> Evaluates all books or a sample of n books against their goodreads recommendations")
+        print("Options:")
+        print("--profile                        ----> Runs the command with cProfile and tracemalloc and writes a report into out/profile")
+        print("--metrics file                   ----> Writes stage timings and counters into the file, as JSON or as Prometheus text if it ends with .prom")
     else:
-        arg = sys.argv[1]
-        if utils.is_book_url(arg):
-            get_recommendations_of_book(arg)
+        if profile:
+            # Name the report after the command, e.g. evaluate or data_books_txt
+            name = re.sub(r"[^a-z0-9]+", "_", arguments[0].lower()).strip("_")[-40:]
+            run_profiled(run_command, arguments, name=name)
         else:
-            vectorize_books(arg)
+            run_command(arguments)
+        if metrics_file:
+            metrics.write(metrics_file)
@@ -0,0 +1,248 @@
+import bisect
+import cProfile
+import io
+import json
+import os
+import pstats
+import queue
+import threading
+import time
+import tracemalloc
+import utils
+from contextlib import contextmanager
+
+METRICS_FILE = "out/metrics.json"
+PROFILE_DIR = "out/profile"
+
+# Upper bounds of the histogram buckets in seconds, from 100 microseconds to a minute
+DURATION_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                    0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60)
+
+# Lines waiting for the log writer thread, lines written while it is full are dropped
+LOG_QUEUE_SIZE = 65536
+
+# Functions and allocation sites listed in a profile report
+PROFILE_TOP_COUNT = 40
+
+
+class Histogram():
+    '''
+        Counts observations in fixed buckets, and keeps their count and sum
+    '''
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = tuple(buckets)
+        # The last count is of the observations above the last bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def get_percentile(self, percentile: float) -> float:
+        '''
+            Returns the upper bound of the bucket of the percentile,
+            the last bucket if it is above all buckets, 0 if there are no observations
+        '''
+        if self.count == 0:
+            return 0
+        rank = percentile / 100 * self.count
+        cumulative = 0
+        for upper_bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return upper_bound
+        return self.buckets[-1]
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": {str(upper_bound): count for upper_bound, count in zip(self.buckets, self.counts)},
+            "p50": self.get_percentile(50),
+            "p95": self.get_percentile(95),
+            "p99": self.get_percentile(99)
+        }
+
+
+class Metrics():
+    '''
+        Counters and duration histograms of the pipeline stages, shared by all threads of a process.
+        Stages running in pool processes are counted in their own process, not in this one.
+    '''
+
+    def __init__(self):
+        self.counters: dict[str, float] = {}
+        self.histograms: dict[str, Histogram] = {}
+        self.lock = threading.Lock()
+
+    def increment(self, name: str, value: float = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def get_histogram(self, name: str) -> Histogram:
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(name, Histogram())
+        return histogram
+
+    def observe(self, name: str, seconds: float):
+        self.get_histogram(name).observe(seconds)
+
+    @contextmanager
+    def time(self, name: str):
+        '''
+            Observes the duration of the with block in the histogram of name,
+            also when the block raises
+        '''
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time)
+
+    def clear(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def to_dict(self) -> dict:
+        return {
+            "counters": dict(self.counters),
+            "histograms": {name: histogram.to_dict() for name, histogram in self.histograms.items()}
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self) -> str:
+        '''
+            Returns the metrics in the Prometheus text exposition format,
+            durations are in seconds and bucket counts are cumulative
+        '''
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name} {value}")
+        for name, histogram in sorted(self.histograms.items()):
+            lines.append(f"# TYPE {name}_seconds histogram")
+            cumulative = 0
+            for upper_bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(
+                    f'{name}_seconds_bucket{{le="{upper_bound}"}} {cumulative}')
+            lines.append(
+                f'{name}_seconds_bucket{{le="+Inf"}} {histogram.count}')
+            lines.append(f"{name}_seconds_sum {histogram.sum}")
+            lines.append(f"{name}_seconds_count {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, location: str = METRICS_FILE):
+        '''
+            Writes the metrics into location, in the Prometheus text format
+            if it ends with .prom, as JSON otherwise
+        '''
+        utils.create_dir(os.path.dirname(location))
+        content = self.to_prometheus() if location.endswith(".prom") else self.to_json()
+        with open(utils.get_file_path(location), "w") as file:
+            file.write(content)
+        print(f"Metrics are written into '{location}'")
+
+
+# Metrics of this process
+metrics = Metrics()
+
+
+class BufferedLogWriter():
+    '''
+        File-like writer whose writes only put the text into a queue,
+        a background thread appends the queued text to the file in batches.
+        It can be passed to print(..., file=log_writer) from any thread.
+        Text written while LOG_QUEUE_SIZE writes are waiting is dropped and counted.
+    '''
+
+    def __init__(self, location: str, queue_size: int = LOG_QUEUE_SIZE):
+        self.location = location
+        self.queue = queue.Queue(queue_size)
+        self.dropped = 0
+        self.writer = threading.Thread(target=self.write_queued, daemon=True)
+        self.writer.start()
+
+    def write(self, text: str):
+        try:
+            self.queue.put_nowait(text)
+        except queue.Full:
+            self.dropped += 1
+            metrics.increment("log_lines_dropped")
+
+    def flush(self):
+        pass
+
+    def write_queued(self):
+        with open(utils.get_file_path(self.location), "a+") as file:
+            while True:
+                texts = [self.queue.get()]
+                # Take everything that is waiting, so that the file is written once per batch
+                while True:
+                    try:
+                        texts.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                closed = None in texts
+                file.write("".join(text for text in texts if text is not None))
+                file.flush()
+                if closed:
+                    return
+
+    def close(self):
+        '''
+            Waits until the queued text is written
+        '''
+        self.queue.put(None)
+        self.writer.join()
+
+
+def run_profiled(function, *args, name: str = None, profile_dir: str = PROFILE_DIR):
+    '''
+        Runs function(*args) under cProfile and tracemalloc, then writes a report of
+        the slowest functions, the largest allocation sites and the metrics into profile_dir
+        Returns the result of the function
+    '''
+    name = name or function.__name__
+    tracemalloc.start()
+    profiler = cProfile.Profile()
+    start_time = time.time()
+    try:
+        return profiler.runcall(function, *args)
+    finally:
+        elapsed = time.time() - start_time
+        snapshot = tracemalloc.take_snapshot()
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        report = io.StringIO()
+        print(f"{name} took {elapsed:.3f} seconds, peak traced memory {peak_memory / 2**20:.1f} MB",
+              file=report)
+        print("\nSlowest functions by cumulative time:", file=report)
+        pstats.Stats(profiler, stream=report).sort_stats(
+            "cumulative").print_stats(PROFILE_TOP_COUNT)
+        print("Largest allocation sites still in memory:", file=report)
+        for statistic in snapshot.statistics("lineno")[:PROFILE_TOP_COUNT]:
+            print(statistic, file=report)
+        print("\nMetrics:", file=report)
+        print(metrics.to_json(), file=report)
+
+        utils.create_dir(profile_dir)
+        location = os.path.join(
+            profile_dir, f"{name}_{time.strftime('%Y%m%d_%H%M%S')}.txt")
+        with open(utils.get_file_path(location), "w") as file:
+            file.write(report.getvalue())
+        profiler.dump_stats(utils.get_file_path(f"{location[:-len('.txt')]}.prof"))
+        print(f"Profile report is written into '{location}'")
@@ -0,0 +1,209 @@
+import os
+import time
+import numpy as np
+import utils
+from concurrent.futures import ProcessPoolExecutor
+from index import IndexReader, IndexWriter, INDEX_FILE
+from retrieval import select_top_k
+from vectorization import BookVectorizer, VectorMatrix
+from typing import List, Tuple
+
+NEIGHBORS_FILE = "out/index/neighbors.index"
+NEIGHBORS_CHECKPOINT_DIR = "out/neighbors"
+
+NEIGHBOR_COUNT = 18
+
+# Rows scored together, a block needs about 32 * NEIGHBOR_BLOCK_SIZE * book count bytes
+NEIGHBOR_BLOCK_SIZE = 128
+
+# Vectorizer of the pool processes, the index file is mapped once per process
+worker_vectorizer: BookVectorizer = None
+
+
+def calculate_block_similarities(vector_matrix: VectorMatrix, start: int, end: int) -> np.ndarray:
+    '''
+        Returns the cosine similarities of rows start:end with all rows as a dense
+        (end - start) x row count array, with one sparse matrix-matrix product.
+        Non-zeros of the block rows are joined with the columns of their terms,
+        and the products are summed with a single bincount.
+    '''
+    vector_matrix.build_columns()
+    row_count = len(vector_matrix.book_urls)
+    block_size = end - start
+    first, last = vector_matrix.indptr[start], vector_matrix.indptr[end]
+    block_rows = np.repeat(np.arange(block_size, dtype=np.int64),
+                           np.diff(vector_matrix.indptr[start:end + 1]))
+    terms = vector_matrix.indices[first:last]
+    weights = vector_matrix.data[first:last].astype(np.float64)
+
+    # Positions of the column entries of every block non-zero
+    column_starts = vector_matrix.column_indptr[terms]
+    column_lengths = vector_matrix.column_indptr[terms + 1] - column_starts
+    entry_count = int(column_lengths.sum())
+    entry_offsets = np.cumsum(column_lengths) - column_lengths
+    positions = np.arange(entry_count, dtype=np.int64) + \
+        np.repeat(column_starts - entry_offsets, column_lengths)
+
+    cells = np.repeat(block_rows, column_lengths) * row_count + \
+        vector_matrix.column_rows[positions]
+    products = vector_matrix.get_column_weights(positions).astype(
+        np.float64) * np.repeat(weights, column_lengths)
+    dot_products = np.bincount(cells, weights=products, minlength=block_size *
+                               row_count).reshape(block_size, row_count)
+
+    # Divide by the norms in place, rows with 0 norm have 0 similarity
+    norms = vector_matrix.norms.astype(np.float64)
+    inverse_norms = np.zeros_like(norms)
+    np.divide(1, norms, out=inverse_norms, where=norms != 0)
+    dot_products *= inverse_norms[start:end, None]
+    dot_products *= inverse_norms[None, :]
+    return dot_products
+
+
+def calculate_block_neighbors(book_vectorizer: BookVectorizer, start: int, end: int, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+        Returns (neighbor row ids, scores) of rows start:end as (end - start) x k arrays
+        Rows with less than k neighbors are padded with -1 ids and 0 scores
+    '''
+    description_vectors = book_vectorizer.description_vectors
+    scores = book_vectorizer.combine_description_genre_similarity(
+        calculate_block_similarities(description_vectors, start, end),
+        calculate_block_similarities(book_vectorizer.genre_vectors, start, end))
+
+    neighbor_ids = np.full((end - start, k), -1, dtype=np.int32)
+    neighbor_scores = np.zeros((end - start, k), dtype=np.float32)
+    for row in range(start, end):
+        top_k = select_top_k(
+            scores[row - start], description_vectors.book_urls, k, excluded_rows=[row])
+        for rank, (score, book_url) in enumerate(top_k):
+            neighbor_ids[row - start, rank] = description_vectors.url_index[book_url]
+            neighbor_scores[row - start, rank] = score
+    return (neighbor_ids, neighbor_scores)
+
+
+def init_neighbor_worker(index_file: str):
+    global worker_vectorizer
+    worker_vectorizer = BookVectorizer(index_file=index_file)
+
+
+def calculate_neighbor_block(start: int, end: int, k: int, checkpoint_file: str) -> int:
+    '''
+        Calculates the neighbors of a block in a pool process and saves them into checkpoint_file
+        Returns start, so that the caller knows which block is done
+    '''
+    neighbor_ids, neighbor_scores = calculate_block_neighbors(
+        worker_vectorizer, start, end, k)
+    # Write into a temporary file first, so that an interrupted write is not taken as a checkpoint
+    temporary_file = f"{checkpoint_file}.tmp.npz"
+    np.savez(temporary_file, neighbor_ids=neighbor_ids,
+             neighbor_scores=neighbor_scores)
+    os.replace(temporary_file, checkpoint_file)
+    return start
+
+
+class NeighborTableBuilder():
+    '''
+        Calculates the top-k neighbors of every book of an index file block by block
+        in a process pool, and writes them into a neighbor table file.
+
+        Every finished block is saved as a checkpoint, so an interrupted run
+        continues from the blocks that are not done yet. Checkpoints are kept
+        per index checksum, so they are never mixed with another index, and are
+        named by their rows and k, so a run with another block_size or k does not use them.
+    '''
+
+    def __init__(self, index_file: str = INDEX_FILE, k: int = NEIGHBOR_COUNT, block_size: int = NEIGHBOR_BLOCK_SIZE,
+                 processes: int = os.cpu_count(), checkpoint_dir: str = NEIGHBORS_CHECKPOINT_DIR):
+        self.index_file = index_file
+        self.k = k
+        self.block_size = block_size
+        self.processes = processes or 1
+        self.checkpoint_dir = checkpoint_dir
+
+    def get_checkpoint_file(self, checkpoint_dir: str, start: int, end: int) -> str:
+        return os.path.join(checkpoint_dir, f"block_{start}_{end}_{self.k}.npz")
+
+    def build(self, location: str = NEIGHBORS_FILE):
+        # The whole index is read anyway, a corrupted one must not be checkpointed under its checksum
+        index_reader = IndexReader(
+            utils.get_file_path(self.index_file), verify=True)
+        book_urls = index_reader.get_strings("book_urls")
+        book_count = len(book_urls)
+        checkpoint_dir = utils.get_file_path(
+            os.path.join(self.checkpoint_dir, f"{index_reader.checksum:08x}"))
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+        blocks = [(start, min(start + self.block_size, book_count))
+                  for start in range(0, book_count, self.block_size)]
+        remaining_blocks = [(start, end) for start, end in blocks
+                            if not os.path.isfile(self.get_checkpoint_file(checkpoint_dir, start, end))]
+        print(f"Calculating {self.k} neighbors of {book_count} books in {len(blocks)} blocks, "
+              f"{len(blocks) - len(remaining_blocks)} blocks are already done...")
+
+        start_time = time.time()
+        done_rows = 0
+        remaining_rows = sum(end - start for start, end in remaining_blocks)
+        with ProcessPoolExecutor(self.processes, initializer=init_neighbor_worker,
+                                 initargs=(utils.get_file_path(self.index_file),)) as pool:
+            futures = [pool.submit(calculate_neighbor_block, start, end, self.k,
+                                   self.get_checkpoint_file(checkpoint_dir, start, end))
+                       for start, end in remaining_blocks]
+            block_ends = dict(remaining_blocks)
+            for done_count, future in enumerate(futures, 1):
+                start = future.result()
+                done_rows += block_ends[start] - start
+                elapsed = time.time() - start_time
+                remaining_time = elapsed / done_rows * (remaining_rows - done_rows)
+                print(f"Block {done_count}/{len(remaining_blocks)} done, "
+                      f"{done_rows / elapsed:.1f} books/second, {remaining_time:.0f} seconds left")
+
+        neighbor_ids = np.empty((book_count, self.k), dtype=np.int32)
+        neighbor_scores = np.empty((book_count, self.k), dtype=np.float32)
+        for start, end in blocks:
+            with np.load(self.get_checkpoint_file(checkpoint_dir, start, end)) as checkpoint:
+                neighbor_ids[start:end] = checkpoint["neighbor_ids"]
+                neighbor_scores[start:end] = checkpoint["neighbor_scores"]
+
+        print(f"Writing the neighbor table into '{location}'...")
+        index_writer = IndexWriter()
+        index_writer.add_array("index_checksum", np.array(
+            [index_reader.checksum], dtype=np.int64))
+        index_writer.add_array(
+            "neighbor_count", np.array([self.k], dtype=np.int64))
+        index_writer.add_strings("book_urls", book_urls)
+        index_writer.add_array("neighbor_ids", neighbor_ids.ravel())
+        index_writer.add_array("neighbor_scores", neighbor_scores.ravel())
+        utils.create_dir(os.path.dirname(location))
+        index_writer.write(utils.get_file_path(location))
+
+
+class NeighborTable():
+    '''
+        Precalculated top-k neighbors of every book, mapped from a neighbor table file
+    '''
+
+    def __init__(self, location: str = NEIGHBORS_FILE):
+        self.index_reader = IndexReader(utils.get_file_path(location))
+        self.index_checksum = int(
+            self.index_reader.get_array("index_checksum")[0])
+        self.k = int(self.index_reader.get_array("neighbor_count")[0])
+        self.book_urls = self.index_reader.get_strings("book_urls")
+        self.url_index = {book_url: row for row,
+                          book_url in enumerate(self.book_urls)}
+        book_count = len(self.book_urls)
+        self.neighbor_ids = self.index_reader.get_array(
+            "neighbor_ids").reshape(book_count, self.k)
+        self.neighbor_scores = self.index_reader.get_array(
+            "neighbor_scores").reshape(book_count, self.k)
+
+    def get_neighbors(self, book_url: str, k: int) -> List[Tuple[float, str]]:
+        '''
+            Returns the k best (score, book_url) pairs of the book in descending order,
+            or None if the book is not in the table or the table has less than k neighbors
+        '''
+        row = self.url_index.get(book_url)
+        if row is None or k > self.k:
+            return None
+        return [(float(score), self.book_urls[neighbor_id])
+                for neighbor_id, score in zip(self.neighbor_ids[row, :k].tolist(), self.neighbor_scores[row, :k].tolist())
+                if neighbor_id >= 0]
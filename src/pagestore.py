@@ -0,0 +1,344 @@
+import hashlib
+import json
+import lzma
+import os
+import struct
+import threading
+import zlib
+import numpy as np
+import utils
+from book import Book
+from index import IndexReader, IndexWriter
+from typing import Iterable, Iterator, Tuple
+
+PAGE_STORE_FILE = "out/pages/pages.pack"
+BOOK_STORE_FILE = "out/pickle/books.pack"
+
+PACK_MAGIC = b"GRPAGES\0"
+PACK_VERSION = 1
+
+# magic, version
+PACK_HEADER_FORMAT = "<8sI"
+# compression, url length, data length, crc32 of the data
+RECORD_FORMAT = "<BHII"
+
+COMPRESSIONS = {'none': 0, 'zlib': 1, 'lzma': 2}
+
+# Buffer of the sequential reads of iterate_pages
+READ_BUFFER_SIZE = 1 << 20
+
+
+def get_url_hash(url: str) -> int:
+    '''
+        Returns a 64 bit hash of the url, the same in every process
+    '''
+    return int.from_bytes(hashlib.blake2b(url.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def compress_page(page: str, compression: int) -> bytes:
+    data = page.encode("utf-8")
+    if compression == COMPRESSIONS['zlib']:
+        return zlib.compress(data)
+    if compression == COMPRESSIONS['lzma']:
+        return lzma.compress(data)
+    return data
+
+
+def decompress_page(data: bytes, compression: int) -> str:
+    if compression == COMPRESSIONS['zlib']:
+        data = zlib.decompress(data)
+    elif compression == COMPRESSIONS['lzma']:
+        data = lzma.decompress(data)
+    return data.decode("utf-8")
+
+
+class PageStore():
+    '''
+        Downloaded pages in a single append-only pack file, keyed by url:
+
+            header | record | record ...
+
+        A record is its compression, the lengths of its url and data, a crc32 of the data,
+        the url and the page compressed by itself with zlib or lzma. A page that is saved again
+        is appended, and the latest record of a url is its page.
+
+        Offsets of the records are found by url hash in an index file written next to the pack
+        with IndexWriter: url hashes in sorted order, their offsets and the pack size it covers.
+        Records appended after the index was written are found by scanning the end of the pack
+        when the store is opened, so a store that was not closed loses nothing.
+
+        A read_only store never writes, so it can be opened while another process writes the store.
+    '''
+
+    def __init__(self, location: str = PAGE_STORE_FILE, compression: str = 'zlib', read_only: bool = False):
+        if compression not in COMPRESSIONS:
+            raise ValueError(
+                f"Unknown compression {compression}, expected one of {list(COMPRESSIONS)}")
+        self.location = location
+        self.index_location = f"{location}.index"
+        self.compression = COMPRESSIONS[compression]
+        self.read_only = read_only
+        self.lock = threading.Lock()
+
+        path = utils.get_file_path(location)
+        if not read_only:
+            utils.create_dir(os.path.dirname(location))
+            if not os.path.isfile(path):
+                with open(path, "wb") as file:
+                    file.write(struct.pack(PACK_HEADER_FORMAT,
+                               PACK_MAGIC, PACK_VERSION))
+        self.file = open(path, "rb" if read_only else "r+b")
+        magic, version = struct.unpack(PACK_HEADER_FORMAT, self.file.read(
+            struct.calcsize(PACK_HEADER_FORMAT)))
+        if magic != PACK_MAGIC:
+            raise ValueError(f"{location} is not a page store file")
+        if version != PACK_VERSION:
+            raise ValueError(
+                f"{location} has page store version {version}, expected {PACK_VERSION}")
+
+        # Sorted url hashes and offsets of the index file, and offsets of the records appended after it
+        self.url_hashes = np.zeros(0, dtype=np.uint64)
+        self.offsets = np.zeros(0, dtype=np.int64)
+        self.new_offsets: dict[str, int] = {}
+        indexed_size = struct.calcsize(PACK_HEADER_FORMAT)
+        pack_size = self.file.seek(0, os.SEEK_END)
+        if utils.file_exists(self.index_location):
+            index_reader = IndexReader(utils.get_file_path(self.index_location))
+            if int(index_reader.get_array("pack_size")[0]) <= pack_size:
+                self.url_hashes = index_reader.get_array("url_hashes")
+                self.offsets = index_reader.get_array("offsets")
+                indexed_size = int(index_reader.get_array("pack_size")[0])
+        self.scan_records(indexed_size)
+
+    def scan_records(self, offset: int):
+        '''
+            Adds the records from offset to the end of the pack to new_offsets,
+            a record that was not written completely is cut off
+        '''
+        for url, record_offset, end, _ in self.read_records(offset, read_data=False):
+            self.new_offsets[url] = record_offset
+            offset = end
+        if not self.read_only:
+            self.file.truncate(offset)
+
+    def read_records(self, offset: int, read_data: bool = True) -> Iterator[Tuple[str, int, int, bytes]]:
+        '''
+            Reads the records from offset sequentially,
+            yields (url, offset, end offset, page or None) of the complete ones
+        '''
+        record_size = struct.calcsize(RECORD_FORMAT)
+        with open(utils.get_file_path(self.location), "rb", buffering=READ_BUFFER_SIZE) as file:
+            file.seek(offset)
+            while True:
+                header = file.read(record_size)
+                if len(header) < record_size:
+                    return
+                compression, url_length, data_length, checksum = struct.unpack(
+                    RECORD_FORMAT, header)
+                url = file.read(url_length)
+                if read_data:
+                    data = file.read(data_length)
+                    if len(url) < url_length or len(data) < data_length:
+                        return
+                    if zlib.crc32(data) != checksum:
+                        raise ValueError(
+                            f"{self.location} is corrupted at offset {offset}, checksum mismatch")
+                    page = decompress_page(data, compression)
+                else:
+                    page = None
+                    if len(url) < url_length or file.seek(data_length, os.SEEK_CUR) > os.fstat(file.fileno()).st_size:
+                        return
+                end = offset + record_size + url_length + data_length
+                yield (url.decode("utf-8"), offset, end, page)
+                offset = end
+
+    def read_record(self, offset: int, read_data: bool = True) -> Tuple[str, str]:
+        '''
+            Returns (url, page) of the record at offset, page is None if read_data is False
+        '''
+        record_size = struct.calcsize(RECORD_FORMAT)
+        with self.lock:
+            self.file.seek(offset)
+            compression, url_length, data_length, checksum = struct.unpack(
+                RECORD_FORMAT, self.file.read(record_size))
+            url = self.file.read(url_length).decode("utf-8")
+            data = self.file.read(data_length) if read_data else None
+        if data is None:
+            return (url, None)
+        if zlib.crc32(data) != checksum:
+            raise ValueError(
+                f"{self.location} is corrupted at offset {offset}, checksum mismatch")
+        return (url, decompress_page(data, compression))
+
+    def find_offset(self, url: str) -> int:
+        '''
+            Returns the offset of the latest record of the url, or None
+        '''
+        with self.lock:
+            offset = self.new_offsets.get(url)
+        if offset is not None:
+            return offset
+        url_hash = np.uint64(get_url_hash(url))
+        left = np.searchsorted(self.url_hashes, url_hash, side="left")
+        right = np.searchsorted(self.url_hashes, url_hash, side="right")
+        # Offsets of the same hash are sorted, the latest record is checked first
+        for offset in self.offsets[left:right][::-1].tolist():
+            if self.read_record(offset, read_data=False)[0] == url:
+                return offset
+        return None
+
+    def put(self, url: str, page: str):
+        '''
+            Appends the page of the url, it replaces the previous page of the url
+        '''
+        data = compress_page(page, self.compression)
+        encoded_url = url.encode("utf-8")
+        record = struct.pack(RECORD_FORMAT, self.compression, len(
+            encoded_url), len(data), zlib.crc32(data)) + encoded_url + data
+        with self.lock:
+            offset = self.file.seek(0, os.SEEK_END)
+            self.file.write(record)
+            self.file.flush()
+            self.new_offsets[url] = offset
+
+    def get(self, url: str) -> str:
+        '''
+            Returns the latest page of the url, or None if it is not stored
+        '''
+        offset = self.find_offset(url)
+        if offset is None:
+            return None
+        return self.read_record(offset)[1]
+
+    def __contains__(self, url: str) -> bool:
+        return self.find_offset(url) is not None
+
+    def get_latest_offsets(self) -> np.ndarray:
+        '''
+            Returns the sorted offsets of the latest record of every url, found from the index
+            A url hash is unique for almost all urls, so its last offset is the latest record of its url.
+            Only records of a hash with several offsets, of a page saved again or of colliding urls,
+            are read to find their urls.
+        '''
+        with self.lock:
+            url_hashes, offsets = self.url_hashes, self.offsets
+            new_offsets = dict(self.new_offsets)
+        new_hashes = np.array([get_url_hash(url) for url in new_offsets], dtype=np.uint64)
+        # Offsets of the same hash are sorted, the last one of a hash is the latest
+        group_starts = np.r_[True, url_hashes[1:] != url_hashes[:-1]]
+        group_ends = np.r_[url_hashes[1:] != url_hashes[:-1], True]
+        ambiguous = ~(group_starts & group_ends) | np.isin(url_hashes, new_hashes)
+
+        latest_offsets = dict(new_offsets)
+        for offset in offsets[ambiguous].tolist():
+            url = self.read_record(offset, read_data=False)[0]
+            if url not in new_offsets:
+                latest_offsets[url] = max(offset, latest_offsets.get(url, offset))
+        return np.sort(np.concatenate([offsets[~ambiguous], np.fromiter(
+            latest_offsets.values(), dtype=np.int64, count=len(latest_offsets))]))
+
+    def iterate_pages(self) -> Iterator[Tuple[str, str]]:
+        '''
+            Yields (url, page) of the latest page of every url,
+            the pack is read sequentially instead of a random read per page
+        '''
+        latest_offsets = self.get_latest_offsets().tolist()
+        position = 0
+        for url, offset, _, page in self.read_records(struct.calcsize(PACK_HEADER_FORMAT)):
+            # Both are in increasing order
+            while position < len(latest_offsets) and latest_offsets[position] < offset:
+                position += 1
+            if position < len(latest_offsets) and latest_offsets[position] == offset:
+                yield (url, page)
+
+    def write_index(self):
+        '''
+            Writes the offsets of all records into the index file,
+            so that the next open does not scan the pack
+        '''
+        with self.lock:
+            pack_size = self.file.seek(0, os.SEEK_END)
+            new_urls = list(self.new_offsets)
+            url_hashes = np.concatenate([self.url_hashes, np.array(
+                [get_url_hash(url) for url in new_urls], dtype=np.uint64)])
+            offsets = np.concatenate([self.offsets, np.array(
+                [self.new_offsets[url] for url in new_urls], dtype=np.int64)])
+            order = np.lexsort((offsets, url_hashes))
+
+            index_writer = IndexWriter()
+            index_writer.add_array(
+                "pack_size", np.array([pack_size], dtype=np.int64))
+            index_writer.add_array("url_hashes", url_hashes[order])
+            index_writer.add_array("offsets", offsets[order])
+            # Replace the file at once, so that an interrupted write does not leave a broken index
+            temporary_location = f"{self.index_location}.tmp"
+            index_writer.write(utils.get_file_path(temporary_location))
+            os.replace(utils.get_file_path(temporary_location),
+                       utils.get_file_path(self.index_location))
+
+            self.url_hashes = url_hashes[order]
+            self.offsets = offsets[order]
+            self.new_offsets = {}
+
+    def close(self):
+        if not self.read_only:
+            self.write_index()
+        self.file.close()
+
+    def replace(self, location: str):
+        '''
+            Closes the store and moves it to location, replacing the store there
+        '''
+        self.close()
+        index_location = f"{location}.index"
+        # Without an index the pack is scanned when opened, so a store opened in between
+        # finds the old or the new records, never the offsets of the other pack
+        if utils.file_exists(index_location):
+            os.remove(utils.get_file_path(index_location))
+        os.replace(utils.get_file_path(self.location),
+                   utils.get_file_path(location))
+        os.replace(utils.get_file_path(self.index_location),
+                   utils.get_file_path(index_location))
+        self.location, self.index_location = location, index_location
+
+
+class BookStore(PageStore):
+    '''
+        Extracted books in a pack file like the pages of PageStore, keyed by compressed url,
+        so that a book is read without unpickling all books.
+        A book is stored as the JSON of its fields.
+    '''
+
+    def __init__(self, location: str = BOOK_STORE_FILE, read_only: bool = False):
+        super().__init__(location, read_only=read_only)
+
+    def put_book(self, book_url: str, book: Book):
+        self.put(book_url, json.dumps(vars(book)))
+
+    def get_book(self, book_url: str) -> Book:
+        '''
+            Returns the book of the compressed url, or None if it is not stored
+        '''
+        page = self.get(book_url)
+        return Book(**json.loads(page)) if page is not None else None
+
+    def iterate_books(self) -> Iterator[Tuple[str, Book]]:
+        '''
+            Yields (compressed url, book) of every stored book in the order they were stored
+        '''
+        for book_url, page in self.iterate_pages():
+            yield (book_url, Book(**json.loads(page)))
+
+
+def write_book_store(books: Iterable[Tuple[str, Book]], location: str = BOOK_STORE_FILE):
+    '''
+        Writes the (compressed url, book) pairs into a new book store at location
+    '''
+    temporary_location = f"{location}.tmp"
+    for leftover in (temporary_location, f"{temporary_location}.index"):
+        if utils.file_exists(leftover):
+            os.remove(utils.get_file_path(leftover))
+    book_store = BookStore(temporary_location)
+    for book_url, book in books:
+        book_store.put_book(book_url, book)
+    book_store.replace(location)
@@ -0,0 +1,410 @@
+import os
+import time
+import numpy as np
+import utils
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from book import Book
+from download import BookDownloader
+from metrics import metrics
+from index import ArrayFile, IndexWriter, INDEX_FILE
+from pagestore import BookStore, BOOK_STORE_FILE
+from vectorization import BookVectorizer, Vocabulary, CONTENT_TYPES, INT8_MAX, QUANTIZATIONS, count_book_terms
+from typing import Iterator, List, Tuple
+
+# Books tokenized and written together, peak memory grows with it
+SHARD_SIZE = 10000
+SHARD_DIR = "out/shards"
+
+# Postings of the shards merged into the column-wise weights at once
+MERGE_BLOCK_SIZE = 1 << 22
+
+
+def tokenize_book_shard(books: List[Book]) -> List[dict[str, Counter]]:
+    '''
+        Returns the term frequencies of a shard of books, runs in a pool process
+    '''
+    return [count_book_terms(book) for book in books]
+
+
+def iterate_shards(books: Iterator[Tuple[str, Book]], shard_size: int) -> Iterator[List[Tuple[str, Book]]]:
+    '''
+        Groups the (book_url, book) pairs into lists of shard_size pairs
+    '''
+    shard = []
+    for item in books:
+        shard.append(item)
+        if len(shard) == shard_size:
+            yield shard
+            shard = []
+    if shard:
+        yield shard
+
+
+class ShardPostings():
+    '''
+        Postings of a field of a shard on disk, sorted by term id and then by row:
+        term ids, global rows and term frequencies in 3 ArrayFiles
+    '''
+
+    def __init__(self, location: str):
+        self.terms = ArrayFile(f"{location}.terms", np.int32)
+        self.rows = ArrayFile(f"{location}.rows", np.int32)
+        self.frequencies = ArrayFile(f"{location}.frequencies", np.int32)
+        # Read position and the postings read ahead by read_until
+        self.position = 0
+        self.buffer = (np.zeros(0, dtype=np.int32),) * 3
+
+    def write(self, terms: np.ndarray, rows: np.ndarray, frequencies: np.ndarray):
+        '''
+            Writes the postings and closes the files, so that open files do not grow with the shards
+        '''
+        for array_file, array in ((self.terms, terms), (self.rows, rows), (self.frequencies, frequencies)):
+            array_file.append(array)
+            array_file.close()
+
+    def read_all(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        return (self.terms.read(0, len(self.terms)), self.rows.read(0, len(self.rows)),
+                self.frequencies.read(0, len(self.frequencies)))
+
+    def read_until(self, term_end: int, chunk_size: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        '''
+            Returns (terms, rows, frequencies) of the next postings whose term id is less than term_end,
+            the file is read sequentially in chunks of chunk_size postings
+        '''
+        terms, rows, frequencies = self.buffer
+        while (len(terms) == 0 or terms[-1] < term_end) and self.position < len(self.terms):
+            terms = np.concatenate(
+                (terms, self.terms.read(self.position, chunk_size)))
+            rows = np.concatenate(
+                (rows, self.rows.read(self.position, chunk_size)))
+            frequencies = np.concatenate(
+                (frequencies, self.frequencies.read(self.position, chunk_size)))
+            self.position += chunk_size
+        end = np.searchsorted(terms, term_end)
+        self.buffer = (terms[end:], rows[end:], frequencies[end:])
+        return (terms[:end], rows[:end], frequencies[:end])
+
+    def remove(self):
+        for array_file in (self.terms, self.rows, self.frequencies):
+            array_file.remove()
+
+
+class StreamingIndexBuilder():
+    '''
+        Builds the index file of books added shard by shard without keeping their postings in memory.
+
+        Every shard's postings are written into shard_dir sorted by term id. When the index is written,
+        the tf-idf rows are built shard by shard with the final idf weights and appended to the index
+        sections on disk, then the column-wise weights are built with a k-way merge of the shard files
+        in blocks of terms, so a block holds about MERGE_BLOCK_SIZE postings.
+        Only the vocabularies, the document frequencies and a few numbers per book stay in memory.
+        The book urls are appended to files too. StreamingIndexer writes the offsets of the book store
+        after every shard, so the store keeps a url hash and an offset per book instead of the urls.
+        Terms get their ids in the same order as SegmentedIndex, so the index file is the same as
+        the one written by BookVectorizer.
+    '''
+
+    def __init__(self, shard_dir: str = SHARD_DIR):
+        self.shard_dir = shard_dir
+        self.vocabularies = {content_type: Vocabulary()
+                             for content_type in CONTENT_TYPES}
+        self.doc_frequencies = {content_type: np.zeros(0, dtype=np.int64)
+                                for content_type in CONTENT_TYPES}
+        self.shards: List[dict[str, ShardPostings]] = []
+        # First row of each shard, and the row after the last shard
+        self.shard_rows = [0]
+        utils.create_dir(shard_dir)
+        # Book urls as the blob and offsets sections of IndexWriter.add_strings
+        self.book_url_blob = ArrayFile(self.get_shard_path("book_urls.blob"), np.uint8)
+        self.book_url_offsets = ArrayFile(self.get_shard_path("book_urls.offsets"), np.int64)
+        self.book_url_offsets.append(np.zeros(1, dtype=np.int64))
+        self.book_url_size = 0
+
+    def get_shard_path(self, file_name: str) -> str:
+        return utils.get_file_path(os.path.join(self.shard_dir, file_name))
+
+    def get_book_count(self) -> int:
+        return self.shard_rows[-1]
+
+    def add_shard(self, book_urls: List[str], term_frequencies: List[dict[str, Counter]]):
+        '''
+            Writes the postings of the next shard of books, term_frequencies are returned by count_book_terms
+        '''
+        first_row = self.get_book_count()
+        shard = {}
+        for content_type in CONTENT_TYPES:
+            vocabulary = self.vocabularies[content_type]
+            rows, terms, frequencies = [], [], []
+            for row, book_term_frequencies in enumerate(term_frequencies):
+                for term, frequency in book_term_frequencies[content_type].items():
+                    rows.append(first_row + row)
+                    terms.append(vocabulary.add(term))
+                    frequencies.append(frequency)
+            terms = np.array(terms, dtype=np.int32)
+            rows = np.array(rows, dtype=np.int32)
+            frequencies = np.array(frequencies, dtype=np.int32)
+
+            doc_frequencies = np.zeros(len(vocabulary), dtype=np.int64)
+            doc_frequencies[:len(self.doc_frequencies[content_type])
+                            ] = self.doc_frequencies[content_type]
+            # Term ids are unique within a row, so each row adds 1 to its terms
+            np.add.at(doc_frequencies, terms, 1)
+            self.doc_frequencies[content_type] = doc_frequencies
+
+            # Rows are added in increasing order, so a stable sort keeps them sorted within a term
+            order = np.argsort(terms, kind='stable')
+            shard_postings = ShardPostings(self.get_shard_path(
+                f"{content_type}_{len(self.shards)}"))
+            shard_postings.write(terms[order], rows[order], frequencies[order])
+            shard[content_type] = shard_postings
+        self.shards.append(shard)
+        self.shard_rows.append(first_row + len(book_urls))
+
+        encoded = [book_url.encode("utf-8") for book_url in book_urls]
+        self.book_url_blob.append(np.frombuffer(b"".join(encoded), dtype=np.uint8))
+        self.book_url_offsets.append(self.book_url_size + np.cumsum(
+            [len(book_url) for book_url in encoded], dtype=np.int64))
+        self.book_url_size += sum(len(book_url) for book_url in encoded)
+
+    def get_idf_weights(self, content_type: str) -> np.ndarray:
+        doc_frequencies = self.doc_frequencies[content_type]
+        idf_weights = np.zeros(len(doc_frequencies), dtype=np.float64)
+        present = doc_frequencies > 0
+        idf_weights[present] = np.log10(
+            self.get_book_count() / doc_frequencies[present])
+        return idf_weights
+
+    def write_rows(self, index_writer: IndexWriter, content_type: str, idf_weights: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+            Appends the tf-idf rows of the shards to the row-wise sections of the field,
+            returns the norms and the int8 scales of the rows
+        '''
+        indptr = ArrayFile(self.get_shard_path(f"{content_type}.indptr"), np.int64)
+        indices = ArrayFile(self.get_shard_path(f"{content_type}.indices"), np.int32)
+        data = ArrayFile(self.get_shard_path(f"{content_type}.data"), np.float32)
+        norms = np.zeros(self.get_book_count(), dtype=np.float64)
+        scales = np.zeros(self.get_book_count(), dtype=np.float32)
+        indptr.append(np.zeros(1, dtype=np.int64))
+        for shard_id, shard in enumerate(self.shards):
+            first_row, end_row = self.shard_rows[shard_id], self.shard_rows[shard_id + 1]
+            terms, rows, frequencies = shard[content_type].read_all()
+            weights = (1 + np.log10(frequencies.astype(np.float64))) * \
+                idf_weights[terms]
+            positive = weights > 0
+            terms, rows, weights = terms[positive], rows[positive] - first_row, weights[positive]
+            order = np.lexsort((terms, rows))
+            rows, shard_data = rows[order], weights[order].astype(np.float32)
+
+            row_counts = np.bincount(rows, minlength=end_row - first_row)
+            row_ends = np.cumsum(row_counts)
+            indptr.append(row_ends + len(data))
+            indices.append(terms[order])
+            data.append(shard_data)
+
+            norms[first_row:end_row] = np.sqrt(np.bincount(
+                rows, weights=shard_data.astype(np.float64) ** 2, minlength=end_row - first_row))
+            non_empty = row_counts > 0
+            if non_empty.any():
+                scales[first_row:end_row][non_empty] = np.maximum.reduceat(
+                    np.abs(shard_data), (row_ends - row_counts)[non_empty]) / INT8_MAX
+
+        index_writer.add_array(f"{content_type}.indptr", indptr)
+        index_writer.add_array(f"{content_type}.indices", indices)
+        index_writer.add_array(f"{content_type}.data", data)
+        index_writer.add_array(f"{content_type}.norms", norms)
+        return (norms, scales)
+
+    def write_columns(self, index_writer: IndexWriter, content_type: str, idf_weights: np.ndarray,
+                      norms: np.ndarray, scales: np.ndarray, quantization: str):
+        '''
+            Merges the postings of the shards into the column-wise sections of the field, block of terms by block
+            Columns are the same as VectorMatrix.quantize_columns builds from the rows
+        '''
+        doc_frequencies = self.doc_frequencies[content_type]
+        vocabulary_size = len(doc_frequencies)
+        # Weights of the terms of every book have idf 0 and are dropped
+        column_counts = np.where(idf_weights > 0, doc_frequencies, 0)
+        column_indptr = np.zeros(vocabulary_size + 1, dtype=np.int64)
+        np.cumsum(column_counts, out=column_indptr[1:])
+        posting_indptr = np.zeros(vocabulary_size + 1, dtype=np.int64)
+        np.cumsum(doc_frequencies, out=posting_indptr[1:])
+
+        column_dtype = {'float16': np.float16, 'int8': np.int8}.get(quantization, np.float32)
+        column_rows = ArrayFile(self.get_shard_path(f"{content_type}.column_rows"), np.int32)
+        column_data = ArrayFile(self.get_shard_path(f"{content_type}.column_data"), column_dtype)
+        column_max_weights = np.zeros(vocabulary_size, dtype=np.float64)
+        inverse_scales = np.zeros_like(scales)
+        np.divide(1, scales, out=inverse_scales, where=scales != 0)
+        shard_postings = [shard[content_type] for shard in self.shards]
+        chunk_size = max(MERGE_BLOCK_SIZE // max(len(shard_postings), 1), 1 << 14)
+
+        term_start = 0
+        while term_start < vocabulary_size:
+            term_end = int(np.searchsorted(
+                posting_indptr, posting_indptr[term_start] + MERGE_BLOCK_SIZE, side='right')) - 1
+            term_end = min(max(term_end, term_start + 1), vocabulary_size)
+            # Rows of a term are in shard order, the stable sort keeps them sorted
+            blocks = [postings.read_until(term_end, chunk_size) for postings in shard_postings]
+            terms = np.concatenate([block[0] for block in blocks])
+            order = np.argsort(terms, kind='stable')
+            terms = terms[order]
+            rows = np.concatenate([block[1] for block in blocks])[order]
+            frequencies = np.concatenate([block[2] for block in blocks])[order]
+
+            weights = (1 + np.log10(frequencies.astype(np.float64))) * \
+                idf_weights[terms]
+            positive = weights > 0
+            rows, weights = rows[positive], weights[positive].astype(np.float32)
+            if quantization == 'float16':
+                block_data = weights.astype(np.float16)
+                dequantized_weights = block_data
+            elif quantization == 'int8':
+                block_data = np.rint(weights * inverse_scales[rows]).astype(np.int8)
+                dequantized_weights = block_data * scales[rows]
+            else:
+                block_data = dequantized_weights = weights
+            column_rows.append(rows)
+            column_data.append(block_data)
+
+            block_indptr = column_indptr[term_start:term_end + 1] - column_indptr[term_start]
+            non_empty = np.diff(block_indptr) > 0
+            if non_empty.any():
+                column_max_weights[term_start:term_end][non_empty] = np.maximum.reduceat(
+                    dequantized_weights / norms[rows], block_indptr[:-1][non_empty])
+            term_start = term_end
+
+        index_writer.add_array(f"{content_type}.column_indptr", column_indptr)
+        index_writer.add_array(f"{content_type}.column_rows", column_rows)
+        index_writer.add_array(f"{content_type}.column_data", column_data)
+        index_writer.add_array(f"{content_type}.column_max_weights", column_max_weights)
+        if quantization == 'int8':
+            index_writer.add_array(f"{content_type}.column_scales", scales)
+
+    @metrics.time("index_build")
+    def write_index(self, location: str = INDEX_FILE, quantization: str = 'float32'):
+        '''
+            Writes the index file like BookVectorizer.write_index and removes the shard files
+        '''
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(
+                f"Unknown quantization {quantization}, expected one of {list(QUANTIZATIONS)}")
+        print(f"Writing the index into '{location}'...")
+        index_writer = IndexWriter()
+        index_writer.add_array("book_count", np.array(
+            [self.get_book_count()], dtype=np.int64))
+        index_writer.add_array("book_urls.blob", self.book_url_blob)
+        index_writer.add_array("book_urls.offsets", self.book_url_offsets)
+
+        for content_type in CONTENT_TYPES:
+            index_writer.add_term_dictionary(
+                f"{content_type}.terms", self.vocabularies[content_type])
+            index_writer.add_array(f"{content_type}.doc_frequency",
+                                   self.doc_frequencies[content_type].astype(np.int32))
+            idf_weights = self.get_idf_weights(content_type)
+            norms, scales = self.write_rows(index_writer, content_type, idf_weights)
+            self.write_columns(index_writer, content_type, idf_weights,
+                               norms, scales, quantization)
+
+        utils.create_dir(os.path.dirname(location))
+        # Replace the file at once, so that readers mapping the old file are not affected
+        temporary_location = f"{location}.tmp"
+        index_writer.write(utils.get_file_path(temporary_location))
+        os.replace(utils.get_file_path(temporary_location),
+                   utils.get_file_path(location))
+
+        for array in index_writer.sections.values():
+            if isinstance(array, ArrayFile):
+                array.remove()
+        for shard in self.shards:
+            for shard_postings in shard.values():
+                shard_postings.remove()
+        self.shards = []
+
+
+class StreamingIndexer():
+    '''
+        Indexes a books file as a stream: fetch -> extract -> tokenize -> shard writer.
+
+        Books are yielded by BookDownloader.stream_books as they are extracted, grouped into shards
+        of shard_size books and tokenized in a process pool. Every finished shard is written into
+        the book store, its postings are written into shard_dir by StreamingIndexBuilder, and it is
+        dropped. Stages are connected with bounded queues, a slow stage makes the previous ones wait,
+        so the books in memory depend on shard_size, not on the corpus size.
+    '''
+
+    def __init__(self, book_downloader: BookDownloader = None, shard_size: int = SHARD_SIZE,
+                 shard_dir: str = SHARD_DIR, processes: int = os.cpu_count()):
+        self.book_downloader = book_downloader or BookDownloader()
+        self.shard_size = shard_size
+        self.shard_dir = shard_dir
+        self.processes = processes or 1
+
+    def tokenize_shards(self, shards: Iterator[List[Tuple[str, Book]]]) -> Iterator[Tuple[List[Tuple[str, Book]], List[dict[str, Counter]]]]:
+        '''
+            Yields (shard, term frequencies of its books) in the order of the shards
+            At most processes + 1 shards are tokenized at the same time
+        '''
+        if self.processes == 1:
+            for shard in shards:
+                with metrics.time("tokenize"):
+                    term_frequencies = tokenize_book_shard(
+                        [book for _, book in shard])
+                yield (shard, term_frequencies)
+            return
+
+        with ProcessPoolExecutor(self.processes) as pool:
+            pending = deque()
+            for shard in shards:
+                pending.append((shard, pool.submit(
+                    tokenize_book_shard, [book for _, book in shard])))
+                if len(pending) > self.processes:
+                    shard, future = pending.popleft()
+                    yield (shard, future.result())
+            while pending:
+                shard, future = pending.popleft()
+                yield (shard, future.result())
+
+    def write_shard(self, index_builder: StreamingIndexBuilder, book_store: BookStore, shard: List[Tuple[str, Book]],
+                    term_frequencies: List[dict[str, Counter]]):
+        '''
+            Writes the books of the shard into the book store and their postings into the shard files
+            A book which is in the books file more than once is indexed once, with its first page
+        '''
+        book_urls, kept_term_frequencies = [], []
+        for (book_url, book), book_term_frequencies in zip(shard, term_frequencies):
+            if book_url in book_store:
+                continue
+            book_store.put_book(book_url, book)
+            book_urls.append(book_url)
+            kept_term_frequencies.append(book_term_frequencies)
+        with metrics.time("shard_write"):
+            index_builder.add_shard(book_urls, kept_term_frequencies)
+            # Offsets of new records are kept by url until they are written into the index of the store
+            book_store.write_index()
+        metrics.increment("shards_written_total")
+
+    def index_books(self, books_file: str, index_file: str = INDEX_FILE, book_store_file: str = BOOK_STORE_FILE) -> BookVectorizer:
+        '''
+            Downloads, tokenizes and indexes the books of books_file,
+            writes the book store and the index file
+        '''
+        start_time = time.time()
+        index_builder = StreamingIndexBuilder(self.shard_dir)
+        temporary_location = f"{book_store_file}.tmp"
+        for leftover in (temporary_location, f"{temporary_location}.index"):
+            if utils.file_exists(leftover):
+                os.remove(utils.get_file_path(leftover))
+        book_store = BookStore(temporary_location)
+
+        books = self.book_downloader.stream_books(books_file)
+        shards = iterate_shards(books, self.shard_size)
+        for shard_id, (shard, term_frequencies) in enumerate(self.tokenize_shards(shards)):
+            self.write_shard(index_builder, book_store,
+                             shard, term_frequencies)
+            print(f"Shard {shard_id} written, {index_builder.get_book_count()} books indexed in "
+                  f"{time.time() - start_time:.1f} seconds")
+
+        book_store.replace(book_store_file)
+        index_builder.write_index(index_file)
+        return BookVectorizer(index_file=index_file)
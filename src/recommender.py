@@ -0,0 +1,247 @@
+import os
+import threading
+import time
+import utils
+import evaluation
+from cache import LRUCache, TTLCache
+from download import BookDownloader
+from book import Book
+from vectorization import BookVectorizer, ENGINES
+from index import INDEX_FILE
+from neighbors import NeighborTable, NEIGHBORS_FILE
+from pagestore import BookStore, BOOK_STORE_FILE
+from metrics import metrics
+from sharding import ShardCoordinator, SHARD_ENGINES
+from typing import Tuple
+
+BOOKS_PICKLE = "out/pickle/books.pickle"
+
+RECOMMENDATION_COUNT = 18
+
+# Engines of get_recommendations, neighbors falls back to exhaustive for books that are not in the neighbor table
+RECOMMENDER_ENGINES = ENGINES + ('neighbors',)
+
+# Downloaded query books are kept for an hour
+PAGE_CACHE_SIZE = 1024
+PAGE_CACHE_TTL = 60 * 60
+
+RESULT_CACHE_SIZE = 4096
+
+# Seconds between checks of the index file for a rebuild
+INDEX_CHECK_INTERVAL = 1.0
+
+
+class Recommender():
+    '''
+        Loads the books and vectors once and calculates recommendations of books
+
+        Results are cached in two levels: downloaded query books in a TTL cache,
+        and top-k results in an LRU cache keyed by book url, k, engine and index version.
+        Indexed books are never downloaded. They are read one by one from the book store,
+        books_dict is only unpickled at the first query if there is no book store.
+
+        With engine='neighbors', indexed books are answered from the neighbor table
+        built by neighbors.NeighborTableBuilder, if it was built from the loaded index.
+
+        With a shard_coordinator, exhaustive, maxscore and threshold queries are scored by its shard workers.
+
+        With min_genre_overlap > 0, only the books sharing that many genres with the query book are ranked.
+        With field_weights, the description and genre similarities are weighted per query.
+    '''
+
+    def __init__(self, books_dict_file: str = BOOKS_PICKLE, index_file: str = INDEX_FILE, neighbors_file: str = NEIGHBORS_FILE,
+                 shard_coordinator: ShardCoordinator = None, book_store_file: str = BOOK_STORE_FILE):
+        self.books_dict_file = books_dict_file
+        self.book_store_file = book_store_file
+        self.index_file = index_file
+        self.neighbors_file = neighbors_file
+        self.shard_coordinator = shard_coordinator
+        self.book_downloader = BookDownloader()
+        self.page_cache = TTLCache(PAGE_CACHE_SIZE, PAGE_CACHE_TTL)
+        self.result_cache = LRUCache(RESULT_CACHE_SIZE)
+        self.load_lock = threading.Lock()
+        self.books_lock = threading.Lock()
+        self.load_index()
+
+    def load_index(self):
+        '''
+            Loads the vectors and opens the book store, results of the previous index are dropped
+        '''
+        book_store = None
+        if utils.file_exists(self.index_file):
+            book_vectorizer = BookVectorizer(index_file=self.index_file)
+            self.index_mtime = os.stat(
+                utils.get_file_path(self.index_file)).st_mtime_ns
+            if utils.file_exists(self.book_store_file):
+                book_store = BookStore(self.book_store_file, read_only=True)
+            # Without a book store, books_dict is unpickled by get_books_dict
+            books_dict = None
+        else:
+            # Vectors pickled by older versions
+            book_vectorizer = BookVectorizer(
+                books_dict_file=self.books_dict_file)
+            self.index_mtime = None
+            books_dict = book_vectorizer.books_dict
+        book_vectorizer.load_vectors()
+        # Build column-wise copies before serving any query
+        book_vectorizer.description_vectors.build_columns()
+        book_vectorizer.genre_vectors.build_columns()
+
+        neighbor_table = None
+        if utils.file_exists(self.neighbors_file):
+            neighbor_table = NeighborTable(self.neighbors_file)
+            if neighbor_table.index_checksum != book_vectorizer.get_index_version():
+                print(
+                    f"Neighbor table {self.neighbors_file} is not built from the index, it is not used")
+                neighbor_table = None
+
+        # Shards load the rebuilt index too, or are assigned again after a failed reassignment
+        if self.shard_coordinator is not None and (not self.shard_coordinator.assigned or
+                                                   self.shard_coordinator.book_vectorizer.get_index_version() != book_vectorizer.get_index_version()):
+            self.shard_coordinator.load_index()
+
+        self.book_vectorizer = book_vectorizer
+        self.neighbor_table = neighbor_table
+        # The old book store is closed when the queries reading it are done
+        with self.books_lock:
+            self.book_store = book_store
+            self.books_dict = books_dict
+        self.last_index_check = time.monotonic()
+        self.result_cache.clear()
+
+    def refresh_index(self):
+        '''
+            Reloads the index if the index file was rewritten since it was loaded
+            The file is checked at most once per INDEX_CHECK_INTERVAL seconds
+        '''
+        if self.index_mtime is None or time.monotonic() - self.last_index_check < INDEX_CHECK_INTERVAL:
+            return
+        with self.load_lock:
+            if time.monotonic() - self.last_index_check < INDEX_CHECK_INTERVAL:
+                return
+            self.last_index_check = time.monotonic()
+            try:
+                index_mtime = os.stat(utils.get_file_path(
+                    self.index_file)).st_mtime_ns
+            except OSError:
+                return
+            if index_mtime != self.index_mtime:
+                print(f"Index file {self.index_file} changed, reloading...")
+                self.load_index()
+
+    def get_books_dict(self) -> dict[str, Book]:
+        '''
+            Returns books_dict, it is unpickled at the first call
+        '''
+        with self.books_lock:
+            if self.books_dict is None:
+                self.books_dict = utils.unpickle_object(self.books_dict_file) if utils.file_exists(
+                    self.books_dict_file) else {}
+            return self.books_dict
+
+    def get_indexed_book(self, compressed_url: str) -> Book:
+        '''
+            Returns the book from the book store, or from books_dict if there is no book store
+        '''
+        book_store = self.book_store
+        if book_store is not None:
+            return book_store.get_book(compressed_url)
+        return self.get_books_dict().get(compressed_url)
+
+    def get_book(self, book_url: str) -> Book:
+        '''
+            Returns the indexed book or the book from the page cache, downloads it otherwise
+        '''
+        compressed_url = utils.compress_book_url(book_url)
+        book = self.get_indexed_book(compressed_url)
+        if book is not None:
+            return book
+        book = self.page_cache.get(compressed_url)
+        if book is not None:
+            return book
+        book = self.book_downloader.download_single_book(book_url)
+        if book is not None:
+            self.page_cache.put(compressed_url, book)
+        return book
+
+    def get_cache_stats(self) -> dict:
+        stats = {
+            "page_cache": self.page_cache.get_stats(),
+            "result_cache": self.result_cache.get_stats(),
+            "index_version": self.book_vectorizer.get_index_version()
+        }
+        if self.shard_coordinator is not None:
+            stats["shards"] = self.shard_coordinator.get_stats()
+        return stats
+
+    def get_recommendations(self, book_url: str, k: int = RECOMMENDATION_COUNT, engine: str = 'exhaustive',
+                            min_genre_overlap: int = 0, field_weights: Tuple[float, float] = None) -> dict:
+        '''
+            Downloads the book in book_url and calculates its recommendations with the engine,
+            or returns them from the result cache
+            Returns a dictionary with goodread's and calculated recommendations,
+            their precision and the latency of the calculation in seconds
+        '''
+        if engine not in RECOMMENDER_ENGINES:
+            raise ValueError(
+                f"Unknown engine {engine}, expected one of {RECOMMENDER_ENGINES}")
+        start_time = time.time()
+        compressed_url = utils.compress_book_url(book_url)
+        metrics.increment("queries_total")
+
+        self.refresh_index()
+        book_vectorizer = self.book_vectorizer
+        neighbor_table = self.neighbor_table
+        field_weights = book_vectorizer.get_field_weights(field_weights)
+        result_key = (compressed_url, k, engine, min_genre_overlap, field_weights,
+                      book_vectorizer.get_index_version())
+        result = self.result_cache.get(result_key)
+        if result is not None:
+            return dict(result, latency=time.time() - start_time)
+
+        # Get the indexed book or the book from the cache, download it otherwise
+        book = self.get_book(book_url)
+        if book is None:
+            metrics.increment("query_errors_total")
+            return {
+                "book_url": compressed_url,
+                "error": f"Book could not be downloaded: {book_url}"
+            }
+
+        top_similarities = None
+        if engine == 'neighbors' and neighbor_table is not None and min_genre_overlap <= 0 and \
+                field_weights == book_vectorizer.get_field_weights():
+            top_similarities = neighbor_table.get_neighbors(compressed_url, k)
+        if top_similarities is None:
+            # Books that are not in the neighbor table are scored against all books
+            if engine == 'neighbors':
+                engine = 'exhaustive'
+            if self.shard_coordinator is not None and engine in SHARD_ENGINES:
+                top_similarities = self.shard_coordinator.calculate_top_k_similarities(
+                    book, k=k, excluded_urls=[compressed_url], engine=engine, min_genre_overlap=min_genre_overlap,
+                    field_weights=field_weights)
+            else:
+                top_similarities = book_vectorizer.calculate_top_k_similarities(
+                    book, k=k, excluded_urls=[compressed_url], engine=engine, min_genre_overlap=min_genre_overlap,
+                    field_weights=field_weights)
+
+        # Get calculated_recommendations
+        calculated_recommendations = [url for rank, url in top_similarities]
+
+        # Get goodread's recommendations
+        goodreads_recommendations = book.recommendations[:k]
+
+        precision, average_precision = evaluation.evaluate_precision(
+            goodreads_recommendations, calculated_recommendations)
+
+        result = {
+            "book_url": compressed_url,
+            "goodreads_recommendations": goodreads_recommendations,
+            "calculated_recommendations": calculated_recommendations,
+            "precision": precision,
+            "average_precision": average_precision,
+            "latency": time.time() - start_time
+        }
+        metrics.observe("query", result["latency"])
+        self.result_cache.put(result_key, result)
+        return result
@@ -0,0 +1,338 @@
+import heapq
+import numpy as np
+from typing import List, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from vectorization import Vector, VectorMatrix
+
+# Upper bounds are loosened by this factor, so that rounding errors never prune a book
+UPPER_BOUND_SLACK = 1 + 1e-9
+
+
+def select_top_k(scores: np.ndarray, book_urls: List[str], k: int, excluded_rows=(), rows: np.ndarray = None) -> List[Tuple[float, str]]:
+    '''
+        Returns the k best (score, book_url) pairs in descending order, skipping excluded_rows
+        If rows is given, scores[i] is the score of rows[i], otherwise of row i
+        Candidates are selected with partial selection, only they are sorted
+        Ties are ordered by book_url, the same as sorting all (score, book_url) pairs
+    '''
+    scores = np.array(scores, dtype=np.float64)
+    if rows is None:
+        rows = np.arange(len(scores))
+    excluded_rows = [row for row in excluded_rows if row is not None]
+    scores[np.isin(rows, excluded_rows)] = -np.inf
+    k = min(k, int(np.count_nonzero(scores > -np.inf)))
+    if k <= 0:
+        return []
+
+    # Every row with a score higher than the k-th best score is in top-k,
+    # rows tied with the k-th best score are also candidates
+    kth_score = np.partition(scores, len(scores) - k)[len(scores) - k]
+    candidates = np.flatnonzero(scores >= kth_score)
+    ranked = sorted(((scores[index], book_urls[rows[index]])
+                    for index in candidates.tolist()), reverse=True)
+    return [(float(score), book_url) for score, book_url in ranked[:k]]
+
+
+def get_kth_score(scores: np.ndarray, k: int) -> float:
+    '''
+        Returns the k-th highest score, or 0 if there are less than k scores
+    '''
+    if len(scores) < k or k <= 0:
+        return 0.0
+    return float(np.partition(scores, len(scores) - k)[len(scores) - k])
+
+
+def score_field(matrix: 'VectorMatrix', vector: 'Vector', rows: np.ndarray) -> np.ndarray:
+    '''
+        Returns the cosine similarities of the rows with the vector,
+        adding the products in the same order as VectorMatrix.calculate_similarities
+    '''
+    dot_products = np.zeros(len(rows), dtype=np.float64)
+    for index, weight in vector.weight_dict.items():
+        column_rows, column_data = matrix.get_column(index)
+        if len(column_rows) == 0:
+            continue
+        positions = np.minimum(np.searchsorted(
+            column_rows, rows), len(column_rows) - 1)
+        found = column_rows[positions] == rows
+        dot_products[found] += column_data[positions[found]
+                                           ].astype(np.float64) * weight
+
+    size_products = matrix.norms[rows] * vector.get_size()
+    similarities = np.zeros(len(rows), dtype=np.float64)
+    np.divide(dot_products, size_products,
+              out=similarities, where=size_products != 0)
+    return similarities
+
+
+def fill_zero_scores(top_similarities: List[Tuple[float, str]], book_urls: List[str], k: int, skipped_rows: set) -> List[Tuple[float, str]]:
+    '''
+        Books sharing no term with the query have 0 similarity,
+        they fill the ranking if there are less than k scored books
+    '''
+    if len(top_similarities) < k:
+        zero_urls = heapq.nlargest(k - len(top_similarities), (book_url for row, book_url in enumerate(book_urls)
+                                                              if row not in skipped_rows))
+        top_similarities += [(0.0, book_url) for book_url in zero_urls]
+    return top_similarities
+
+
+class MaxScoreRetriever():
+    '''
+        Finds the top-k books of a query by walking only the postings (columns)
+        of the query's terms, instead of scoring every book.
+
+        Terms are visited in decreasing order of their maximum possible contribution.
+        Once the contributions of the remaining terms cannot lift an unseen book
+        above the current k-th score, no new books are accepted, and seen books
+        that cannot reach it anymore are dropped (MaxScore).
+        Surviving books are rescored exactly, so the ranking is equal to scoring every book.
+    '''
+
+    def __init__(self, description_vectors: 'VectorMatrix', genre_vectors: 'VectorMatrix', description_weight: float, genre_weight: float):
+        if description_weight < 0 or genre_weight < 0:
+            raise ValueError(
+                "The MaxScore algorithm needs non-negative field weights")
+        self.description_vectors = description_vectors
+        self.genre_vectors = genre_vectors
+        self.description_weight = description_weight
+        self.genre_weight = genre_weight
+        self.description_vectors.build_columns()
+        self.genre_vectors.build_columns()
+
+    def get_query_terms(self, description_vector: 'Vector', genre_vector: 'Vector') -> list:
+        '''
+            Returns (upper_bound, rows, contributions) of every query term,
+            sorted by upper_bound in descending order
+        '''
+        terms = []
+        fields = [(self.description_weight, self.description_vectors, description_vector),
+                  (self.genre_weight, self.genre_vectors, genre_vector)]
+        for field_weight, matrix, vector in fields:
+            query_size = vector.get_size()
+            if field_weight == 0 or query_size == 0:
+                continue
+            for index, weight in vector.weight_dict.items():
+                rows, data = matrix.get_column(index)
+                if len(rows) == 0:
+                    continue
+                contributions = field_weight * weight * \
+                    data.astype(np.float64) / (matrix.norms[rows] * query_size)
+                upper_bound = field_weight * weight * \
+                    matrix.column_max_weights[index] / query_size
+                terms.append((upper_bound, rows, contributions))
+        terms.sort(key=lambda term: term[0], reverse=True)
+        return terms
+
+    def retrieve(self, description_vector: 'Vector', genre_vector: 'Vector', k: int, excluded_rows=()) -> List[Tuple[float, str]]:
+        '''
+            Returns the k most similar (similarity, book_url) pairs in descending order
+        '''
+        terms = self.get_query_terms(description_vector, genre_vector)
+        excluded_rows = np.array(
+            [row for row in excluded_rows if row is not None], dtype=np.int64)
+
+        # remaining_bounds[i] is the highest score that terms[i:] can add to a book
+        remaining_bounds = np.zeros(len(terms) + 1, dtype=np.float64)
+        for i in range(len(terms) - 1, -1, -1):
+            remaining_bounds[i] = remaining_bounds[i + 1] + terms[i][0]
+
+        candidate_rows = np.zeros(0, dtype=np.int64)
+        partial_scores = np.zeros(0, dtype=np.float64)
+        threshold = 0.0
+
+        # Accept new books as long as an unseen book can still reach the k-th score
+        term_index = 0
+        while term_index < len(terms):
+            if threshold > 0 and remaining_bounds[term_index] * UPPER_BOUND_SLACK < threshold:
+                break
+            _, rows, contributions = terms[term_index]
+            merged_rows, inverse = np.unique(np.concatenate(
+                (candidate_rows, rows)), return_inverse=True)
+            partial_scores = np.bincount(inverse, weights=np.concatenate(
+                (partial_scores, contributions)), minlength=len(merged_rows))
+            candidate_rows = merged_rows
+            threshold = get_kth_score(
+                partial_scores[~np.isin(candidate_rows, excluded_rows)], k)
+            term_index += 1
+
+        # Remaining terms only add to the seen books which can still reach the k-th score
+        for term_index in range(term_index, len(terms)):
+            reachable = partial_scores + \
+                remaining_bounds[term_index] * \
+                UPPER_BOUND_SLACK >= threshold
+            candidate_rows, partial_scores = candidate_rows[reachable], partial_scores[reachable]
+            _, rows, contributions = terms[term_index]
+            positions = np.minimum(np.searchsorted(
+                rows, candidate_rows), len(rows) - 1)
+            found = rows[positions] == candidate_rows
+            partial_scores[found] += contributions[positions[found]]
+            threshold = max(threshold, get_kth_score(
+                partial_scores[~np.isin(candidate_rows, excluded_rows)], k))
+
+        # Rescore the candidates exactly
+        scores = self.description_weight * score_field(self.description_vectors, description_vector, candidate_rows) + \
+            self.genre_weight * \
+            score_field(self.genre_vectors, genre_vector, candidate_rows)
+        book_urls = self.description_vectors.book_urls
+        top_similarities = select_top_k(
+            scores, book_urls, k, excluded_rows.tolist(), rows=candidate_rows)
+
+        skipped_rows = set(candidate_rows.tolist()) | set(
+            excluded_rows.tolist())
+        return fill_zero_scores(top_similarities, book_urls, k, skipped_rows)
+
+
+class ThresholdRetriever():
+    '''
+        Finds the top-k books of a query with Fagin's threshold algorithm (TA)
+        over the description and the genre rankings.
+
+        Every field has a sorted access list: the books sharing a term with the query in
+        decreasing order of their similarity in the field. A list is built from the columns
+        of the query terms of its field only when it is first read, and it is read in batches
+        of doubling size. Books read from a list are scored in the other field by random access,
+        from the other field's list if it is built, by looking them up in the columns of the
+        query terms otherwise, or by building the list if that visits less entries.
+
+        The threshold is the weighted sum of the highest similarity that is not read yet of every
+        list, or of an upper bound of the field's similarity from column_max_weights while its list
+        is not built. No unseen book can score above it. The list with the largest weighted term
+        in the threshold is read next, so the weaker field is often only accessed randomly,
+        and reading stops once the k-th fused score is above the threshold.
+    '''
+
+    def __init__(self, description_vectors: 'VectorMatrix', genre_vectors: 'VectorMatrix', description_weight: float, genre_weight: float):
+        if description_weight < 0 or genre_weight < 0:
+            raise ValueError(
+                "The threshold algorithm needs non-negative field weights")
+        self.description_vectors = description_vectors
+        self.genre_vectors = genre_vectors
+        self.description_weight = description_weight
+        self.genre_weight = genre_weight
+        self.description_vectors.build_columns()
+        self.genre_vectors.build_columns()
+
+    def get_upper_bound(self, matrix: 'VectorMatrix', vector: 'Vector') -> float:
+        '''
+            Returns the highest similarity a book can have with the vector in the field
+        '''
+        query_size = vector.get_size()
+        if query_size == 0:
+            return 0.0
+        bound = sum(weight * float(matrix.column_max_weights[index])
+                    for index, weight in vector.weight_dict.items() if index < matrix.vocabulary_size)
+        return min(bound / query_size, 1.0) * UPPER_BOUND_SLACK
+
+    def get_posting_count(self, matrix: 'VectorMatrix', vector: 'Vector') -> int:
+        '''
+            Returns the number of entries in the columns of the vector's indices
+        '''
+        indices = np.fromiter(vector.weight_dict, dtype=np.int64,
+                              count=len(vector.weight_dict))
+        indices = indices[indices < matrix.vocabulary_size]
+        return int((matrix.column_indptr[indices + 1] - matrix.column_indptr[indices]).sum())
+
+    def get_sorted_list(self, matrix: 'VectorMatrix', vector: 'Vector') -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        '''
+            Returns (rows, similarities) of the books sharing a term with the vector and the similarities of all rows,
+            the products are added in the same order as VectorMatrix.calculate_similarities
+        '''
+        rows, products = [], []
+        for index, weight in vector.weight_dict.items():
+            column_rows, column_data = matrix.get_column(index)
+            rows.append(column_rows)
+            products.append(column_data.astype(np.float64) * weight)
+        all_similarities = np.zeros(len(matrix.book_urls), dtype=np.float64)
+        if len(rows) == 0:
+            return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64), all_similarities)
+        dot_products = np.bincount(np.concatenate(rows), weights=np.concatenate(
+            products), minlength=len(matrix.book_urls))
+        rows = np.flatnonzero(dot_products)
+        size_products = matrix.norms[rows] * vector.get_size()
+        similarities = np.zeros(len(rows), dtype=np.float64)
+        np.divide(dot_products[rows], size_products,
+                  out=similarities, where=size_products != 0)
+        all_similarities[rows] = similarities
+        return (rows, similarities, all_similarities)
+
+    def read_sorted_list(self, sorted_list: Tuple[np.ndarray, np.ndarray], start: int, end: int) -> Tuple[np.ndarray, np.ndarray, float]:
+        '''
+            Returns the rows and similarities at positions start:end of the list in decreasing order of similarity
+            and increasing order of row, and the highest similarity after end, 0 if the list ends
+        '''
+        rows, similarities, _ = sorted_list
+        if end < len(rows):
+            # All rows tied with the end-th similarity are sorted, so that every read sees the same order
+            partitioned = -np.partition(-similarities, [end - 1, end])
+            top = np.flatnonzero(similarities >= partitioned[end - 1])
+            level = float(partitioned[end])
+        else:
+            top = np.arange(len(rows))
+            level = 0.0
+        top = top[np.lexsort((rows[top], -similarities[top]))]
+        return (rows[top[start:end]], similarities[top[start:end]], level)
+
+    def retrieve(self, description_vector: 'Vector', genre_vector: 'Vector', k: int, excluded_rows=()) -> List[Tuple[float, str]]:
+        '''
+            Returns the k most similar (similarity, book_url) pairs in descending order
+        '''
+        excluded_rows = np.array(
+            [row for row in excluded_rows if row is not None], dtype=np.int64)
+        fields = [(self.description_weight, self.description_vectors, description_vector),
+                  (self.genre_weight, self.genre_vectors, genre_vector)]
+        levels = [self.get_upper_bound(matrix, vector) if field_weight > 0 else 0.0
+                  for field_weight, matrix, vector in fields]
+        sorted_lists = [None] * len(fields)
+        depths = [0] * len(fields)
+
+        seen_rows = np.zeros(0, dtype=np.int64)
+        fused_scores = np.zeros(0, dtype=np.float64)
+        while True:
+            threshold = sum(field_weight * level for (field_weight, _, _),
+                            level in zip(fields, levels))
+            kth_score = get_kth_score(
+                fused_scores[~np.isin(seen_rows, excluded_rows)], k)
+            if threshold == 0 or threshold * UPPER_BOUND_SLACK < kth_score:
+                break
+
+            # Read the list that keeps the threshold highest
+            field = max(range(len(fields)),
+                        key=lambda field: fields[field][0] * levels[field])
+            _, matrix, vector = fields[field]
+            if sorted_lists[field] is None:
+                sorted_lists[field] = self.get_sorted_list(matrix, vector)
+            start = depths[field]
+            depths[field] = max(2 * start, k)
+            rows, _, levels[field] = self.read_sorted_list(
+                sorted_lists[field], start, depths[field])
+
+            rows = rows[~np.isin(rows, seen_rows)]
+            if len(rows) == 0:
+                continue
+            field_similarities = []
+            for other_field, (other_weight, other_matrix, other_vector) in enumerate(fields):
+                if other_weight == 0:
+                    # Fields of 0 weight add nothing, they are not scored
+                    field_similarities.append(np.zeros(len(rows)))
+                    continue
+                if sorted_lists[other_field] is None and \
+                        len(other_vector.weight_dict) * len(rows) > self.get_posting_count(other_matrix, other_vector):
+                    sorted_lists[other_field] = self.get_sorted_list(
+                        other_matrix, other_vector)
+                if sorted_lists[other_field] is not None:
+                    field_similarities.append(
+                        sorted_lists[other_field][2][rows])
+                else:
+                    field_similarities.append(score_field(
+                        other_matrix, other_vector, rows))
+            seen_rows = np.concatenate((seen_rows, rows))
+            fused_scores = np.concatenate((fused_scores, self.description_weight * field_similarities[0] +
+                                           self.genre_weight * field_similarities[1]))
+
+        book_urls = self.description_vectors.book_urls
+        top_similarities = select_top_k(
+            fused_scores, book_urls, k, excluded_rows.tolist(), rows=seen_rows)
+        skipped_rows = set(seen_rows.tolist()) | set(excluded_rows.tolist())
+        return fill_zero_scores(top_similarities, book_urls, k, skipped_rows)
@@ -0,0 +1,154 @@
+import json
+import socket
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from recommender import Recommender, RECOMMENDATION_COUNT
+from metrics import metrics
+from sharding import ShardCoordinator
+
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8493
+
+
+class RecommendationRequestHandler(BaseHTTPRequestHandler):
+    '''
+        Answers GET /recommendations?url=book-url&k=18&engine=exhaustive&genres=0&weights=0.5,0.5 requests with JSON,
+        genres is the number of genres a recommended book must share with the queried book,
+        weights are the description and genre weights of the similarity, the index's weights by default,
+        GET /stats returns the hit and miss counters of the caches,
+        GET /metrics returns the counters and histograms of the process in the Prometheus text format
+    '''
+
+    def do_GET(self):
+        start_time = time.time()
+        parsed_url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(parsed_url.query)
+
+        if parsed_url.path == "/health":
+            self.send_json(200, {"status": "ok"})
+            return
+
+        if parsed_url.path == "/stats":
+            self.send_json(200, self.server.recommender.get_cache_stats())
+            return
+
+        if parsed_url.path == "/metrics":
+            body = metrics.to_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        if parsed_url.path != "/recommendations" or "url" not in query:
+            self.send_json(
+                400, {"error": "Usage: /recommendations?url=book-url&k=18"})
+            return
+
+        try:
+            k = int(query.get("k", [RECOMMENDATION_COUNT])[0])
+            min_genre_overlap = int(query.get("genres", [0])[0])
+        except ValueError:
+            self.send_json(400, {"error": "k and genres must be integers"})
+            return
+
+        field_weights = None
+        if "weights" in query:
+            try:
+                field_weights = tuple(float(weight)
+                                      for weight in query["weights"][0].split(","))
+            except ValueError:
+                field_weights = ()
+            if len(field_weights) != 2 or min(field_weights) < 0:
+                self.send_json(
+                    400, {"error": "weights must be two non-negative numbers: description,genre"})
+                return
+
+        engine = query.get("engine", ["exhaustive"])[0]
+        try:
+            result = self.server.recommender.get_recommendations(
+                query["url"][0], k=k, engine=engine, min_genre_overlap=min_genre_overlap, field_weights=field_weights)
+        except ValueError as error:
+            self.send_json(400, {"error": str(error)})
+            return
+        except RuntimeError as error:
+            # Shards are not assigned
+            self.send_json(503, {"error": str(error)})
+            return
+        result["latency"] = time.time() - start_time
+        self.send_json(404 if "error" in result else 200, result)
+        self.log_message("%s answered in %.4f seconds",
+                         result["book_url"], result["latency"])
+
+    def send_json(self, status: int, content: dict):
+        body = json.dumps(content).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class RecommendationServer(ThreadingHTTPServer):
+    '''
+        Local HTTP server that loads the books and vectors once,
+        then answers recommendation queries concurrently
+    '''
+    daemon_threads = True
+
+    def __init__(self, recommender: Recommender, host: str = SERVER_HOST, port: int = SERVER_PORT):
+        self.recommender = recommender
+        super().__init__((host, port), RecommendationRequestHandler)
+
+
+def run_server(host: str = SERVER_HOST, port: int = SERVER_PORT, shards: int = 0):
+    '''
+        Loads the index and serves recommendations until interrupted
+        With shards > 0, queries are scored by that many local shard worker processes
+    '''
+    print("Loading books and vectors...")
+    start_time = time.time()
+    shard_coordinator = ShardCoordinator(shard_count=shards) if shards > 0 else None
+    recommender = Recommender(shard_coordinator=shard_coordinator)
+    print(f"Loaded in {time.time() - start_time} seconds")
+
+    if shard_coordinator is not None:
+        # Rows are moved from slower shards to faster ones while serving
+        threading.Thread(target=shard_coordinator.rebalance_periodically, daemon=True).start()
+
+    with RecommendationServer(recommender, host, port) as server:
+        print(f"Serving recommendations on http://{host}:{port}/recommendations?url=book-url")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print("Shutting down the server...")
+    if shard_coordinator is not None:
+        shard_coordinator.close()
+
+
+def is_server_running(host: str = SERVER_HOST, port: int = SERVER_PORT) -> bool:
+    '''
+        Returns True if something accepts connections on host:port
+    '''
+    try:
+        with socket.create_connection((host, port), timeout=0.2):
+            return True
+    except OSError:
+        return False
+
+
+def request_recommendations(book_url: str, k: int = RECOMMENDATION_COUNT, host: str = SERVER_HOST, port: int = SERVER_PORT) -> dict:
+    '''
+        Asks the running server for the recommendations of book_url
+    '''
+    query = urllib.parse.urlencode({"url": book_url, "k": k})
+    try:
+        with urllib.request.urlopen(f"http://{host}:{port}/recommendations?{query}", timeout=120) as response:
+            return json.loads(response.read().decode("utf-8"))
+    except urllib.error.HTTPError as e:
+        return json.loads(e.read().decode("utf-8"))
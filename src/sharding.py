@@ -0,0 +1,483 @@
+import json
+import multiprocessing
+import socket
+import socketserver
+import struct
+import threading
+import time
+import numpy as np
+import utils
+from concurrent.futures import ThreadPoolExecutor
+from book import Book
+from index import INDEX_FILE
+from metrics import Histogram
+from vectorization import BookVectorizer, Vector
+from typing import List, Tuple
+
+SHARD_HOST = "127.0.0.1"
+SHARD_PORT = 8494
+
+# Engines that a shard answers exactly, the merged top-k is equal to the top-k of the whole index
+SHARD_ENGINES = ('exhaustive', 'maxscore', 'threshold')
+
+# Length of the messages in bytes
+MESSAGE_HEADER_FORMAT = "<I"
+
+# Seconds between rebalances of the server, queries every shard must have answered since the last one,
+# and the difference of the mean worker times of the shards that is left as it is
+REBALANCE_INTERVAL = 60
+REBALANCE_MIN_QUERIES = 100
+REBALANCE_TOLERANCE = 0.1
+
+
+def receive_exactly(connection: socket.socket, size: int) -> bytes:
+    chunks = []
+    while size > 0:
+        chunk = connection.recv(min(size, 1 << 20))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def send_message(connection: socket.socket, message: dict):
+    '''
+        Sends the message as JSON after its length
+    '''
+    data = json.dumps(message).encode("utf-8")
+    connection.sendall(struct.pack(MESSAGE_HEADER_FORMAT, len(data)) + data)
+
+
+def receive_message(connection: socket.socket) -> dict:
+    size, = struct.unpack(MESSAGE_HEADER_FORMAT, receive_exactly(
+        connection, struct.calcsize(MESSAGE_HEADER_FORMAT)))
+    return json.loads(receive_exactly(connection, size).decode("utf-8"))
+
+
+def encode_vector(vector: Vector) -> dict:
+    return {"indices": list(vector.weight_dict.keys()), "weights": list(vector.weight_dict.values()),
+            "size": vector.get_size()}
+
+
+def decode_vector(message: dict, vocabulary_size: int) -> Vector:
+    return Vector(vocabulary_size, dict(zip(message["indices"], message["weights"])), message["size"])
+
+
+def get_row_costs(book_vectorizer: BookVectorizer) -> np.ndarray:
+    '''
+        Returns the non-zeros of every row in both fields, scoring a row costs in proportion to them
+    '''
+    return np.diff(book_vectorizer.description_vectors.indptr) + np.diff(book_vectorizer.genre_vectors.indptr)
+
+
+def assign_shards(row_costs: np.ndarray, shares: List[float]) -> List[Tuple[int, int]]:
+    '''
+        Splits the rows into consecutive (start, end) ranges, one per share,
+        so that the cost of each range is proportional to its share
+    '''
+    cumulative_costs = np.cumsum(row_costs, dtype=np.float64)
+    total_cost = cumulative_costs[-1] if len(cumulative_costs) > 0 else 0
+    cumulative_shares = np.cumsum(shares, dtype=np.float64) / sum(shares)
+    ends = [int(np.searchsorted(cumulative_costs, total_cost * share, side="right"))
+            for share in cumulative_shares[:-1]] + [len(row_costs)]
+    starts = [0] + ends[:-1]
+    return [(start, max(start, end)) for start, end in zip(starts, ends)]
+
+
+class ShardRequestHandler(socketserver.StreamRequestHandler):
+    '''
+        Answers the messages of a connection until it is closed:
+            {"op": "load", "start": row, "end": row} -> {"checksum": index checksum, "rows": row count}
+            {"op": "query", "description": vector, "genre": vector, "k": k, "excluded_urls": urls, "engine": engine,
+             "min_genre_overlap": genres, "field_weights": [description weight, genre weight]}
+                -> {"results": [[score, book_url], ...], "elapsed": seconds}
+            {"op": "shutdown"} -> {}
+    '''
+
+    def handle(self):
+        while True:
+            try:
+                message = receive_message(self.request)
+            except ConnectionError:
+                return
+            try:
+                response = self.server.shard_worker.answer(message)
+            except Exception as e:
+                response = {"error": f"{type(e).__name__}: {e}"}
+            send_message(self.request, response)
+            if message.get("op") == "shutdown":
+                threading.Thread(target=self.server.shutdown).start()
+                return
+
+
+class ShardServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, shard_worker: 'ShardWorker', host: str, port: int):
+        self.shard_worker = shard_worker
+        super().__init__((host, port), ShardRequestHandler)
+
+
+class ShardWorker():
+    '''
+        Serves the top-k queries of a range of rows of the index file.
+        The rows are views of the mapped file, so loading another range copies nothing.
+    '''
+
+    def __init__(self, index_file: str = INDEX_FILE):
+        self.index_file = index_file
+        self.book_vectorizer: BookVectorizer = None
+
+    def load(self, start: int, end: int) -> dict:
+        '''
+            Maps the index file again, so that a rebuilt index is served, and keeps rows start:end
+        '''
+        book_vectorizer = BookVectorizer(index_file=self.index_file)
+        book_vectorizer.description_vectors = book_vectorizer.description_vectors.get_row_range(
+            start, end)
+        book_vectorizer.genre_vectors = book_vectorizer.genre_vectors.get_row_range(
+            start, end)
+        # Columns of the range are built again, with the quantization of the index file
+        book_vectorizer.description_vectors.quantize_columns(
+            book_vectorizer.quantization)
+        book_vectorizer.genre_vectors.quantize_columns(
+            book_vectorizer.quantization)
+        self.book_vectorizer = book_vectorizer
+        return {"checksum": book_vectorizer.get_index_version(), "rows": end - start}
+
+    def answer(self, message: dict) -> dict:
+        op = message.get("op")
+        if op == "load":
+            return self.load(message["start"], message["end"])
+        if op == "query":
+            start_time = time.perf_counter()
+            book_vectorizer = self.book_vectorizer
+            results = book_vectorizer.calculate_top_k_of_vectors(
+                decode_vector(message["description"],
+                              book_vectorizer.description_vectors.vocabulary_size),
+                decode_vector(message["genre"],
+                              book_vectorizer.genre_vectors.vocabulary_size),
+                k=message["k"], excluded_urls=message["excluded_urls"], engine=message["engine"],
+                min_genre_overlap=message.get("min_genre_overlap", 0), field_weights=message.get("field_weights"))
+            return {"results": results, "elapsed": time.perf_counter() - start_time}
+        if op == "shutdown":
+            return {}
+        raise ValueError(f"Unknown op {op}")
+
+
+def run_shard_worker(index_file: str = INDEX_FILE, host: str = SHARD_HOST, port: int = SHARD_PORT, ready_queue=None):
+    '''
+        Serves a shard until a shutdown message, the coordinator tells it which rows to load
+        If ready_queue is given, the port is put into it once the server listens
+    '''
+    shard_server = ShardServer(ShardWorker(index_file), host, port)
+    if ready_queue is not None:
+        ready_queue.put(shard_server.server_address[1])
+    else:
+        print(f"Shard worker is listening on {host}:{shard_server.server_address[1]}")
+    with shard_server:
+        shard_server.serve_forever()
+
+
+class ShardClient():
+    '''
+        Connection of the coordinator to a shard worker, one request at a time
+    '''
+
+    def __init__(self, address: Tuple[str, int], timeout: float = 60):
+        self.address = address
+        self.timeout = timeout
+        self.connection: socket.socket = None
+        self.lock = threading.Lock()
+        # Rows of the shard and latencies of its queries
+        self.start = 0
+        self.end = 0
+        self.latencies = Histogram()
+        self.worker_elapsed = 0.0
+        self.stats_lock = threading.Lock()
+
+    def observe(self, latency: float, worker_elapsed: float):
+        with self.stats_lock:
+            self.latencies.observe(latency)
+            self.worker_elapsed += worker_elapsed
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.latencies = Histogram()
+            self.worker_elapsed = 0.0
+
+    def get_query_stats(self) -> Tuple[int, float]:
+        '''
+            Returns the number of queries and the worker time of the shard since it was assigned
+        '''
+        with self.stats_lock:
+            return self.latencies.count, self.worker_elapsed
+
+    def request(self, message: dict) -> dict:
+        with self.lock:
+            # Reconnect once if the connection was closed by the worker or the network
+            for attempt in range(2):
+                try:
+                    if self.connection is None:
+                        self.connection = socket.create_connection(
+                            self.address, timeout=self.timeout)
+                        self.connection.setsockopt(
+                            socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    send_message(self.connection, message)
+                    response = receive_message(self.connection)
+                    break
+                except (OSError, ConnectionError):
+                    self.close()
+                    if attempt == 1:
+                        raise
+        if "error" in response:
+            raise RuntimeError(
+                f"Shard {self.address[0]}:{self.address[1]} failed: {response['error']}")
+        return response
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class ShardCoordinator():
+    '''
+        Splits the rows of the index file into consecutive shards served by shard workers,
+        scatters every query vector to all shards and merges their top-k lists.
+
+        A shard returns its exact top-k with the same scores as the whole index,
+        so the k best of the merged lists, ordered like select_top_k, are the exact top-k.
+        Workers are started as local processes, or run on other nodes with
+        'main.py shard-worker [port]' and are given as (host, port) addresses.
+        Shards are assigned by the non-zeros of their rows, and rebalance moves rows
+        from slower shards to faster ones by their measured latencies.
+
+        Shards are reassigned while no query is in flight: a query sent to some shards before
+        and to others after their rows changed would miss or repeat rows. Queries wait for
+        a reassignment, and a reassignment waits for the queries in flight.
+        If a shard cannot load its new rows, all shards load their previous rows again,
+        and if that fails too, queries raise RuntimeError until a reassignment succeeds.
+    '''
+
+    def __init__(self, index_file: str = INDEX_FILE, shard_count: int = None, addresses: List[Tuple[str, int]] = None):
+        self.index_file = index_file
+        self.processes = []
+        if addresses is None:
+            addresses = self.start_local_workers(
+                shard_count or multiprocessing.cpu_count())
+        self.shard_clients = [ShardClient(address) for address in addresses]
+        self.executor = ThreadPoolExecutor(len(self.shard_clients))
+        # Queries in flight and whether the shards are being reassigned
+        self.assignment_condition = threading.Condition()
+        self.active_queries = 0
+        self.assigning = False
+        # Whether every shard serves the rows of its shard_client
+        self.assigned = False
+        self.book_vectorizer: BookVectorizer = None
+        self.stop_rebalancing = threading.Event()
+        self.load_index()
+
+    def start_local_workers(self, shard_count: int) -> List[Tuple[str, int]]:
+        ready_queue = multiprocessing.Queue()
+        for _ in range(shard_count):
+            process = multiprocessing.Process(target=run_shard_worker, args=(
+                utils.get_file_path(self.index_file), SHARD_HOST, 0, ready_queue), daemon=True)
+            process.start()
+            self.processes.append(process)
+        return [(SHARD_HOST, ready_queue.get()) for _ in range(shard_count)]
+
+    def load_index(self):
+        '''
+            Maps the index file and assigns the shards by the non-zeros of their rows,
+            it is called again after the index file is rebuilt
+        '''
+        book_vectorizer = BookVectorizer(index_file=self.index_file)
+        self.assign([1] * len(self.shard_clients), book_vectorizer)
+
+    def start_query(self):
+        with self.assignment_condition:
+            while self.assigning:
+                self.assignment_condition.wait()
+            if not self.assigned:
+                raise RuntimeError(
+                    "Shards are not assigned, a reassignment failed")
+            self.active_queries += 1
+
+    def finish_query(self):
+        with self.assignment_condition:
+            self.active_queries -= 1
+            self.assignment_condition.notify_all()
+
+    def load_shards(self, ranges: List[Tuple[int, int]], checksum: int) -> List[str]:
+        '''
+            Sends every shard its range of rows, returns the errors of the shards that could not load it
+        '''
+        def load_shard(shard_client: ShardClient, row_range: Tuple[int, int]) -> str:
+            address = f"{shard_client.address[0]}:{shard_client.address[1]}"
+            try:
+                response = shard_client.request(
+                    {"op": "load", "start": row_range[0], "end": row_range[1]})
+            except (OSError, ConnectionError, RuntimeError) as e:
+                return f"Shard {address} could not load rows {row_range[0]}-{row_range[1]}, {type(e).__name__}: {e}"
+            if response["checksum"] != checksum:
+                return f"Shard {address} has another index file"
+            return None
+        errors = self.executor.map(load_shard, self.shard_clients, ranges)
+        return [error for error in errors if error is not None]
+
+    def assign(self, shares: List[float], book_vectorizer: BookVectorizer = None):
+        '''
+            Gives every shard a range of rows of book_vectorizer's index, the current index by default,
+            with a cost proportional to its share. It waits for the queries in flight, new queries wait for it.
+        '''
+        with self.assignment_condition:
+            while self.assigning:
+                self.assignment_condition.wait()
+            self.assigning = True
+            while self.active_queries > 0:
+                self.assignment_condition.wait()
+        try:
+            book_vectorizer = book_vectorizer or self.book_vectorizer
+            ranges = assign_shards(get_row_costs(book_vectorizer), shares)
+            checksum = book_vectorizer.get_index_version()
+            errors = self.load_shards(ranges, checksum)
+            if errors:
+                previous_ranges = [(shard_client.start, shard_client.end)
+                                   for shard_client in self.shard_clients]
+                if self.assigned and not self.load_shards(previous_ranges, self.book_vectorizer.get_index_version()):
+                    raise RuntimeError(
+                        "Shards could not be reassigned, they serve their previous rows: " + "; ".join(errors))
+                # Queries fail until the shards are assigned book_vectorizer's index
+                self.assigned = False
+                self.book_vectorizer = book_vectorizer
+                raise RuntimeError(
+                    "Shards could not be reassigned, no query is answered until they are: " + "; ".join(errors))
+            for shard_client, (start, end) in zip(self.shard_clients, ranges):
+                shard_client.start, shard_client.end = start, end
+                shard_client.reset_stats()
+            # Queries are vectorized with the index the shards serve
+            self.book_vectorizer = book_vectorizer
+            self.assigned = True
+        finally:
+            with self.assignment_condition:
+                self.assigning = False
+                self.assignment_condition.notify_all()
+
+    def rebalance(self, min_queries: int = 1, tolerance: float = 0) -> bool:
+        '''
+            Reassigns the rows, so that every shard is expected to take the same time per query.
+            The speed of a shard is the cost of its rows per second of its worker's query time.
+            Returns False without reassigning if a shard answered fewer than min_queries queries,
+            or the mean worker times of the shards differ by at most tolerance.
+            Shards that are not assigned after a failed reassignment are assigned equal shares again.
+        '''
+        if not self.assigned:
+            self.assign([1] * len(self.shard_clients))
+            return True
+        query_stats = [shard_client.get_query_stats()
+                       for shard_client in self.shard_clients]
+        if any(count < min_queries for count, _ in query_stats):
+            return False
+        mean_times = [worker_elapsed / count for count, worker_elapsed in query_stats]
+        if min(mean_times) > 0 and max(mean_times) <= min(mean_times) * (1 + tolerance):
+            return False
+        row_costs = get_row_costs(self.book_vectorizer)
+        speeds = []
+        for shard_client, (count, worker_elapsed) in zip(self.shard_clients, query_stats):
+            cost = float(row_costs[shard_client.start:shard_client.end].sum())
+            if count == 0 or worker_elapsed == 0 or cost == 0:
+                speeds.append(None)
+            else:
+                speeds.append(cost * count / worker_elapsed)
+        measured = [speed for speed in speeds if speed is not None]
+        if not measured:
+            return False
+        # Shards without measurements are taken as fast as the average
+        average_speed = sum(measured) / len(measured)
+        self.assign([average_speed if speed is None else speed for speed in speeds])
+        return True
+
+    def rebalance_periodically(self, interval: float = REBALANCE_INTERVAL, min_queries: int = REBALANCE_MIN_QUERIES,
+                               tolerance: float = REBALANCE_TOLERANCE):
+        '''
+            Rebalances the shards every interval seconds until close, runs in a thread of the server
+        '''
+        while not self.stop_rebalancing.wait(interval):
+            try:
+                if self.rebalance(min_queries, tolerance):
+                    print("Shards are rebalanced: " + ", ".join(
+                        f"{shard_client.start}-{shard_client.end}" for shard_client in self.shard_clients))
+            except (OSError, ConnectionError, RuntimeError, ValueError) as e:
+                print(f"Shards could not be rebalanced, {type(e).__name__}: {e}")
+
+    def query_shard(self, shard_client: ShardClient, message: dict) -> List[Tuple[float, str]]:
+        start_time = time.perf_counter()
+        response = shard_client.request(message)
+        shard_client.observe(time.perf_counter() - start_time,
+                             response["elapsed"])
+        return [(score, book_url) for score, book_url in response["results"]]
+
+    def calculate_top_k_similarities(self, book: Book, k: int = 18, excluded_urls: List[str] = (), engine: str = 'exhaustive',
+                                     min_genre_overlap: int = 0, field_weights: Tuple[float, float] = None) -> List[Tuple[float, str]]:
+        '''
+            Returns the k most similar (similarity, book_url) pairs of the whole index in descending order
+        '''
+        if engine not in SHARD_ENGINES:
+            raise ValueError(
+                f"Engine {engine} is not supported by shards, expected one of {SHARD_ENGINES}")
+        self.start_query()
+        try:
+            book_vectorizer = self.book_vectorizer
+            description_vector, genre_vector = book_vectorizer.vectorize_query(
+                book)
+            message = {"op": "query", "description": encode_vector(description_vector),
+                       "genre": encode_vector(genre_vector), "k": k,
+                       "excluded_urls": list(excluded_urls), "engine": engine, "min_genre_overlap": min_genre_overlap,
+                       "field_weights": list(book_vectorizer.get_field_weights(field_weights))}
+            shard_results = list(self.executor.map(
+                lambda shard_client: self.query_shard(shard_client, message), self.shard_clients))
+        finally:
+            self.finish_query()
+        # Ordered like select_top_k, ties by book_url
+        merged = sorted((result for results in shard_results for result in results),
+                        reverse=True)
+        return merged[:k]
+
+    def get_stats(self) -> List[dict]:
+        '''
+            Returns the rows and the query latencies of every shard in seconds
+        '''
+        stats = []
+        for shard_client in self.shard_clients:
+            with shard_client.stats_lock:
+                latencies, worker_elapsed = shard_client.latencies, shard_client.worker_elapsed
+            stats.append({
+                "address": f"{shard_client.address[0]}:{shard_client.address[1]}",
+                "start": shard_client.start,
+                "end": shard_client.end,
+                "queries": latencies.count,
+                "mean_latency": latencies.sum / latencies.count if latencies.count else 0,
+                "mean_worker_time": worker_elapsed / latencies.count if latencies.count else 0,
+                "p50_latency": latencies.get_percentile(50),
+                "p99_latency": latencies.get_percentile(99)
+            })
+        return stats
+
+    def close(self):
+        '''
+            Stops the local workers, workers on other nodes keep running
+        '''
+        self.stop_rebalancing.set()
+        for shard_client in self.shard_clients:
+            if self.processes:
+                try:
+                    shard_client.request({"op": "shutdown"})
+                except (OSError, ConnectionError):
+                    pass
+            shard_client.close()
+        for process in self.processes:
+            process.join()
+        self.executor.shutdown()
@@ -20,14 +20,6 @@ def file_exists(file_name):
     return os.path.isfile(get_file_path(file_name))
 
 
-def run_threads_and_wait(threads: list):
-    for thread in threads:
-        thread.start()
-
-    for thread in threads:
-        thread.join()
-
-
 def pickle_object(object, location):
     with open(get_file_path(location), 'wb') as file:
         pickle.dump(object, file, protocol=pickle.HIGHEST_PROTOCOL)
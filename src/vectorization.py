@@ -1,20 +1,55 @@
+import bisect
 import math
+import os
 import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import utils
 from book import Book
+from index import DocFrequencies, IndexReader, IndexWriter, IndexedBookData, INDEX_FILE
+from collections import Counter
+from collections.abc import Mapping
+from retrieval import select_top_k, MaxScoreRetriever, ThresholdRetriever
+from ann import LSHIndex, LSH_TABLES, LSH_BITS, LSH_PROBES
+from lsa import LSAModel, fit_lsa_model, LSA_RANK
+from genres import GenreIndex
+from hashing import FeatureHasher, HashedBookData, DESCRIPTION_HASH_BITS, GENRE_HASH_BITS
+from metrics import metrics
 from typing import List, Tuple
 
 DESCRIPTION_DATA_PICKLE = "out/pickle/description_data.pickle"
 GENRE_DATA_PICKLE = "out/pickle/genre_data.pickle"
+SEGMENTS_PICKLE = "out/pickle/segments.pickle"
+
+CONTENT_TYPES = ('description', 'genre')
+
+# Term frequencies are stored as unsigned 16 bit integers
+MAX_TERM_FREQUENCY = 2 ** 16 - 1
+
+# Segments are merged into one when there are more of them
+MAX_SEGMENT_COUNT = 8
+
+# Encodings of the column-wise weights, int8 weights have a scale per row
+QUANTIZATIONS = ('float32', 'float16', 'int8')
+INT8_MAX = 127
+
+# Books rescored with the float32 weights per result, when the columns are quantized
+RERANK_FACTOR = 4
+
+# Engines of calculate_top_k_similarities
+ENGINES = ('exhaustive', 'maxscore', 'threshold', 'lsh', 'lsa')
 
 
 class Vector():
-    def __init__(self, vocabulary_size):
-        self.weight_dict = {}
+    def __init__(self, vocabulary_size, weight_dict: dict[int, float] = None, size: float = None):
+        self.weight_dict = weight_dict if weight_dict is not None else {}
         self.vocabulary_size = vocabulary_size
+        self.size = size
 
     def add_index_weight(self, index: int, weight: float):
         self.weight_dict[index] = weight
+        self.size = None
 
     def __str__(self):
         return repr(self.weight_dict)
@@ -23,7 +58,10 @@ class Vector():
         return repr(self.weight_dict)
 
     def get_size(self):
-        return math.sqrt(sum([x ** 2 for x in self.weight_dict.values()]))
+        # Size is cached until the vector is modified
+        if self.size is None:
+            self.size = math.sqrt(sum([x ** 2 for x in self.weight_dict.values()]))
+        return self.size
 
     def get_cross_product(self, other_vector):
         return sum([self.weight_dict[key] * other_vector.weight_dict[key] for key in self.weight_dict.keys() if key in other_vector.weight_dict.keys()])
@@ -42,18 +80,432 @@ class Vector():
         return {vocabulary[key]: self.weight_dict[key] for key in self.weight_dict.keys()}
 
 
+class VectorMatrix(Mapping):
+    '''
+        Stores the tf-idf vectors of a corpus as a CSR (compressed sparse row) matrix.
+        Row i is the vector of book_urls[i], the non-zero weights of the row are
+        data[indptr[i]:indptr[i + 1]] at vocabulary indices indices[indptr[i]:indptr[i + 1]].
+        Norms of the rows are calculated once while building the matrix.
+
+        It behaves like the old dict[str, Vector], so that matrix[book_url] returns
+        a Vector view of the row.
+    '''
+
+    def __init__(self, book_urls: List[str], vocabulary_size: int, indptr: np.ndarray, indices: np.ndarray, data: np.ndarray, norms: np.ndarray = None):
+        self.book_urls = list(book_urls)
+        self.url_index = {book_url: row for row,
+                          book_url in enumerate(self.book_urls)}
+        self.vocabulary_size = vocabulary_size
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.data = np.asarray(data, dtype=np.float32)
+        self.norms = self.calculate_norms() if norms is None else norms
+        # Column-wise (CSC) copy of the matrix, built on the first query
+        self.column_indptr = None
+        self.column_rows = None
+        self.column_data = None
+        self.column_max_weights = None
+        # Weights of the column-wise copy are int8 * column_scales[row] or float16 if quantized,
+        # the row-wise weights are always float32
+        self.quantization = 'float32'
+        self.column_scales = None
+
+    def get_row_ids(self) -> np.ndarray:
+        '''
+            Returns the row of each stored weight
+        '''
+        return np.repeat(np.arange(len(self.book_urls), dtype=np.int32), np.diff(self.indptr))
+
+    def calculate_norms(self) -> np.ndarray:
+        '''
+            Returns L2 norms of all rows
+        '''
+        squares = self.data.astype(np.float64) ** 2
+        return np.sqrt(np.bincount(self.get_row_ids(), weights=squares, minlength=len(self.book_urls)))
+
+    def get_row(self, row: int) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+            Returns (indices, weights) of the row
+        '''
+        start, end = self.indptr[row], self.indptr[row + 1]
+        return (self.indices[start:end], self.data[start:end])
+
+    def build_columns(self):
+        '''
+            Builds the column-wise copy of the matrix, so that the rows containing
+            a vocabulary index can be found without scanning the whole matrix
+        '''
+        if self.column_indptr is not None:
+            return
+        order = np.argsort(self.indices, kind='stable')
+        column_indptr = np.zeros(self.vocabulary_size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.indices, minlength=self.vocabulary_size),
+                  out=column_indptr[1:])
+        self.column_rows = self.get_row_ids()[order]
+        self.column_data = self.data[order]
+        self.column_max_weights = self.calculate_column_max_weights(
+            column_indptr)
+        self.column_indptr = column_indptr
+
+    def calculate_column_max_weights(self, column_indptr: np.ndarray) -> np.ndarray:
+        '''
+            Returns the highest normalized weight (weight / norm of the row) of each column
+        '''
+        column_max_weights = np.zeros(self.vocabulary_size, dtype=np.float64)
+        non_empty = np.diff(column_indptr) > 0
+        if non_empty.any():
+            normalized_weights = self.get_column_weights(
+                slice(None)) / self.norms[self.column_rows]
+            column_max_weights[non_empty] = np.maximum.reduceat(
+                normalized_weights, column_indptr[:-1][non_empty])
+        return column_max_weights
+
+    def quantize_columns(self, quantization: str):
+        '''
+            Stores the column-wise weights as float16, or as int8 with a scale per row
+            that maps the highest weight of the row to INT8_MAX. Columns are rebuilt from
+            the float32 rows first, so a quantized matrix can be quantized differently.
+        '''
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(
+                f"Unknown quantization {quantization}, expected one of {list(QUANTIZATIONS)}")
+        if quantization == self.quantization and self.column_indptr is not None:
+            return
+        self.column_indptr = None
+        self.quantization = 'float32'
+        self.column_scales = None
+        self.build_columns()
+        if quantization == 'float16':
+            self.column_data = self.column_data.astype(np.float16)
+        elif quantization == 'int8':
+            scales = np.zeros(len(self.book_urls), dtype=np.float32)
+            non_empty = np.diff(self.indptr) > 0
+            if non_empty.any():
+                scales[non_empty] = np.maximum.reduceat(
+                    np.abs(self.data), self.indptr[:-1][non_empty]) / INT8_MAX
+            inverse_scales = np.zeros_like(scales)
+            np.divide(1, scales, out=inverse_scales, where=scales != 0)
+            self.column_data = np.rint(
+                self.column_data * inverse_scales[self.column_rows]).astype(np.int8)
+            self.column_scales = scales
+        self.quantization = quantization
+        # Bounds of MaxScore must hold for the quantized weights
+        self.column_max_weights = self.calculate_column_max_weights(
+            self.column_indptr)
+
+    def set_columns(self, column_indptr: np.ndarray, column_rows: np.ndarray, column_data: np.ndarray, column_max_weights: np.ndarray,
+                    column_scales: np.ndarray = None):
+        '''
+            Sets the column-wise copy of the matrix built before, e.g. loaded from an index file
+            The quantization is found from the type of column_data
+        '''
+        self.column_indptr = column_indptr
+        self.column_rows = column_rows
+        self.column_data = column_data
+        self.column_max_weights = column_max_weights
+        self.column_scales = column_scales
+        self.quantization = {np.dtype(np.float16): 'float16', np.dtype(np.int8): 'int8'}.get(
+            column_data.dtype, 'float32')
+
+    def get_column_weights(self, positions) -> np.ndarray:
+        '''
+            Returns the weights of the column-wise copy at positions (a slice or an array), dequantized
+        '''
+        weights = self.column_data[positions]
+        if self.column_scales is not None:
+            return weights * self.column_scales[self.column_rows[positions]]
+        return weights
+
+    def get_column(self, index: int, dequantize: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+            Returns (rows, weights) of the column, rows are sorted
+            If dequantize is False, int8 weights are returned without their row scales
+        '''
+        self.build_columns()
+        if index >= self.vocabulary_size:
+            return (self.column_rows[:0], self.column_data[:0])
+        start, end = self.column_indptr[index], self.column_indptr[index + 1]
+        if dequantize:
+            return (self.column_rows[start:end], self.get_column_weights(slice(start, end)))
+        return (self.column_rows[start:end], self.column_data[start:end])
+
+    def dot(self, vector: Vector) -> np.ndarray:
+        '''
+            Returns the dot products of all rows with the vector
+            Only the columns of vector's non-zero indices are visited
+        '''
+        self.build_columns()
+        rows = []
+        products = []
+        for index, weight in vector.weight_dict.items():
+            column_rows, column_data = self.get_column(index, dequantize=False)
+            rows.append(column_rows)
+            products.append(column_data.astype(np.float64) * weight)
+        if len(rows) == 0:
+            return np.zeros(len(self.book_urls), dtype=np.float64)
+        dot_products = np.bincount(np.concatenate(rows), weights=np.concatenate(
+            products), minlength=len(self.book_urls))
+        if self.column_scales is not None:
+            # int8 weights are summed as they are and rescaled once per row
+            dot_products *= self.column_scales
+        return dot_products
+
+    def calculate_similarities(self, vector: Vector) -> np.ndarray:
+        '''
+            Returns the cosine similarities of all rows with the vector
+        '''
+        size_products = self.norms * vector.get_size()
+        similarities = np.zeros(len(self.book_urls), dtype=np.float64)
+        np.divide(self.dot(vector), size_products,
+                  out=similarities, where=size_products != 0)
+        return similarities
+
+    def calculate_row_similarities(self, vector: Vector, rows: np.ndarray) -> np.ndarray:
+        '''
+            Returns the cosine similarities of the rows with the vector from the float32 row-wise weights,
+            adding the products in the same order as calculate_similarities of a float32 matrix
+        '''
+        rows = np.asarray(rows, dtype=np.int64)
+        similarities = np.zeros(len(rows), dtype=np.float64)
+        if len(rows) == 0 or len(vector.weight_dict) == 0:
+            return similarities
+        query_indices = np.fromiter(
+            vector.weight_dict, dtype=np.int64, count=len(vector.weight_dict))
+        query_weights = np.fromiter(vector.weight_dict.values(
+        ), dtype=np.float64, count=len(vector.weight_dict))
+        # Position of every vocabulary index in the query, -1 if it is not in the query
+        query_positions = np.full(self.vocabulary_size, -1, dtype=np.int64)
+        known = query_indices < self.vocabulary_size
+        query_positions[query_indices[known]] = np.flatnonzero(known)
+
+        # Positions of the non-zeros of the rows, and the query term of each of them
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows + 1] - starts
+        entry_offsets = np.cumsum(lengths) - lengths
+        positions = np.arange(int(lengths.sum()), dtype=np.int64) + \
+            np.repeat(starts - entry_offsets, lengths)
+        entry_rows = np.repeat(np.arange(len(rows), dtype=np.int64), lengths)
+        entry_positions = query_positions[self.indices[positions]]
+        found = entry_positions >= 0
+        query_ranks = entry_positions[found]
+
+        # Products of a row are added in the order of the query terms
+        order = np.lexsort((query_ranks, entry_rows[found]))
+        products = self.data[positions[found]].astype(
+            np.float64) * query_weights[query_ranks]
+        dot_products = np.bincount(entry_rows[found][order], weights=products[order],
+                                   minlength=len(rows))
+
+        size_products = self.norms[rows] * vector.get_size()
+        np.divide(dot_products, size_products,
+                  out=similarities, where=size_products != 0)
+        return similarities
+
+    def calculate_similarities_of_rows(self, vector: Vector, rows: np.ndarray) -> np.ndarray:
+        '''
+            Returns the cosine similarities of the rows with the vector, from the non-zeros of the rows
+            or from the columns of the vector's indices, whichever has fewer entries
+        '''
+        self.build_columns()
+        rows = np.asarray(rows, dtype=np.int64)
+        indices = np.fromiter(vector.weight_dict, dtype=np.int64,
+                              count=len(vector.weight_dict))
+        indices = indices[indices < self.vocabulary_size]
+        row_entries = int((self.indptr[rows + 1] - self.indptr[rows]).sum())
+        column_entries = int(
+            (self.column_indptr[indices + 1] - self.column_indptr[indices]).sum())
+        if row_entries <= column_entries:
+            return self.calculate_row_similarities(vector, rows)
+        return self.calculate_similarities(vector)[rows]
+
+    def get_vector(self, book_url: str) -> Vector:
+        '''
+            Returns the Vector view of the book_url's row
+        '''
+        row = self.url_index[book_url]
+        indices, weights = self.get_row(row)
+        weight_dict = dict(zip(indices.tolist(), weights.tolist()))
+        return Vector(self.vocabulary_size, weight_dict, float(self.norms[row]))
+
+    def __getitem__(self, book_url: str) -> Vector:
+        return self.get_vector(book_url)
+
+    def __contains__(self, book_url) -> bool:
+        return book_url in self.url_index
+
+    def __iter__(self):
+        return iter(self.book_urls)
+
+    def __len__(self) -> int:
+        return len(self.book_urls)
+
+    def get_row_range(self, start: int, end: int) -> 'VectorMatrix':
+        '''
+            Returns the rows start:end as a VectorMatrix, its arrays are views of this matrix's arrays
+        '''
+        first, last = self.indptr[start], self.indptr[end]
+        return VectorMatrix(self.book_urls[start:end], self.vocabulary_size, self.indptr[start:end + 1] - first,
+                            self.indices[first:last], self.data[first:last], self.norms[start:end])
+
+    def __repr__(self) -> str:
+        return f"VectorMatrix({len(self.book_urls)} x {self.vocabulary_size}, {len(self.data)} non-zeros)"
+
+
+class Vocabulary(list):
+    '''
+        Terms in their id order, with a term -> id map
+        New terms are appended, so ids of existing terms never change
+    '''
+
+    def __init__(self, terms: List[str] = ()):
+        super().__init__(terms)
+        self.term_ids = {term: term_id for term_id, term in enumerate(self)}
+
+    def add(self, term: str) -> int:
+        '''
+            Returns the id of the term, adds the term if it is new
+        '''
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            term_id = len(self)
+            self.term_ids[term] = term_id
+            self.append(term)
+        return term_id
+
+    def get(self, term: str, default=None):
+        return self.term_ids.get(term, default)
+
+    def __contains__(self, term) -> bool:
+        return term in self.term_ids
+
+
 class BookData():
+    '''
+        Vocabulary, inverted index and frequencies of a content type.
+        Terms and books are interned as integer ids. Postings of a term are the ids of
+        the books containing it in increasing order, with a parallel array of term frequencies.
+    '''
+
     def __init__(self, content_type: str) -> None:
         self.content_type = content_type
-        self.vocabulary = set()
-        self.inverted_index: dict[str, set] = {}
-        self.term_frequency: dict[(str, str), int] = {}
-        self.doc_frequency: dict[str] = {}
+        self.vocabulary = Vocabulary()
+        self.book_urls: List[str] = []
+        self.book_ids: dict[str, int] = {}
+        # Indexed by term id
+        self.postings: List[array] = []
+        self.posting_frequencies: List[array] = []
+        self.doc_frequencies = array('i')
+
+    @property
+    def doc_frequency(self) -> DocFrequencies:
+        '''
+            Maps terms to their document frequencies
+        '''
+        return DocFrequencies(self.vocabulary, self.doc_frequencies)
 
     def pickle(self, location: str):
-        self.vocabulary = list(self.vocabulary)
         utils.pickle_object(self, location)
 
+    def get_book_id(self, book_url: str) -> int:
+        '''
+            Returns the id of the book, adds the book if it is new
+        '''
+        book_id = self.book_ids.get(book_url)
+        if book_id is None:
+            book_id = len(self.book_urls)
+            self.book_ids[book_url] = book_id
+            self.book_urls.append(book_url)
+        return book_id
+
+    def get_term_id(self, term: str) -> int:
+        '''
+            Returns the id of the term, adds the term if it is new
+        '''
+        term_id = self.vocabulary.add(term)
+        if term_id == len(self.postings):
+            self.postings.append(array('i'))
+            self.posting_frequencies.append(array('H'))
+            self.doc_frequencies.append(0)
+        return term_id
+
+    def add_book_tokens(self, book_url: str, tokens: List[str]):
+        '''
+            Adds the tokens of the book into vocabulary, postings and frequencies
+            A book added again adds to its frequencies, its postings stay in book id order
+        '''
+        book_id = self.get_book_id(book_url)
+        for token, frequency in Counter(tokens).items():
+            term_id = self.get_term_id(token)
+            postings = self.postings[term_id]
+            frequencies = self.posting_frequencies[term_id]
+            if len(postings) == 0 or postings[-1] < book_id:
+                # A new book has the highest id
+                postings.append(book_id)
+                frequencies.append(min(frequency, MAX_TERM_FREQUENCY))
+                self.doc_frequencies[term_id] += 1
+                continue
+            position = bisect.bisect_left(postings, book_id)
+            if position < len(postings) and postings[position] == book_id:
+                # The book is added again, add to its frequency
+                frequencies[position] = min(
+                    frequencies[position] + frequency, MAX_TERM_FREQUENCY)
+            else:
+                # The book is added again with a term it did not have
+                postings.insert(position, book_id)
+                frequencies.insert(position, min(frequency, MAX_TERM_FREQUENCY))
+                self.doc_frequencies[term_id] += 1
+
+    def get_postings(self, term: str) -> Tuple[array, array]:
+        '''
+            Returns (book ids, term frequencies) of the books containing the term
+        '''
+        term_id = self.vocabulary.get(term)
+        if term_id is None:
+            return (array('i'), array('H'))
+        return (self.postings[term_id], self.posting_frequencies[term_id])
+
+    def get_term_frequency(self, term: str, book_url: str) -> int:
+        '''
+            Returns the frequency of the term in the book
+        '''
+        book_id = self.book_ids.get(book_url)
+        postings, frequencies = self.get_postings(term)
+        if book_id is None:
+            return 0
+        position = bisect.bisect_left(postings, book_id)
+        if position < len(postings) and postings[position] == book_id:
+            return frequencies[position]
+        return 0
+
+    def get_entries(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        '''
+            Returns (book_ids, term_ids, term_frequencies) of all postings, grouped by term
+        '''
+        book_ids = np.frombuffer(b''.join(postings.tobytes()
+                                 for postings in self.postings), dtype=np.int32)
+        frequencies = np.frombuffer(b''.join(frequencies.tobytes()
+                                    for frequencies in self.posting_frequencies), dtype=np.uint16)
+        term_ids = np.repeat(np.arange(len(self.postings), dtype=np.int32),
+                             np.asarray(self.doc_frequencies, dtype=np.int64))
+        return (book_ids, term_ids, frequencies)
+
+    def merge_shard_data(self, shard_data: 'BookData'):
+        '''
+            Merges the BookData of the next shard, renumbering its term and book ids
+            Books of the shard must come after the books added before
+        '''
+        book_ids = np.array([self.get_book_id(book_url)
+                            for book_url in shard_data.book_urls], dtype=np.int32)
+        for shard_term_id, term in enumerate(shard_data.vocabulary):
+            term_id = self.get_term_id(term)
+            shard_postings = np.frombuffer(
+                shard_data.postings[shard_term_id], dtype=np.int32)
+            self.postings[term_id].frombytes(
+                book_ids[shard_postings].tobytes())
+            self.posting_frequencies[term_id].extend(
+                shard_data.posting_frequencies[shard_term_id])
+            self.doc_frequencies[term_id] += shard_data.doc_frequencies[shard_term_id]
+
 
 class BookPreprocessor():
     def __init__(self, books_dict: dict[str, Book] = None, books_dict_file: str = None):
@@ -102,50 +554,460 @@ class BookPreprocessor():
             content_tokens = self.tokenize_genres(book)
             book_data = self.genre_data
 
-        for token in content_tokens:
-            # Add token into vocabulary
-            book_data.vocabulary.add(token)
-
-            # Add document into inverted index
-            if token not in book_data.inverted_index:
-                book_data.inverted_index[token] = {book_url}
-            else:
-                book_data.inverted_index[token].add(book_url)
-
-            word_book_pair = (token, book_url)
-
-            # Add 1 to frequency of a word occurrence in a book
-            if word_book_pair not in book_data.term_frequency:
-                book_data.term_frequency[word_book_pair] = 1
-                # Add 1 to document frequency
-                if token not in book_data.doc_frequency:
-                    book_data.doc_frequency[token] = 1
-                else:
-                    book_data.doc_frequency[token] += 1
-            else:
-                book_data.term_frequency[word_book_pair] += 1
+        book_data.add_book_tokens(book_url, content_tokens)
 
     def preprocess_book(self, book):
         self.preprocess_book_content(book, 'description')
         self.preprocess_book_content(book, 'genre')
 
-    def preprocess_books(self):
+    def preprocess_books(self, processes: int = 1):
+        '''
+            Preprocesses all books, in this process or sharded across processes
+        '''
         start_time = time.time()
-        for book in self.books_dict.values():
-            self.preprocess_book(book)
+        with metrics.time("tokenize"):
+            if processes > 1:
+                self.preprocess_books_parallel(processes)
+            else:
+                for book in self.books_dict.values():
+                    self.preprocess_book(book)
 
         end_time = time.time()
         print(f"It took {end_time - start_time} seconds to preprocess books")
 
+    def preprocess_books_parallel(self, processes: int):
+        '''
+            Splits books into consecutive shards, preprocesses the shards in a process pool (map)
+            and merges their partial results in shard order (reduce).
+            Terms and books get their ids in the same order as the serial preprocessing,
+            so the result is the same.
+        '''
+        books = list(self.books_dict.values())
+        if len(books) == 0:
+            return
+        shard_size = math.ceil(len(books) / (processes * 4))
+        shards = [books[start:start + shard_size]
+                  for start in range(0, len(books), shard_size)]
+
+        with ProcessPoolExecutor(processes) as pool:
+            for shard_data in pool.map(preprocess_book_shard, shards):
+                self.description_data.merge_shard_data(
+                    shard_data['description'])
+                self.genre_data.merge_shard_data(shard_data['genre'])
+
     def pickle_book_data(self):
         self.description_data.pickle(DESCRIPTION_DATA_PICKLE)
         self.genre_data.pickle(GENRE_DATA_PICKLE)
 
 
+class IndexSegment():
+    '''
+        Books added to the index at the same time.
+        For each content type, it stores the term frequencies of its books as a CSR matrix
+        whose columns are term ids. idf weights are not stored, since they change with every update.
+    '''
+
+    def __init__(self, book_urls: List[str], entries: dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]]):
+        '''
+            entries[content_type] is (row_ids, term_ids, term_frequencies) of the books in any order
+        '''
+        self.book_urls = list(book_urls)
+        self.tf_matrices: dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]] = {}
+        for content_type, (row_ids, term_ids, frequencies) in entries.items():
+            row_ids = np.asarray(row_ids, dtype=np.int64)
+            order = np.lexsort((term_ids, row_ids))
+            indptr = np.zeros(len(self.book_urls) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(row_ids, minlength=len(self.book_urls)),
+                      out=indptr[1:])
+            self.tf_matrices[content_type] = (indptr,
+                                              np.asarray(term_ids, dtype=np.int32)[
+                                                  order],
+                                              np.asarray(frequencies, dtype=np.int32)[order])
+
+    def get_term_ids(self, content_type: str, row: int) -> np.ndarray:
+        indptr, indices, _ = self.tf_matrices[content_type]
+        return indices[indptr[row]:indptr[row + 1]]
+
+
+class SegmentedIndex():
+    '''
+        Index that is updated without a full rebuild.
+        New and refreshed books are appended as a delta segment. Removed books are tombstoned:
+        they are dropped from locations, but stay in their segment until the segments are merged.
+        Document frequencies are updated with every change, tf-idf vectors are built from the
+        segments with the current idf weights only when they are needed.
+    '''
+
+    def __init__(self):
+        self.vocabularies = {content_type: Vocabulary()
+                             for content_type in CONTENT_TYPES}
+        self.doc_frequencies = {content_type: np.zeros(0, dtype=np.int64)
+                                for content_type in CONTENT_TYPES}
+        self.segments: List[IndexSegment] = []
+        # Live books and their (segment, row)
+        self.locations: dict[str, Tuple[int, int]] = {}
+        # Increased with every change
+        self.version = 0
+
+    @staticmethod
+    def from_book_data(book_urls: List[str], book_datas: dict[str, BookData]) -> 'SegmentedIndex':
+        '''
+            Creates the index with a single segment from preprocessed books
+            Term ids are the indices of the terms in book_data.vocabulary
+        '''
+        segmented_index = SegmentedIndex()
+        url_index = {book_url: row for row, book_url in enumerate(book_urls)}
+        entries = {}
+        for content_type, book_data in book_datas.items():
+            segmented_index.vocabularies[content_type] = Vocabulary(
+                list(book_data.vocabulary))
+            book_ids, term_ids, frequencies = book_data.get_entries()
+            book_rows = np.array([url_index.get(book_url, -1)
+                                 for book_url in book_data.book_urls], dtype=np.int64)
+            rows = book_rows[book_ids]
+            kept = rows >= 0
+            entries[content_type] = (
+                rows[kept], term_ids[kept], frequencies[kept])
+        segmented_index.add_segment(IndexSegment(book_urls, entries))
+        return segmented_index
+
+    def get_book_count(self) -> int:
+        return len(self.locations)
+
+    def get_book_data(self, content_type: str) -> IndexedBookData:
+        '''
+            Returns the vocabulary and the document frequencies of the content type
+        '''
+        return IndexedBookData(content_type, self.vocabularies[content_type], self.doc_frequencies[content_type])
+
+    def add_segment(self, segment: IndexSegment):
+        '''
+            Appends the segment, older versions of its books are tombstoned
+        '''
+        for book_url in segment.book_urls:
+            if book_url in self.locations:
+                self.remove_book(book_url)
+
+        segment_id = len(self.segments)
+        self.segments.append(segment)
+        for row, book_url in enumerate(segment.book_urls):
+            self.locations[book_url] = (segment_id, row)
+
+        for content_type in CONTENT_TYPES:
+            doc_frequencies = np.zeros(
+                len(self.vocabularies[content_type]), dtype=np.int64)
+            doc_frequencies[:len(self.doc_frequencies[content_type])
+                            ] = self.doc_frequencies[content_type]
+            # Term ids are unique within a row, so each row adds 1 to its terms
+            np.add.at(doc_frequencies,
+                      segment.tf_matrices[content_type][1], 1)
+            self.doc_frequencies[content_type] = doc_frequencies
+        self.version += 1
+
+    def add_books(self, books_dict: dict[str, Book]):
+        '''
+            Tokenizes the books and appends them as a new segment
+            Books which are already in the index are refreshed
+        '''
+        self.add_term_frequencies(books_dict.keys(), [count_book_terms(book)
+                                                      for book in books_dict.values()])
+
+    def add_term_frequencies(self, book_urls: List[str], term_frequencies: List[dict[str, Counter]], merge: bool = True):
+        '''
+            Appends tokenized books as a new segment, term_frequencies are returned by count_book_terms
+            If merge is False, segments are not merged when there are more than MAX_SEGMENT_COUNT
+        '''
+        entries = {}
+        for content_type in CONTENT_TYPES:
+            vocabulary = self.vocabularies[content_type]
+            row_ids, term_ids, frequencies = [], [], []
+            for row, book_term_frequencies in enumerate(term_frequencies):
+                for term, frequency in book_term_frequencies[content_type].items():
+                    row_ids.append(row)
+                    term_ids.append(vocabulary.add(term))
+                    frequencies.append(frequency)
+            entries[content_type] = (row_ids, term_ids, frequencies)
+        self.add_segment(IndexSegment(book_urls, entries))
+
+        if merge and len(self.segments) > MAX_SEGMENT_COUNT:
+            self.merge_segments()
+
+    def remove_book(self, book_url: str):
+        '''
+            Tombstones the book and removes it from the document frequencies
+        '''
+        segment_id, row = self.locations.pop(book_url)
+        segment = self.segments[segment_id]
+        for content_type in CONTENT_TYPES:
+            self.doc_frequencies[content_type][segment.get_term_ids(
+                content_type, row)] -= 1
+        self.version += 1
+
+    def remove_books(self, book_urls: List[str]):
+        for book_url in book_urls:
+            if book_url in self.locations:
+                self.remove_book(book_url)
+
+    def get_live_entries(self, content_type: str) -> Tuple[List[str], np.ndarray, np.ndarray, np.ndarray]:
+        '''
+            Returns (book_urls, row_ids, term_ids, term_frequencies) of the live books of all segments
+            Tombstoned books are skipped, rows are numbered from 0 in book_urls order
+        '''
+        book_urls = []
+        row_ids, term_ids, frequencies = [], [], []
+        for segment_id, segment in enumerate(self.segments):
+            live = np.array([self.locations.get(book_url) == (segment_id, row)
+                             for row, book_url in enumerate(segment.book_urls)], dtype=bool)
+            indptr, indices, segment_frequencies = segment.tf_matrices[content_type]
+            segment_row_ids = np.repeat(np.arange(len(segment.book_urls), dtype=np.int64),
+                                        np.diff(indptr))
+            # Live rows are numbered after the live rows of the previous segments
+            new_rows = np.cumsum(live) - 1 + len(book_urls)
+            kept = live[segment_row_ids]
+            row_ids.append(new_rows[segment_row_ids[kept]])
+            term_ids.append(indices[kept])
+            frequencies.append(segment_frequencies[kept])
+            book_urls += [book_url for book_url,
+                          is_live in zip(segment.book_urls, live) if is_live]
+
+        if len(self.segments) == 0:
+            return ([], np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32))
+        return (book_urls, np.concatenate(row_ids), np.concatenate(term_ids), np.concatenate(frequencies))
+
+    def merge_segments(self):
+        '''
+            Merges all segments into one, dropping the tombstoned books
+        '''
+        entries = {}
+        for content_type in CONTENT_TYPES:
+            book_urls, row_ids, term_ids, frequencies = self.get_live_entries(
+                content_type)
+            entries[content_type] = (row_ids, term_ids, frequencies)
+
+        self.segments = [IndexSegment(book_urls, entries)]
+        self.locations = {book_url: (0, row)
+                          for row, book_url in enumerate(book_urls)}
+        self.version += 1
+
+    @metrics.time("vectorize")
+    def build_vector_matrix(self, content_type: str) -> VectorMatrix:
+        '''
+            Returns the tf-idf matrix of the live books with the current idf weights
+        '''
+        book_urls, row_ids, term_ids, frequencies = self.get_live_entries(
+            content_type)
+        doc_frequencies = self.doc_frequencies[content_type]
+        idf_weights = np.zeros(len(doc_frequencies), dtype=np.float64)
+        present = doc_frequencies > 0
+        idf_weights[present] = np.log10(
+            self.get_book_count() / doc_frequencies[present])
+
+        weights = (1 + np.log10(frequencies.astype(np.float64))) * \
+            idf_weights[term_ids]
+        positive = weights > 0
+        row_ids, term_ids, weights = row_ids[positive], term_ids[positive], weights[positive]
+
+        indptr = np.zeros(len(book_urls) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(row_ids, minlength=len(book_urls)),
+                  out=indptr[1:])
+        return VectorMatrix(book_urls, len(self.vocabularies[content_type]), indptr, term_ids, weights)
+
+
+class HashedIndex():
+    '''
+        Index of hashed term frequencies that is updated like SegmentedIndex.
+        Every field has a CSR matrix of signed term frequencies whose columns are features,
+        and a fixed size array of document frequencies. Indexes built separately from
+        different books (e.g. in different processes) are merged by appending their rows
+        and adding their document frequencies, no term ids have to be renumbered.
+    '''
+
+    def __init__(self, description_bits: int = DESCRIPTION_HASH_BITS, genre_bits: int = GENRE_HASH_BITS):
+        self.hash_bits = {'description': description_bits,
+                          'genre': genre_bits}
+        self.feature_hashers = {content_type: FeatureHasher(hash_bits)
+                                for content_type, hash_bits in self.hash_bits.items()}
+        self.book_urls: List[str] = []
+        self.book_rows: dict[str, int] = {}
+        # content_type -> (indptr, features, signed frequencies)
+        self.tf_matrices = {content_type: (np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32))
+                            for content_type in self.hash_bits}
+        self.doc_frequencies = {content_type: np.zeros(1 << hash_bits, dtype=np.int64)
+                                for content_type, hash_bits in self.hash_bits.items()}
+        # Increased with every change
+        self.version = 0
+
+    def get_book_count(self) -> int:
+        return len(self.book_urls)
+
+    def get_book_data(self, content_type: str) -> HashedBookData:
+        return HashedBookData(content_type, self.hash_bits[content_type], self.doc_frequencies[content_type].copy())
+
+    def add_books(self, books_dict: dict[str, Book]):
+        '''
+            Hashes the terms of the books and appends them, books which are already in the index are refreshed
+        '''
+        self.add_term_frequencies(books_dict.keys(), [count_book_terms(book)
+                                                      for book in books_dict.values()])
+
+    def add_term_frequencies(self, book_urls: List[str], term_frequencies: List[dict[str, Counter]]):
+        '''
+            Appends tokenized books, term_frequencies are returned by count_book_terms
+        '''
+        hashed_index = HashedIndex(
+            self.hash_bits['description'], self.hash_bits['genre'])
+        hashed_index.book_urls = list(book_urls)
+        for content_type, feature_hasher in self.feature_hashers.items():
+            hashed_rows = [feature_hasher.hash_term_frequencies(book_term_frequencies[content_type])
+                           for book_term_frequencies in term_frequencies]
+            indptr = np.zeros(len(hashed_rows) + 1, dtype=np.int64)
+            np.cumsum([len(features) for features, _ in hashed_rows],
+                      out=indptr[1:])
+            features = np.concatenate(
+                [features for features, _ in hashed_rows] + [np.zeros(0, dtype=np.int32)])
+            hashed_index.tf_matrices[content_type] = (indptr, features, np.concatenate(
+                [counts for _, counts in hashed_rows] + [np.zeros(0, dtype=np.int32)]))
+            # Features are unique within a row, so each row adds 1 to its features
+            hashed_index.doc_frequencies[content_type] = np.bincount(
+                features, minlength=feature_hasher.feature_count).astype(np.int64)
+        self.remove_books(hashed_index.book_urls)
+        self.merge(hashed_index)
+
+    def merge(self, other: 'HashedIndex'):
+        '''
+            Appends the books of other, their document frequencies are added
+        '''
+        if other.hash_bits != self.hash_bits:
+            raise ValueError(
+                f"Indexes of {other.hash_bits} hash bits cannot be merged into {self.hash_bits}")
+        duplicates = [book_url for book_url in other.book_urls if book_url in self.book_rows]
+        if duplicates:
+            raise ValueError(
+                f"{len(duplicates)} books are in both indexes, e.g. {duplicates[0]}")
+
+        for content_type in self.hash_bits:
+            indptr, features, counts = self.tf_matrices[content_type]
+            other_indptr, other_features, other_counts = other.tf_matrices[content_type]
+            self.tf_matrices[content_type] = (np.concatenate((indptr, indptr[-1] + other_indptr[1:])),
+                                              np.concatenate((features, other_features)), np.concatenate((counts, other_counts)))
+            self.doc_frequencies[content_type] = self.doc_frequencies[content_type] + \
+                other.doc_frequencies[content_type]
+        for book_url in other.book_urls:
+            self.book_rows[book_url] = len(self.book_urls)
+            self.book_urls.append(book_url)
+        self.version += 1
+
+    def remove_books(self, book_urls: List[str]):
+        '''
+            Drops the rows of the books and subtracts them from the document frequencies
+        '''
+        removed_rows = [self.book_rows[book_url]
+                        for book_url in book_urls if book_url in self.book_rows]
+        if not removed_rows:
+            return
+        live = np.ones(len(self.book_urls), dtype=bool)
+        live[removed_rows] = False
+        for content_type in self.hash_bits:
+            indptr, features, counts = self.tf_matrices[content_type]
+            row_ids = np.repeat(np.arange(len(self.book_urls)), np.diff(indptr))
+            kept = live[row_ids]
+            self.doc_frequencies[content_type] -= np.bincount(
+                features[~kept], minlength=len(self.doc_frequencies[content_type]))
+            new_indptr = np.zeros(int(live.sum()) + 1, dtype=np.int64)
+            np.cumsum(np.diff(indptr)[live], out=new_indptr[1:])
+            self.tf_matrices[content_type] = (
+                new_indptr, features[kept], counts[kept])
+        self.book_urls = [book_url for book_url,
+                          is_live in zip(self.book_urls, live) if is_live]
+        self.book_rows = {book_url: row for row,
+                          book_url in enumerate(self.book_urls)}
+        self.version += 1
+
+    def build_vector_matrix(self, content_type: str) -> VectorMatrix:
+        '''
+            Returns the tf-idf matrix of the books with the current idf weights.
+            A weight has the sign of its signed frequency, the tf weight is taken of its absolute value.
+        '''
+        indptr, features, counts = self.tf_matrices[content_type]
+        doc_frequencies = self.doc_frequencies[content_type]
+        idf_weights = np.zeros(len(doc_frequencies), dtype=np.float64)
+        present = doc_frequencies > 0
+        idf_weights[present] = np.log10(
+            self.get_book_count() / doc_frequencies[present])
+
+        weights = np.sign(counts) * (1 + np.log10(np.abs(counts).astype(np.float64))) * \
+            idf_weights[features]
+        row_ids = np.repeat(np.arange(len(self.book_urls)), np.diff(indptr))
+        non_zero = weights != 0
+        row_ids, features, weights = row_ids[non_zero], features[non_zero], weights[non_zero]
+
+        new_indptr = np.zeros(len(self.book_urls) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(row_ids, minlength=len(self.book_urls)),
+                  out=new_indptr[1:])
+        return VectorMatrix(list(self.book_urls), len(doc_frequencies), new_indptr, features, weights)
+
+
+def get_index_quantization(location: str = INDEX_FILE) -> str:
+    '''
+        Returns the quantization of the index file's column-wise weights, float32 if there is no index file
+    '''
+    if not utils.file_exists(location):
+        return 'float32'
+    column_data = IndexReader(utils.get_file_path(
+        location)).get_array("description.column_data")
+    return {np.dtype(np.float16): 'float16', np.dtype(np.int8): 'int8'}.get(column_data.dtype, 'float32')
+
+
+def count_book_terms(book: Book) -> dict[str, Counter]:
+    '''
+        Returns the term frequencies of the description and genre of the book
+    '''
+    book_preprocessor = BookPreprocessor()
+    return {
+        'description': Counter(book_preprocessor.tokenize_description(book)),
+        'genre': Counter(book_preprocessor.tokenize_genres(book))
+    }
+
+
+def preprocess_book_shard(books: List[Book]) -> dict[str, BookData]:
+    '''
+        Preprocesses a shard of books in a pool process,
+        returns BookData of description and genre
+    '''
+    book_preprocessor = BookPreprocessor(books_dict={})
+    for book in books:
+        book_preprocessor.preprocess_book(book)
+    return {
+        'description': book_preprocessor.description_data,
+        'genre': book_preprocessor.genre_data
+    }
+
+
+def hash_book_shard(books: List[Book], description_bits: int = DESCRIPTION_HASH_BITS,
+                    genre_bits: int = GENRE_HASH_BITS) -> HashedIndex:
+    '''
+        Returns the hashed index of a shard of books, runs in a pool process
+    '''
+    hashed_index = HashedIndex(description_bits, genre_bits)
+    hashed_index.add_books({book.url: book for book in books})
+    return hashed_index
+
+
 class BookVectorizer():
-    def __init__(self, books_dict_file: str = None):
+    DESCRIPTION_WEIGHT = 0.5
+    GENRE_WEIGHT = 0.5
 
-        if books_dict_file:
+    def __init__(self, books_dict_file: str = None, index_file: str = None):
+        # content_type -> (book_data, book_count, idf weights in term id order)
+        self.idf_weights: dict[str, Tuple[object, int, np.ndarray]] = {}
+        # Encoding of the column-wise weights written by write_index, one of QUANTIZATIONS
+        self.quantization = 'float32'
+        # Results of quantized columns are rescored from this many candidates per result
+        self.rerank_factor = RERANK_FACTOR
+
+        if index_file:
+            self.load_index(index_file)
+        elif books_dict_file:
             self.books_dict: dict[str, Book] = utils.unpickle_object(
                 books_dict_file)
             self.description_data: BookData = utils.unpickle_object(
@@ -168,51 +1030,216 @@ class BookVectorizer():
             idf_weight = math.log10(self.book_count/df)
         return idf_weight
 
-    def vectorize_book(self, book_content: List[str], vocabulary: List[str], df_dict: dict[str, int]):
-        term_frequencies = {word: book_content.count(
-            word) for word in book_content if word in vocabulary}
+    def get_idf_weights(self, book_data: BookData) -> np.ndarray:
+        '''
+            Returns the idf weights of the vocabulary of book_data in term id order
+            They are calculated once and recalculated when book_data or the book count changes
+        '''
+        cached = self.idf_weights.get(book_data.content_type)
+        if cached is not None and cached[0] is book_data and cached[1] == self.book_count:
+            return cached[2]
+
+        if isinstance(book_data, HashedBookData):
+            doc_frequencies = np.asarray(
+                book_data.doc_frequencies, dtype=np.float64)
+        else:
+            doc_frequencies = np.asarray(
+                book_data.doc_frequency.doc_frequencies, dtype=np.float64)
+        idf_weights = np.zeros(len(doc_frequencies), dtype=np.float64)
+        # Terms of removed books have 0 document frequency and 0 weight
+        known = doc_frequencies > 0
+        idf_weights[known] = np.log10(
+            self.book_count / doc_frequencies[known])
+        self.idf_weights[book_data.content_type] = (
+            book_data, self.book_count, idf_weights)
+        return idf_weights
+
+    def vectorize_book(self, book_content: List[str], vocabulary: Vocabulary, df_dict: dict[str, int], idf_weights: np.ndarray = None):
+        '''
+            Counts the tokens in one pass and looks them up in the term -> id map of vocabulary,
+            so only the non-zero weights of the book are calculated.
+            idf_weights are the precomputed idf weights in term id order, if they are not given
+            idf weights are calculated from df_dict
+        '''
+        term_frequencies = {}
+        for word, frequency in Counter(book_content).items():
+            index = vocabulary.get(word)
+            if index is not None:
+                term_frequencies[index] = (word, frequency)
 
         vector = Vector(len(vocabulary))
-        for index, word in enumerate(vocabulary):
-            tf_idf_weight = self.get_tf_weight(
-                word, term_frequencies) * self.get_idf_weight(word, df_dict)
+        # Weights are added in vocabulary order, like the vectors of the books
+        for index in sorted(term_frequencies):
+            word, frequency = term_frequencies[index]
+            if idf_weights is not None:
+                idf_weight = float(idf_weights[index])
+            else:
+                idf_weight = self.get_idf_weight(word, df_dict)
+            tf_idf_weight = (1 + math.log10(frequency)) * idf_weight
             if tf_idf_weight > 0:
                 vector.add_index_weight(index, tf_idf_weight)
 
         return vector
 
+    def vectorize_hashed_book(self, book_content: List[str], book_data: HashedBookData) -> Vector:
+        '''
+            Hashes the tokens into the features of book_data, no vocabulary is needed.
+            A weight has the sign of its signed frequency, like the hashed vectors of the books.
+        '''
+        features, counts = book_data.feature_hasher.hash_term_frequencies(
+            Counter(book_content))
+        weights = np.sign(counts) * (1 + np.log10(np.abs(counts).astype(np.float64))) * \
+            self.get_idf_weights(book_data)[features]
+        vector = Vector(book_data.get_vocabulary_size())
+        for index, weight in zip(features.tolist(), weights.tolist()):
+            if weight != 0:
+                vector.add_index_weight(index, weight)
+        return vector
+
     def vectorize_book_data(self, book_url: str, book_data: BookData) -> Vector:
         vector = Vector(len(book_data.vocabulary))
+        doc_frequency = book_data.doc_frequency
         for index, word in enumerate(book_data.vocabulary):
-            tf_key = (word, book_url)
-            df_key = word
-            tf_weight = self.get_tf_weight(tf_key, book_data.term_frequency)
-            idf_weight = self.get_idf_weight(df_key, book_data.doc_frequency)
+            term_frequency = book_data.get_term_frequency(word, book_url)
+            if term_frequency == 0:
+                continue
+            tf_weight = 1 + math.log10(term_frequency)
+            idf_weight = self.get_idf_weight(word, doc_frequency)
             tf_idf_weight = tf_weight * idf_weight
             if tf_idf_weight > 0:
                 vector.add_index_weight(index, tf_idf_weight)
         return vector
 
-    def vectorize_book_dict(self, books_dict: dict[str, Book]) -> Tuple[dict]:
+    @metrics.time("vectorize")
+    def vectorize_book_data_matrix(self, book_urls: List[str], book_data: BookData) -> VectorMatrix:
+        '''
+            Builds the tf-idf matrix of book_urls with a single pass over the postings
+            Rows are in the order of book_urls, columns are in the order of the vocabulary
+        '''
+        url_index = {book_url: row for row, book_url in enumerate(book_urls)}
+
+        book_ids, columns, frequencies = book_data.get_entries()
+        book_rows = np.array([url_index.get(book_url, -1)
+                             for book_url in book_data.book_urls], dtype=np.int64)
+        rows = book_rows[book_ids]
+        kept = rows >= 0
+        rows, columns, frequencies = rows[kept], columns[kept], frequencies[kept].astype(
+            np.float64)
+
+        # idf weight of every term in vocabulary order
+        doc_frequencies = np.asarray(
+            book_data.doc_frequencies, dtype=np.float64)
+        idf_weights = np.log10(self.book_count / doc_frequencies)
+
+        weights = (1 + np.log10(frequencies)) * idf_weights[columns]
+
+        # Keep only the positive weights, sorted by row then column
+        positive = weights > 0
+        rows, columns, weights = rows[positive], columns[positive], weights[positive]
+        order = np.lexsort((columns, rows))
+
+        indptr = np.zeros(len(book_urls) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(book_urls)), out=indptr[1:])
+
+        return VectorMatrix(book_urls, len(book_data.vocabulary), indptr, columns[order], weights[order])
+
+    def vectorize_book_dict(self, books_dict: dict[str, Book], processes: int = 1) -> Tuple[VectorMatrix]:
         book_preprocessor = BookPreprocessor(books_dict=books_dict)
-        book_preprocessor.preprocess_books()
+        book_preprocessor.preprocess_books(processes)
         book_preprocessor.pickle_book_data()
 
         print("Vectorizing books_dict...")
 
-        description_data = book_preprocessor.description_data
-        genre_data = book_preprocessor.genre_data
+        description_data = self.description_data = book_preprocessor.description_data
+        genre_data = self.genre_data = book_preprocessor.genre_data
 
         self.book_count = len(books_dict)
+        book_urls = list(books_dict.keys())
 
-        self.description_vectors = {book_url: self.vectorize_book_data(book_url, description_data)
-                                    for book_url in books_dict.keys()}
+        self.description_vectors = self.vectorize_book_data_matrix(
+            book_urls, description_data)
 
-        self.genre_vectors = {book_url: self.vectorize_book_data(book_url, genre_data)
-                              for book_url in books_dict.keys()}
+        self.genre_vectors = self.vectorize_book_data_matrix(
+            book_urls, genre_data)
 
         return (self.description_vectors, self.genre_vectors)
 
+    def hash_book_dict(self, books_dict: dict[str, Book], processes: int = 1, description_bits: int = DESCRIPTION_HASH_BITS,
+                       genre_bits: int = GENRE_HASH_BITS) -> Tuple[VectorMatrix]:
+        '''
+            Vectorizes books_dict into 2 ** description_bits and 2 ** genre_bits hashed features instead of a vocabulary.
+            Shards of books are hashed in a process pool, and their indexes are merged in shard order
+            by adding their document frequencies. The HashedIndex is kept as the segmented index.
+        '''
+        start_time = time.time()
+        books = list(books_dict.values())
+        hashed_index = HashedIndex(description_bits, genre_bits)
+        with metrics.time("tokenize"):
+            if processes > 1 and len(books) > 0:
+                shard_size = math.ceil(len(books) / (processes * 4))
+                shards = [books[start:start + shard_size]
+                          for start in range(0, len(books), shard_size)]
+                with ProcessPoolExecutor(processes) as pool:
+                    for shard_index in pool.map(hash_book_shard, shards, [description_bits] * len(shards),
+                                                [genre_bits] * len(shards)):
+                        hashed_index.merge(shard_index)
+            else:
+                hashed_index.merge(hash_book_shard(
+                    books, description_bits, genre_bits))
+        print(f"It took {time.time() - start_time} seconds to hash books")
+
+        self.segmented_index = hashed_index
+        self.update_from_segments()
+        self.load_vectors()
+        return (self.description_vectors, self.genre_vectors)
+
+    def is_hashed(self) -> bool:
+        '''
+            Returns whether the vectors are hashed features, whose weights can be negative
+        '''
+        return isinstance(getattr(self, 'description_data', None), HashedBookData)
+
+    def create_segments(self):
+        '''
+            Creates the segmented index of the vectorized books, so that they can be updated later
+        '''
+        self.segmented_index = SegmentedIndex.from_book_data(self.description_vectors.book_urls, {
+            'description': self.description_data, 'genre': self.genre_data})
+
+    def pickle_segments(self, location: str = SEGMENTS_PICKLE):
+        print(f"Pickling the segments into '{location}'...")
+        utils.pickle_object(self.segmented_index, location)
+
+    def load_segments(self, location: str = SEGMENTS_PICKLE):
+        self.segmented_index: SegmentedIndex = utils.unpickle_object(location)
+        self.update_from_segments()
+
+    def update_from_segments(self):
+        '''
+            Takes the book count and document frequencies from the segmented index,
+            vectors are rebuilt with the new idf weights on the next query
+        '''
+        self.book_count = self.segmented_index.get_book_count()
+        self.description_data = self.segmented_index.get_book_data(
+            'description')
+        self.genre_data = self.segmented_index.get_book_data('genre')
+        self.description_vectors = None
+        self.genre_vectors = None
+
+    def add_books(self, books_dict: dict[str, Book]):
+        '''
+            Adds new books to the index or refreshes existing ones without a full rebuild
+        '''
+        self.segmented_index.add_books(books_dict)
+        self.update_from_segments()
+
+    def remove_books(self, book_urls: List[str]):
+        '''
+            Removes books from the index without a full rebuild
+        '''
+        self.segmented_index.remove_books(book_urls)
+        self.update_from_segments()
+
     def pickle_vectors(self):
         print("Pickling the vectors...")
         utils.pickle_object(self.description_vectors,
@@ -220,41 +1247,409 @@ class BookVectorizer():
         utils.pickle_object(self.genre_vectors,
                             "out/pickle/genre_vectors.pickle")
 
-    def combine_description_genre_similarity(self, description_similarity: float, genre_similarity: float) -> float:
-        return 0.5 * description_similarity + 0.5 * genre_similarity
+    @metrics.time("index_build")
+    def write_index(self, location: str = INDEX_FILE, quantization: str = None):
+        '''
+            Writes book urls, term dictionaries, document frequencies,
+            row-wise and column-wise vectors and norms of both fields into an index file
+            Column-wise weights are quantized with quantization, self.quantization by default
+        '''
+        self.load_vectors()
+        self.quantization = quantization or self.quantization
+        print(f"Writing the index into '{location}'...")
+        index_writer = IndexWriter()
+        index_writer.add_array("book_count", np.array(
+            [self.book_count], dtype=np.int64))
+        index_writer.add_strings(
+            "book_urls", self.description_vectors.book_urls)
 
-    def calculate_similarities(self, book: Book):
+        fields = [('description', self.description_data, self.description_vectors),
+                  ('genre', self.genre_data, self.genre_vectors)]
+        for field, book_data, vector_matrix in fields:
+            if isinstance(book_data, HashedBookData):
+                # Hashed fields have no terms, only the document frequencies of their features
+                index_writer.add_array(f"{field}.hash_bits", np.array(
+                    [book_data.feature_hasher.hash_bits], dtype=np.int64))
+                index_writer.add_array(
+                    f"{field}.doc_frequency", book_data.doc_frequencies.astype(np.int32))
+            else:
+                vocabulary = list(book_data.vocabulary)
+                index_writer.add_term_dictionary(f"{field}.terms", vocabulary)
+                index_writer.add_array(f"{field}.doc_frequency", np.array(
+                    [book_data.doc_frequency[term] for term in vocabulary], dtype=np.int32))
+
+            # Genre rows are stored in the order of description rows
+            if vector_matrix.book_urls != self.description_vectors.book_urls:
+                raise ValueError(
+                    "Description and genre vectors must have the same rows")
+
+            vector_matrix.quantize_columns(self.quantization)
+            index_writer.add_array(f"{field}.indptr", vector_matrix.indptr)
+            index_writer.add_array(f"{field}.indices", vector_matrix.indices)
+            index_writer.add_array(f"{field}.data", vector_matrix.data)
+            index_writer.add_array(f"{field}.norms", vector_matrix.norms)
+            index_writer.add_array(
+                f"{field}.column_indptr", vector_matrix.column_indptr)
+            index_writer.add_array(
+                f"{field}.column_rows", vector_matrix.column_rows)
+            index_writer.add_array(
+                f"{field}.column_data", vector_matrix.column_data)
+            index_writer.add_array(
+                f"{field}.column_max_weights", vector_matrix.column_max_weights)
+            if vector_matrix.column_scales is not None:
+                index_writer.add_array(
+                    f"{field}.column_scales", vector_matrix.column_scales)
+
+        lsa_model = getattr(self, 'lsa_model', None)
+        if lsa_model is not None and self.is_current_model(lsa_model):
+            index_writer.add_array("lsa.components", lsa_model.components.ravel())
+            index_writer.add_array("lsa.embeddings", lsa_model.embeddings.ravel())
+            index_writer.add_array(
+                "lsa.rank", np.array([lsa_model.get_rank()], dtype=np.int64))
+
+        utils.create_dir(os.path.dirname(location))
+        # Replace the file at once, so that readers mapping the old file are not affected
+        temporary_location = f"{location}.tmp"
+        index_writer.write(utils.get_file_path(temporary_location))
+        os.replace(utils.get_file_path(temporary_location),
+                   utils.get_file_path(location))
+
+    def load_index(self, location: str = INDEX_FILE):
+        '''
+            Opens the index file with mmap, vectors are not copied into memory
+        '''
+        self.index_reader = IndexReader(utils.get_file_path(location))
+        self.book_count = int(self.index_reader.get_array("book_count")[0])
+        book_urls = self.index_reader.get_strings("book_urls")
+
+        get_array = self.index_reader.get_array
+        for field in ('description', 'genre'):
+            if f"{field}.hash_bits" in self.index_reader:
+                book_data = HashedBookData(field, int(get_array(f"{field}.hash_bits")[0]),
+                                           get_array(f"{field}.doc_frequency"))
+                vocabulary_size = book_data.get_vocabulary_size()
+            else:
+                vocabulary = self.index_reader.get_term_dictionary(
+                    f"{field}.terms")
+                book_data = IndexedBookData(
+                    field, vocabulary, get_array(f"{field}.doc_frequency"))
+                vocabulary_size = len(vocabulary)
+            vector_matrix = VectorMatrix(book_urls, vocabulary_size, get_array(f"{field}.indptr"), get_array(
+                f"{field}.indices"), get_array(f"{field}.data"), get_array(f"{field}.norms"))
+            column_scales = get_array(
+                f"{field}.column_scales") if f"{field}.column_scales" in self.index_reader else None
+            vector_matrix.set_columns(get_array(f"{field}.column_indptr"), get_array(f"{field}.column_rows"),
+                                      get_array(f"{field}.column_data"), get_array(f"{field}.column_max_weights"),
+                                      column_scales)
+            setattr(self, f"{field}_data", book_data)
+            setattr(self, f"{field}_vectors", vector_matrix)
+        self.quantization = self.description_vectors.quantization
+
+        if "lsa.rank" in self.index_reader.sections:
+            rank = int(get_array("lsa.rank")[0])
+            self.lsa_model = LSAModel(self.description_vectors, self.genre_vectors,
+                                      get_array("lsa.components").reshape(-1, rank),
+                                      get_array("lsa.embeddings").reshape(-1, rank),
+                                      self.DESCRIPTION_WEIGHT, self.GENRE_WEIGHT)
+
+    def get_index_version(self) -> int:
+        '''
+            Returns a number that changes when the index is rebuilt or updated
+        '''
+        if getattr(self, 'index_reader', None) is not None:
+            return self.index_reader.checksum
+        if getattr(self, 'segmented_index', None) is not None:
+            return self.segmented_index.version
+        return 0
+
+    def get_field_weights(self, field_weights: Tuple[float, float] = None) -> Tuple[float, float]:
+        '''
+            Returns the (description, genre) weights of a query, the class weights if field_weights is None
+        '''
+        if field_weights is None:
+            return (self.DESCRIPTION_WEIGHT, self.GENRE_WEIGHT)
+        description_weight, genre_weight = field_weights
+        return (float(description_weight), float(genre_weight))
+
+    def combine_description_genre_similarity(self, description_similarity: float, genre_similarity: float,
+                                             field_weights: Tuple[float, float] = None) -> float:
+        description_weight, genre_weight = self.get_field_weights(
+            field_weights)
+        return description_weight * description_similarity + genre_weight * genre_similarity
+
+    def load_vectors(self):
+        '''
+            Unpickles description and genre vectors if they are not loaded yet
+        '''
+        if getattr(self, 'segmented_index', None) is not None:
+            # Build vectors of the updated index with the current idf weights
+            if self.description_vectors is None:
+                self.description_vectors = self.segmented_index.build_vector_matrix(
+                    'description')
+            if self.genre_vectors is None:
+                self.genre_vectors = self.segmented_index.build_vector_matrix(
+                    'genre')
+        if getattr(self, 'description_vectors', None) is None:
+            self.description_vectors: VectorMatrix = utils.unpickle_object(
+                "out/pickle/description_vectors.pickle")
+        if getattr(self, 'genre_vectors', None) is None:
+            self.genre_vectors: VectorMatrix = utils.unpickle_object(
+                "out/pickle/genre_vectors.pickle")
+
+    def vectorize_query(self, book: Book) -> Tuple[Vector, Vector]:
+        '''
+            Returns description and genre vectors of the query book
+        '''
         book_preprocessor = BookPreprocessor()
-        book_url = book.url
         description = book_preprocessor.tokenize_description(book)
         genre = book_preprocessor.tokenize_genres(book)
 
-        # Get vectors of query book
+        if self.is_hashed():
+            return (self.vectorize_hashed_book(description, self.description_data),
+                    self.vectorize_hashed_book(genre, self.genre_data))
+
         description_vector: Vector = self.vectorize_book(
-            description, self.description_data.vocabulary, self.description_data.doc_frequency)
+            description, self.description_data.vocabulary, self.description_data.doc_frequency,
+            self.get_idf_weights(self.description_data))
         genre_vector: Vector = self.vectorize_book(
-            genre, self.genre_data.vocabulary, self.genre_data.doc_frequency)
-
-        # Get vectors of other books
-        description_vectors: dict[str, Vector] = utils.unpickle_object(
-            "out/pickle/description_vectors.pickle")
-        genre_vectors: dict[str, Vector] = utils.unpickle_object(
-            "out/pickle/genre_vectors.pickle")
-
-        similarities = []
-        for book_url in description_vectors.keys():
-            if book_url in genre_vectors:
-                # Other book's vectors
-                other_desc_vector = description_vectors[book_url]
-                other_genre_vector = genre_vectors[book_url]
-                # Calculate similarities
-                desc_similarity = description_vector.calculate_similarity(
-                    other_desc_vector)
-                genre_similarity = genre_vector.calculate_similarity(
-                    other_genre_vector)
-                # Combine similarities
-                similarity = self.combine_description_genre_similarity(
-                    desc_similarity, genre_similarity)
-                similarities.append((similarity, book_url))
+            genre, self.genre_data.vocabulary, self.genre_data.doc_frequency,
+            self.get_idf_weights(self.genre_data))
+        return (description_vector, genre_vector)
 
-        return similarities
+    def calculate_similarity_scores(self, book: Book) -> np.ndarray:
+        '''
+            Returns the combined similarity of the book with every row of description_vectors
+            Each field is scored with one sparse matrix-vector product
+        '''
+        self.load_vectors()
+        description_vector, genre_vector = self.vectorize_query(book)
+        return self.calculate_vector_similarity_scores(description_vector, genre_vector)
+
+    def calculate_vector_similarity_scores(self, description_vector: Vector, genre_vector: Vector,
+                                           field_weights: Tuple[float, float] = None) -> np.ndarray:
+        '''
+            Returns the combined similarity of the query vectors with every row of description_vectors
+        '''
+        description_similarities = self.description_vectors.calculate_similarities(
+            description_vector)
+        genre_similarities = self.genre_vectors.calculate_similarities(
+            genre_vector)
+
+        # Align genre rows with description rows if they are stored in a different order
+        if self.genre_vectors.book_urls != self.description_vectors.book_urls:
+            genre_rows = np.array([self.genre_vectors.url_index.get(book_url, -1)
+                                   for book_url in self.description_vectors.book_urls], dtype=np.int64)
+            genre_similarities = np.where(
+                genre_rows >= 0, genre_similarities[genre_rows], np.nan)
+
+        return self.combine_description_genre_similarity(description_similarities, genre_similarities, field_weights)
+
+    def build_lsh_index(self, tables: int = LSH_TABLES, bits: int = LSH_BITS, probes: int = LSH_PROBES) -> LSHIndex:
+        '''
+            Builds the LSH index of the loaded vectors with the given number of tables,
+            bits per table and probes per table
+        '''
+        self.load_vectors()
+        self.lsh_index = LSHIndex(self.description_vectors, self.genre_vectors, self.DESCRIPTION_WEIGHT, self.GENRE_WEIGHT,
+                                  tables=tables, bits=bits, probes=probes)
+        return self.lsh_index
+
+    def get_lsh_index(self) -> LSHIndex:
+        '''
+            Returns the LSH index, builds it on the first use or after the vectors change
+        '''
+        lsh_index = getattr(self, 'lsh_index', None)
+        if lsh_index is None or not self.is_current_model(lsh_index):
+            lsh_index = self.build_lsh_index()
+        return lsh_index
+
+    def build_genre_index(self) -> GenreIndex:
+        '''
+            Builds the genre bitsets and posting bitmaps of the loaded genre vectors
+        '''
+        self.load_vectors()
+        self.genre_index = GenreIndex(
+            self.genre_vectors, self.get_idf_weights(self.genre_data))
+        return self.genre_index
+
+    def get_genre_index(self) -> GenreIndex:
+        '''
+            Returns the genre index, builds it on the first use or after the vectors change
+        '''
+        genre_index = getattr(self, 'genre_index', None)
+        if genre_index is None or genre_index.genre_vectors is not self.genre_vectors:
+            genre_index = self.build_genre_index()
+        return genre_index
+
+    def build_lsa_model(self, rank: int = LSA_RANK) -> LSAModel:
+        '''
+            Fits dense embeddings of rank dimensions to the loaded vectors,
+            they are written into the index file by write_index
+        '''
+        self.load_vectors()
+        self.lsa_model = fit_lsa_model(self.description_vectors, self.genre_vectors,
+                                       self.DESCRIPTION_WEIGHT, self.GENRE_WEIGHT, rank=rank)
+        return self.lsa_model
+
+    def get_lsa_model(self) -> LSAModel:
+        '''
+            Returns the LSA model, fits it on the first use or after the vectors change
+        '''
+        lsa_model = getattr(self, 'lsa_model', None)
+        if lsa_model is None or not self.is_current_model(lsa_model):
+            lsa_model = self.build_lsa_model()
+        return lsa_model
+
+    def is_current_model(self, model) -> bool:
+        '''
+            Returns True if the model was built from the loaded vectors
+        '''
+        return model.description_vectors is self.description_vectors and model.genre_vectors is self.genre_vectors
+
+    def calculate_top_k_similarities(self, book: Book, k: int = 18, excluded_urls: List[str] = (), engine: str = 'exhaustive',
+                                     min_genre_overlap: int = 0, field_weights: Tuple[float, float] = None) -> List[Tuple[float, str]]:
+        '''
+            Returns the k most similar (similarity, book_url) pairs in descending order
+            engine is either 'exhaustive', which scores every book,
+            'maxscore', which walks only the postings of the query terms,
+            'threshold', which reads the books in the order of their description or genre similarity
+            until no unread book can enter the top k,
+            'lsh', which scores only the books in the query's LSH buckets (approximate)
+            or 'lsa', which scores dense embeddings of the books (approximate)
+            If min_genre_overlap > 0, only the books sharing that many genres with the query are scored
+            field_weights are the (description, genre) weights of the similarities, the class weights by default,
+            lsh and lsa are built with the class weights,
+            maxscore and threshold cannot score hashed features (see hash_book_dict)
+        '''
+        self.load_vectors()
+        description_vector, genre_vector = self.vectorize_query(book)
+        return self.calculate_top_k_of_vectors(description_vector, genre_vector, k, excluded_urls, engine,
+                                               min_genre_overlap, field_weights)
+
+    def calculate_top_k_of_vectors(self, description_vector: Vector, genre_vector: Vector, k: int = 18,
+                                   excluded_urls: List[str] = (), engine: str = 'exhaustive',
+                                   min_genre_overlap: int = 0, field_weights: Tuple[float, float] = None) -> List[Tuple[float, str]]:
+        '''
+            Returns the k most similar (similarity, book_url) pairs of the vectorized query in descending order,
+            engines are the same as calculate_top_k_similarities
+            With quantized columns, k * rerank_factor books are found by the exhaustive, maxscore or threshold
+            engine and the k best of them are found with the float32 weights
+        '''
+        if engine not in ENGINES:
+            raise ValueError(
+                f"Unknown engine {engine}, expected one of {ENGINES}")
+        self.load_vectors()
+        field_weights = self.get_field_weights(field_weights)
+        if engine in ('lsh', 'lsa') and min_genre_overlap <= 0 and field_weights != self.get_field_weights():
+            raise ValueError(
+                f"Engine {engine} is built with the weights {self.get_field_weights()}, they cannot be changed per query")
+        if engine in ('maxscore', 'threshold') and min_genre_overlap <= 0 and self.is_hashed():
+            # Their upper bounds only hold for non-negative weights
+            raise ValueError(
+                f"Engine {engine} cannot score hashed features, their weights can be negative")
+        rerank = self.is_quantized() and (
+            engine in ('exhaustive', 'maxscore', 'threshold') or min_genre_overlap > 0)
+        shortlist_size = k * self.rerank_factor if rerank else k
+        if min_genre_overlap > 0:
+            results = self.find_top_k_by_genres(
+                description_vector, genre_vector, shortlist_size, excluded_urls, min_genre_overlap, field_weights)
+        else:
+            results = self.find_top_k_of_vectors(
+                description_vector, genre_vector, shortlist_size, excluded_urls, engine, field_weights)
+        if rerank:
+            with metrics.time("rerank"):
+                return self.rerank(description_vector, genre_vector, results, k, field_weights)
+        return results
+
+    def is_quantized(self) -> bool:
+        '''
+            Returns True if the column-wise weights of the loaded vectors are quantized
+        '''
+        return self.genre_vectors.book_urls == self.description_vectors.book_urls and \
+            (self.description_vectors.quantization != 'float32' or self.genre_vectors.quantization != 'float32')
+
+    def rerank(self, description_vector: Vector, genre_vector: Vector, shortlist: List[Tuple[float, str]], k: int,
+               field_weights: Tuple[float, float] = None) -> List[Tuple[float, str]]:
+        '''
+            Rescores the (similarity, book_url) pairs of the shortlist with the float32 row-wise weights
+            and returns the k best of them, with the same scores as unquantized vectors
+        '''
+        url_index = self.description_vectors.url_index
+        rows = np.array([url_index[book_url]
+                        for _, book_url in shortlist], dtype=np.int64)
+        scores = self.combine_description_genre_similarity(
+            self.description_vectors.calculate_row_similarities(
+                description_vector, rows),
+            self.genre_vectors.calculate_row_similarities(genre_vector, rows), field_weights)
+        return select_top_k(scores, self.description_vectors.book_urls, k, rows=rows)
+
+    def find_top_k_by_genres(self, description_vector: Vector, genre_vector: Vector, k: int, excluded_urls: List[str],
+                             min_genre_overlap: int, field_weights: Tuple[float, float] = None) -> List[Tuple[float, str]]:
+        '''
+            Returns the k most similar (similarity, book_url) pairs among the books sharing at least
+            min_genre_overlap genres with the query. The candidates are found with the genre posting bitmaps
+            and their genres are scored with their genre bitsets, the engine does not matter.
+            Hashed genres are scored with their vectors, since the bitsets do not have the signs of the features.
+        '''
+        if self.genre_vectors.book_urls != self.description_vectors.book_urls:
+            raise ValueError(
+                "Description and genre vectors must have the same rows to filter by genres")
+        genre_index = self.get_genre_index()
+        genre_ids = genre_index.get_genre_ids(genre_vector)
+        with metrics.time("genre_filter"):
+            rows = genre_index.find_candidates(genre_ids, min_genre_overlap)
+        with metrics.time("query_scoring"):
+            if self.is_hashed():
+                genre_similarities = self.genre_vectors.calculate_similarities_of_rows(
+                    genre_vector, rows)
+            else:
+                genre_similarities = genre_index.calculate_similarities(
+                    genre_ids, rows)
+            scores = self.combine_description_genre_similarity(
+                self.description_vectors.calculate_similarities_of_rows(
+                    description_vector, rows), genre_similarities, field_weights)
+        excluded_rows = [self.description_vectors.url_index.get(book_url)
+                         for book_url in excluded_urls]
+        with metrics.time("top_k"):
+            return select_top_k(scores, self.description_vectors.book_urls, k, excluded_rows, rows=rows)
+
+    def find_top_k_of_vectors(self, description_vector: Vector, genre_vector: Vector, k: int, excluded_urls: List[str],
+                              engine: str, field_weights: Tuple[float, float] = None) -> List[Tuple[float, str]]:
+        '''
+            Returns the k most similar (similarity, book_url) pairs of the engine, without reranking
+        '''
+        if engine in ('maxscore', 'threshold', 'lsh', 'lsa') and self.genre_vectors.book_urls == self.description_vectors.book_urls:
+            if engine == 'maxscore':
+                retriever = MaxScoreRetriever(
+                    self.description_vectors, self.genre_vectors, *self.get_field_weights(field_weights))
+            elif engine == 'threshold':
+                retriever = ThresholdRetriever(
+                    self.description_vectors, self.genre_vectors, *self.get_field_weights(field_weights))
+            elif engine == 'lsh':
+                retriever = self.get_lsh_index()
+            else:
+                retriever = self.get_lsa_model()
+            excluded_rows = [self.description_vectors.url_index.get(book_url)
+                             for book_url in excluded_urls]
+            # Retrievers score the candidates and select the top k together
+            with metrics.time("query_scoring"):
+                return retriever.retrieve(description_vector, genre_vector, k, excluded_rows)
+
+        with metrics.time("query_scoring"):
+            scores = self.calculate_vector_similarity_scores(
+                description_vector, genre_vector, field_weights)
+        # Books without a genre vector are not ranked
+        scores[np.isnan(scores)] = -np.inf
+        book_urls = self.description_vectors.book_urls
+        excluded_rows = [self.description_vectors.url_index.get(book_url)
+                         for book_url in excluded_urls]
+        with metrics.time("top_k"):
+            return select_top_k(scores, book_urls, k, excluded_rows)
+
+    def calculate_similarities(self, book: Book):
+        '''
+            Returns (similarity, book_url) pairs of all books, unsorted
+        '''
+        scores = self.calculate_similarity_scores(book)
+        return [(similarity, book_url) for similarity, book_url in zip(scores.tolist(), self.description_vectors.book_urls)
+                if not math.isnan(similarity)]
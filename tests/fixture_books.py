@@ -0,0 +1,47 @@
+import os
+import random
+import vectorization
+from unittest import mock
+from book import Book
+from vectorization import BookVectorizer
+
+WORDS = ["wizard", "dragon", "castle", "river", "winter", "empire", "garden", "letter", "ocean", "secret",
+         "mirror", "forest", "war", "love", "detective", "murder", "ship", "star", "machine", "island"]
+GENRES = ["Fantasy", "Science Fiction", "Mystery", "Romance",
+          "History", "Classics", "Horror", "Poetry"]
+
+
+def create_books(count: int, seed: int = 0) -> dict[str, Book]:
+    '''
+        Returns books of random words and genres, every tenth book is a copy of the book before it,
+        so that their scores tie, some books have no description or no genres
+    '''
+    generator = random.Random(seed)
+    books_dict = {}
+    previous_book = None
+    for book_id in range(count):
+        url = f"{book_id}.Book"
+        if book_id % 10 == 9:
+            description, genres = previous_book.description, previous_book.genres
+        else:
+            description = "" if book_id % 17 == 5 else " ".join(
+                generator.choices(WORDS, k=generator.randint(3, 30)))
+            genres = [] if book_id % 13 == 6 else generator.sample(
+                GENRES, generator.randint(1, 4))
+        previous_book = books_dict[url] = Book(
+            url, f"Book {book_id}", description, [], [], genres)
+    return books_dict
+
+
+def build_index(books_dict: dict[str, Book], location: str, processes: int = 1, quantization: str = None) -> BookVectorizer:
+    '''
+        Vectorizes the books and writes their index into location,
+        the preprocessing data is pickled next to it instead of out/pickle
+    '''
+    directory = os.path.dirname(location)
+    with mock.patch.multiple(vectorization, DESCRIPTION_DATA_PICKLE=os.path.join(directory, "description_data.pickle"),
+                             GENRE_DATA_PICKLE=os.path.join(directory, "genre_data.pickle")):
+        book_vectorizer = BookVectorizer()
+        book_vectorizer.vectorize_book_dict(books_dict, processes=processes)
+    book_vectorizer.write_index(location, quantization)
+    return book_vectorizer
@@ -0,0 +1,122 @@
+import re
+import threading
+import time
+import utils
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+BOOK_PATH_PATTERN = re.compile(r'^/book/show/(\d+)\.\w+$')
+
+
+def get_fixture_page(book_id: int, recommendations: List[int]) -> str:
+    '''
+        Returns a book page in the markup of the real book pages, recommending the recommendations
+    '''
+    recommendation_items = "".join(
+        f'<li class=\'cover\' id="bookCover{recommendation}">\n'
+        f'<a href="{utils.BOOKS_BASE_URL}{recommendation}.Book"><img alt="Book {recommendation}" src="cover.jpg" /></a>\n'
+        '</li>\n' for recommendation in recommendations)
+    genres = "".join(
+        '<div class="elementList ">\n<div class="left">\n'
+        f'<a class="actionLinkLite bookPageGenreLink" href="/genres/{genre}">Genre {genre}</a>\n'
+        '</div>\n</div>\n' for genre in (book_id % 3, 3 + book_id % 5))
+    return f'''<html><body>
+<h1 id="bookTitle" class="gr-h1" itemprop="name">
+  Book {book_id}
+</h1>
+<div class='authorName__container'>
+<a class="authorName" itemprop="url" href="author"><span itemprop="name">Author {book_id % 7}</span></a>
+</div>
+<div id="descriptionContainer">
+<div id="description" class="readable stacked">
+<span id="freeTextContainer{book_id}">Book {book_id} is about topic{book_id % 4} and topic{book_id % 9}</span>
+</div>
+</div>
+<ul>
+{recommendation_items}</ul>
+{genres}</body></html>'''
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    # Keep-alive connections
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status: int, body: bytes = b""):
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server: FixtureServer = self.server
+        status = server.record_request(self.path, self.client_address)
+        if server.delay:
+            time.sleep(server.delay)
+        if status != 200:
+            self.send_body(status)
+            return
+        if self.path in server.raw_pages:
+            self.send_body(200, server.raw_pages[self.path])
+            return
+        match = BOOK_PATH_PATTERN.match(self.path)
+        if match is None or int(match.group(1)) not in server.graph:
+            self.send_body(404)
+            return
+        book_id = int(match.group(1))
+        self.send_body(200, get_fixture_page(
+            book_id, server.graph[book_id]).encode("utf-8"))
+
+
+class FixtureServer(ThreadingHTTPServer):
+    '''
+        Local stand-in of the book site, serves fixture pages of the books in graph
+        (book id -> recommended book ids) at /book/show/{id}.Book on a free port.
+
+        statuses[path] are the statuses answered to the first requests of path, e.g. [503, 503],
+        raw_pages[path] is sent as the body of path as it is. Every request is recorded as
+        (path, client address, time), requests of the same connection have the same client address.
+    '''
+    daemon_threads = True
+
+    def __init__(self, graph: dict[int, List[int]] = None, statuses: dict[str, List[int]] = None,
+                 raw_pages: dict[str, bytes] = None, delay: float = 0):
+        super().__init__(("127.0.0.1", 0), FixtureHandler)
+        self.graph = graph or {}
+        self.statuses = {path: list(path_statuses)
+                         for path, path_statuses in (statuses or {}).items()}
+        self.raw_pages = raw_pages or {}
+        self.delay = delay
+        self.requests = []
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    def __enter__(self) -> 'FixtureServer':
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+    def get_base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/book/show/"
+
+    def get_url(self, book_id: int) -> str:
+        return f"{self.get_base_url()}{book_id}.Book"
+
+    def record_request(self, path: str, client_address: tuple) -> int:
+        '''
+            Records the request, returns the status to answer it with
+        '''
+        with self.lock:
+            self.requests.append((path, client_address, time.monotonic()))
+            path_statuses = self.statuses.get(path)
+            return path_statuses.pop(0) if path_statuses else 200
+
+    def get_requested_paths(self) -> List[str]:
+        with self.lock:
+            return [path for path, _, _ in self.requests]
@@ -0,0 +1,152 @@
+import os
+import signal
+import subprocess
+import sys
+import time
+import pytest
+import utils
+from download import BookDownloader, CrawlFrontier, CRAWL_HEAP_COMPACTION_SIZE
+from fixture_server import FixtureServer
+from metrics import metrics
+from pagestore import PageStore
+
+# Every book is reachable from book 0, at most 3 recommendations deep
+GRAPH = {book_id: [(book_id * 3 + 1) % 40, (book_id * 7 + 2) % 40]
+         for book_id in range(40)}
+
+# Crawls in another process, until it is killed
+CRAWL_SCRIPT = '''
+import sys
+from download import BookDownloader
+page_store_file, frontier_file, books_file, base_url = sys.argv[1:]
+book_downloader = BookDownloader(page_store_file=page_store_file, logs_file=page_store_file + ".logs",
+                                 errors_file=page_store_file + ".errors", concurrency=2, requests_per_second=0,
+                                 report_interval=60, url_filter=lambda url: url.startswith("http://127.0.0.1"))
+book_downloader.crawl_books(books_file, frontier_file=frontier_file, base_url=base_url, checkpoint_interval=0.1)
+'''
+
+
+def is_local_url(url: str) -> bool:
+    return url.startswith("http://127.0.0.1")
+
+
+def get_reachable_books(graph: dict, seed: int, max_depth: int = None) -> dict[int, int]:
+    '''
+        Returns book id -> depth of the books reachable from seed
+    '''
+    depths = {seed: 0}
+    level = [seed]
+    while level and (max_depth is None or depths[level[0]] < max_depth):
+        next_level = []
+        for book_id in level:
+            for recommendation in graph[book_id]:
+                if recommendation not in depths:
+                    depths[recommendation] = depths[book_id] + 1
+                    next_level.append(recommendation)
+        level = next_level
+    return depths
+
+
+def crawl(tmp_path, server: FixtureServer, concurrency: int = 2, **kwargs) -> BookDownloader:
+    book_downloader = BookDownloader(page_store_file=str(tmp_path / "pages.pack"),
+                                     logs_file=str(tmp_path / "download_logs.txt"),
+                                     errors_file=str(tmp_path / "download_errors.txt"),
+                                     concurrency=concurrency, requests_per_second=0, report_interval=60,
+                                     url_filter=is_local_url)
+    books_file = tmp_path / "books.txt"
+    books_file.write_text(f"{server.get_url(0)}\n")
+    book_downloader.crawl_books(str(books_file), frontier_file=str(tmp_path / "frontier.pickle"),
+                                base_url=server.get_base_url(), **kwargs)
+    return book_downloader
+
+
+def get_stored_urls(tmp_path) -> list[str]:
+    page_store = PageStore(str(tmp_path / "pages.pack"), read_only=True)
+    urls = [url for url, _ in page_store.iterate_pages()]
+    page_store.close()
+    return urls
+
+
+@pytest.fixture(autouse=True)
+def clear_metrics():
+    metrics.clear()
+    yield
+    metrics.clear()
+
+
+def test_crawl_is_breadth_first_within_max_depth(tmp_path):
+    depths = get_reachable_books(GRAPH, 0, max_depth=2)
+    with FixtureServer(GRAPH) as server:
+        crawl(tmp_path, server, concurrency=1, max_depth=2)
+    requested_ids = [int(path.split("/")[-1].split(".")[0])
+                     for path in server.get_requested_paths()]
+    assert sorted(requested_ids) == sorted(depths)
+    assert [depths[book_id] for book_id in requested_ids] == sorted(depths.values())
+
+
+def test_crawl_stops_at_max_books(tmp_path):
+    with FixtureServer(GRAPH) as server:
+        crawl(tmp_path, server, max_books=10)
+    assert len(server.requests) == 10
+    assert len(get_stored_urls(tmp_path)) == 10
+
+
+def test_priority_takes_most_recommended_urls_first():
+    frontier = CrawlFrontier(priority=True)
+    for url in ("a", "b", "c"):
+        frontier.add(url)
+    frontier.add("c")
+    frontier.add("c")
+    frontier.add("b")
+    assert [frontier.take()[2] for _ in range(3)] == ["c", "b", "a"]
+
+
+def test_priority_heap_is_compacted():
+    frontier = CrawlFrontier(priority=True)
+    for url_id in range(10):
+        frontier.add(f"url{url_id}")
+    for _ in range(1000):
+        for url_id in range(10):
+            frontier.add(f"url{url_id}")
+    assert len(frontier.heap) <= CRAWL_HEAP_COMPACTION_SIZE
+    # Ties of the same count are taken in the order they were found
+    taken_urls = [frontier.take()[2] for _ in range(10)]
+    assert taken_urls == [f"url{url_id}" for url_id in range(10)]
+    for url in taken_urls:
+        frontier.complete(url, [])
+    assert frontier.take() is None
+
+
+def test_resumed_crawl_keeps_its_order(tmp_path):
+    with FixtureServer(GRAPH) as server:
+        crawl(tmp_path, server, max_books=5, priority=True)
+        with pytest.raises(ValueError, match="priority order"):
+            crawl(tmp_path, server, max_books=10)
+
+
+def test_killed_crawl_resumes_from_its_checkpoint(tmp_path):
+    frontier_file = tmp_path / "frontier.pickle"
+    with FixtureServer(GRAPH, delay=0.05) as server:
+        books_file = tmp_path / "books.txt"
+        books_file.write_text(f"{server.get_url(0)}\n")
+        process = subprocess.Popen([sys.executable, "-c", CRAWL_SCRIPT, str(tmp_path / "pages.pack"), str(frontier_file),
+                                    str(books_file), server.get_base_url()],
+                                   cwd=os.path.dirname(utils.__file__), stdout=subprocess.DEVNULL)
+        deadline = time.monotonic() + 30
+        while not (frontier_file.exists() and len(server.requests) >= 15):
+            assert time.monotonic() < deadline and process.poll() is None
+            time.sleep(0.01)
+        process.send_signal(signal.SIGKILL)
+        process.wait()
+        killed_requests = len(server.requests)
+        assert killed_requests < len(GRAPH)
+
+        book_downloader = crawl(tmp_path, server)
+
+    requested_paths = server.get_requested_paths()
+    assert sorted(set(requested_paths)) == sorted(
+        f"/book/show/{book_id}.Book" for book_id in get_reachable_books(GRAPH, 0))
+    # Pages saved before the kill are not downloaded again, only the ones in flight when it was killed
+    assert len(requested_paths) - len(set(requested_paths)) <= 2
+    assert len(get_stored_urls(tmp_path)) == len(GRAPH)
+    assert book_downloader.failed_downloads == []
@@ -0,0 +1,201 @@
+import threading
+import pytest
+from download import BookDownloader, PageFetcher, RateLimiter
+from fixture_server import FixtureServer
+from metrics import metrics
+from pagestore import PageStore
+
+GRAPH = {book_id: [(book_id + 1) % 12, (book_id * 5) % 12]
+         for book_id in range(12)}
+
+
+def is_local_url(url: str) -> bool:
+    return url.startswith("http://127.0.0.1")
+
+
+def create_downloader(tmp_path, **kwargs) -> BookDownloader:
+    options = dict(page_store_file=str(tmp_path / "pages.pack"),
+                   logs_file=str(tmp_path / "download_logs.txt"),
+                   errors_file=str(tmp_path / "download_errors.txt"),
+                   requests_per_second=0, backoff_base=0.01, report_interval=60,
+                   url_filter=is_local_url)
+    options.update(kwargs)
+    return BookDownloader(**options)
+
+
+def write_books_file(tmp_path, urls) -> str:
+    books_file = tmp_path / "books.txt"
+    books_file.write_text("".join(f"{url}\n" for url in urls))
+    return str(books_file)
+
+
+def download_books(book_downloader: BookDownloader, books_file: str, timeout: float = 30) -> dict:
+    '''
+        Runs download_books in a thread, fails the test if it does not finish in timeout seconds
+    '''
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(
+        book_downloader.download_books(books_file)), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "download_books did not finish"
+    return result
+
+
+@pytest.fixture(autouse=True)
+def clear_metrics():
+    metrics.clear()
+    yield
+    metrics.clear()
+
+
+def test_downloads_and_extracts_fixture_pages(tmp_path):
+    with FixtureServer(GRAPH) as server:
+        urls = [server.get_url(book_id) for book_id in range(6)]
+        books = download_books(create_downloader(
+            tmp_path, concurrency=3), write_books_file(tmp_path, urls))
+    assert sorted(books) == sorted(urls)
+    book = books[server.get_url(4)]
+    assert book.title == "Book 4"
+    assert book.recommendations == ["5.Book", "8.Book"]
+    assert book.genres == ["Genre 1", "Genre 7"]
+
+
+def test_connections_are_reused(tmp_path):
+    with FixtureServer(GRAPH) as server:
+        urls = [server.get_url(book_id) for book_id in range(10)]
+        download_books(create_downloader(tmp_path, concurrency=2),
+                       write_books_file(tmp_path, urls))
+    client_addresses = {client_address for _, client_address, _ in server.requests}
+    assert len(server.requests) == 10
+    # One keep-alive connection per download thread
+    assert len(client_addresses) <= 2
+
+
+def test_requests_are_rate_limited():
+    rate_limiter = RateLimiter(requests_per_second=20)
+    with FixtureServer(GRAPH) as server:
+        fetchers = [PageFetcher(rate_limiter) for _ in range(3)]
+        threads = [threading.Thread(target=lambda fetcher=fetcher, book_id=book_id: fetcher.fetch(server.get_url(book_id)))
+                   for book_id, fetcher in enumerate(fetchers * 2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for fetcher in fetchers:
+            fetcher.close()
+    request_times = sorted(request_time for _, _, request_time in server.requests)
+    gaps = [later - earlier for earlier, later in zip(request_times, request_times[1:])]
+    assert len(request_times) == 6
+    assert min(gaps) >= 0.04
+    assert request_times[-1] - request_times[0] >= 5 * 0.05 * 0.9
+
+
+def test_unavailable_pages_are_retried(tmp_path):
+    with FixtureServer(GRAPH, statuses={"/book/show/3.Book": [503, 503]}) as server:
+        book_downloader = create_downloader(tmp_path, concurrency=2)
+        books = download_books(book_downloader, write_books_file(
+            tmp_path, [server.get_url(book_id) for book_id in range(5)]))
+    assert server.get_requested_paths().count("/book/show/3.Book") == 3
+    assert server.get_url(3) in books
+    assert book_downloader.failed_downloads == []
+    assert metrics.counters["fetch_retries_total"] == 2
+
+
+def test_retry_budget_is_limited(tmp_path):
+    with FixtureServer(GRAPH, statuses={"/book/show/3.Book": [503] * 10, "/book/show/4.Book": [404]}) as server:
+        book_downloader = create_downloader(tmp_path, max_retries=2)
+        books = download_books(book_downloader, write_books_file(
+            tmp_path, [server.get_url(book_id) for book_id in range(5)]))
+    # 404 is not retried
+    assert server.get_requested_paths().count("/book/show/3.Book") == 3
+    assert server.get_requested_paths().count("/book/show/4.Book") == 1
+    assert sorted(books) == [server.get_url(book_id) for book_id in range(3)]
+    assert sorted(book_downloader.failed_downloads) == [
+        (3, server.get_url(3)), (4, server.get_url(4))]
+
+
+def test_backoff_is_exponential_with_jitter(tmp_path):
+    book_downloader = create_downloader(tmp_path, backoff_base=1.0, backoff_cap=6.0)
+    for retry, limit in enumerate([1, 2, 4, 6, 6]):
+        backoffs = [book_downloader.get_backoff(retry) for _ in range(200)]
+        assert 0 <= min(backoffs) and max(backoffs) <= limit
+        assert max(backoffs) > limit / 2
+
+
+def test_undecodable_pages_fail_without_stopping_the_download(tmp_path):
+    raw_pages = {"/book/show/1.Book": b"\xff\xfe bad page",
+                 "/book/show/2.Book": b"<html>\xc3\x28</html>"}
+    with FixtureServer(GRAPH, raw_pages=raw_pages) as server:
+        urls = [server.get_url(book_id) for book_id in range(12)]
+        # More urls than the url queue holds, so the file is read while the pages fail
+        book_downloader = create_downloader(tmp_path, concurrency=2)
+        books = download_books(book_downloader, write_books_file(tmp_path, urls * 2))
+    failed_urls = [server.get_url(1), server.get_url(2)]
+    assert sorted(books) == sorted(set(urls) - set(failed_urls))
+    assert sorted(url for _, url in book_downloader.failed_downloads) == sorted(failed_urls * 2)
+    # Undecodable pages are not retried
+    assert server.get_requested_paths().count("/book/show/1.Book") == 2
+    assert metrics.counters["fetch_errors_total"] == 4
+    errors = (tmp_path / "download_errors.txt").read_text()
+    assert all(url in errors for url in failed_urls)
+    assert errors.count("UnicodeDecodeError") == 4
+
+
+def test_unexpected_errors_fail_the_url(tmp_path, monkeypatch):
+    fetch = PageFetcher.fetch
+
+    def fetch_with_error(fetcher, url):
+        if url.endswith("/5.Book"):
+            raise ValueError("unexpected")
+        return fetch(fetcher, url)
+
+    monkeypatch.setattr(PageFetcher, "fetch", fetch_with_error)
+    with FixtureServer(GRAPH) as server:
+        urls = [server.get_url(book_id) for book_id in range(12)]
+        book_downloader = create_downloader(tmp_path, concurrency=1)
+        books = download_books(book_downloader, write_books_file(tmp_path, urls * 3))
+    assert sorted(books) == sorted(set(urls) - {server.get_url(5)})
+    assert book_downloader.failed_downloads == [
+        (5, server.get_url(5)), (17, server.get_url(5)), (29, server.get_url(5))]
+    assert metrics.counters["download_errors_total"] == 3
+    assert (tmp_path / "download_errors.txt").read_text().count(
+        f"{server.get_url(5)}, ValueError: unexpected") == 3
+
+
+def test_failed_url_reading_cleans_up(tmp_path, monkeypatch):
+    with FixtureServer(GRAPH, delay=0.01) as server:
+        urls = [server.get_url(book_id % 12) for book_id in range(40)]
+
+        def read_book_urls(book_downloader, books_file):
+            yield from enumerate(urls)
+            raise OSError("books file is gone")
+
+        monkeypatch.setattr(
+            BookDownloader, "_BookDownloader__read_book_urls", read_book_urls)
+        book_downloader = create_downloader(tmp_path, concurrency=2)
+        books_file = write_books_file(tmp_path, urls)
+        errors = []
+
+        def download():
+            try:
+                book_downloader.download_books(books_file, save_into_file=True)
+            except OSError as e:
+                errors.append(e)
+
+        threads_before = set(threading.enumerate())
+        thread = threading.Thread(target=download, daemon=True)
+        thread.start()
+        thread.join(30)
+        assert not thread.is_alive(), "download_books did not stop"
+
+    assert [str(e) for e in errors] == ["books file is gone"]
+    # Download threads are stopped, the page store and the logs are closed
+    assert not [thread for thread in set(threading.enumerate()) - threads_before
+                if not thread.daemon]
+    assert book_downloader.page_store is None
+    assert book_downloader.log_writer is None and book_downloader.error_writer is None
+    page_store = PageStore(str(tmp_path / "pages.pack"), read_only=True)
+    stored_urls = {url for url, _ in page_store.iterate_pages()}
+    page_store.close()
+    assert stored_urls and stored_urls <= set(urls)
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+from index import ArrayFile, IndexReader, IndexWriter, SECTION_NAME_SIZE
+
+
+def write_index(location: str):
+    index_writer = IndexWriter()
+    index_writer.add_array("book_count", np.array([3], dtype=np.int64))
+    index_writer.add_array("norms", np.array([0.5, 1.5, 2.5], dtype=np.float32))
+    index_writer.add_array("empty", np.zeros(0, dtype=np.int32))
+    index_writer.add_strings("book_urls", ["1.Book", "2.Böök", "3.Book"])
+    index_writer.add_term_dictionary("terms", ["wizard", "dragon", "çastle"])
+    array_file = ArrayFile(location + ".rows", np.int32)
+    array_file.append(np.arange(5))
+    array_file.append(np.arange(5, 12))
+    array_file.close()
+    index_writer.add_array("rows", array_file)
+    index_writer.write(location)
+    array_file.remove()
+
+
+def test_index_round_trip(tmp_path):
+    location = str(tmp_path / "books.index")
+    write_index(location)
+    index_reader = IndexReader(location, verify=True)
+    assert int(index_reader.get_array("book_count")[0]) == 3
+    assert index_reader.get_array("norms").tolist() == [0.5, 1.5, 2.5]
+    assert len(index_reader.get_array("empty")) == 0
+    assert index_reader.get_array("rows").tolist() == list(range(12))
+    assert index_reader.get_strings("book_urls") == ["1.Book", "2.Böök", "3.Book"]
+    term_dictionary = index_reader.get_term_dictionary("terms")
+    assert list(term_dictionary) == ["wizard", "dragon", "çastle"]
+    assert term_dictionary.get("dragon") == 1
+    assert term_dictionary.get("çastle") == 2
+    assert "unicorn" not in term_dictionary
+    # Sections are aligned in the mapped file
+    for array in index_reader.sections.values():
+        if len(array) > 0:
+            assert array.ctypes.data % 64 == 0
+
+
+def test_corrupted_byte_fails_verification(tmp_path):
+    location = str(tmp_path / "books.index")
+    write_index(location)
+    with open(location, "r+b") as file:
+        data = file.read()
+        # Flip a byte of the norms, past the header and the section table
+        position = data.index(np.array([1.5], dtype=np.float32).tobytes())
+        file.seek(position)
+        file.write(bytes([data[position] ^ 0xFF]))
+
+    # Loading does not read the whole file, verifying does
+    index_reader = IndexReader(location)
+    assert index_reader.get_array("norms")[1] != 1.5
+    with pytest.raises(ValueError, match="checksum mismatch"):
+        index_reader.verify()
+    with pytest.raises(ValueError, match="checksum mismatch"):
+        IndexReader(location, verify=True)
+
+
+def test_long_section_names_are_rejected():
+    index_writer = IndexWriter()
+    index_writer.add_array("x" * SECTION_NAME_SIZE, np.zeros(1))
+    with pytest.raises(ValueError, match="longer than"):
+        index_writer.add_array("x" * SECTION_NAME_SIZE + "y", np.zeros(1))
+    # Multibyte characters count as their encoded bytes
+    with pytest.raises(ValueError, match="longer than"):
+        index_writer.add_array("ç" * (SECTION_NAME_SIZE // 2 + 1), np.zeros(1))
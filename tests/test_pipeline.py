@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+from fixture_books import create_books, build_index
+from index import IndexReader
+from metrics import metrics
+from pagestore import BookStore
+from pipeline import StreamingIndexBuilder, StreamingIndexer, tokenize_book_shard
+
+
+class BookStream():
+    '''
+        Stands in for BookDownloader.stream_books, yields the books of books_dict without downloading them,
+        every book listed twice in a row is yielded twice
+    '''
+
+    def __init__(self, books_dict: dict, repeated_urls: set = frozenset()):
+        self.books_dict = books_dict
+        self.repeated_urls = repeated_urls
+
+    def stream_books(self, books_file: str):
+        for book_url, book in self.books_dict.items():
+            yield (book_url, book)
+            if book_url in self.repeated_urls:
+                yield (book_url, book)
+
+
+@pytest.fixture(autouse=True)
+def clear_metrics():
+    metrics.clear()
+    yield
+    metrics.clear()
+
+
+def test_streamed_index_equals_book_vectorizer_index(tmp_path):
+    books_dict = create_books(500)
+    (tmp_path / "vectorizer").mkdir()
+    vectorizer_index_file = str(tmp_path / "vectorizer" / "books.index")
+    build_index(books_dict, vectorizer_index_file)
+
+    streaming_indexer = StreamingIndexer(BookStream(books_dict, {"3.Book", "250.Book"}), shard_size=37,
+                                         shard_dir=str(tmp_path / "shards"), processes=1)
+    streamed_index_file = str(tmp_path / "streamed.index")
+    book_vectorizer = streaming_indexer.index_books(
+        "books.txt", streamed_index_file, str(tmp_path / "books.pack"))
+    assert book_vectorizer.book_count == len(books_dict)
+
+    vectorizer_reader = IndexReader(vectorizer_index_file, verify=True)
+    streamed_reader = IndexReader(streamed_index_file, verify=True)
+    assert sorted(streamed_reader.sections) == sorted(vectorizer_reader.sections)
+    for name, array in vectorizer_reader.sections.items():
+        streamed_array = streamed_reader.get_array(name)
+        assert streamed_array.dtype == array.dtype, name
+        assert np.array_equal(streamed_array, array), name
+
+    book_store = BookStore(str(tmp_path / "books.pack"), read_only=True)
+    assert [book_url for book_url, _ in book_store.iterate_books()] == list(books_dict)
+    assert book_store.get_book("250.Book").description == books_dict["250.Book"].description
+    book_store.close()
+
+
+def test_book_store_offsets_are_written_after_every_shard(tmp_path):
+    books_dict = create_books(60)
+    streaming_indexer = StreamingIndexer(shard_dir=str(tmp_path / "shards"), processes=1)
+    index_builder = StreamingIndexBuilder(str(tmp_path / "shards"))
+    book_store = BookStore(str(tmp_path / "books.pack"))
+    books = list(books_dict.items())
+    for start in range(0, len(books), 20):
+        shard = books[start:start + 20]
+        streaming_indexer.write_shard(index_builder, book_store, shard, tokenize_book_shard(
+            [book for _, book in shard]))
+        # No url is kept in memory, they are found by their hashes
+        assert book_store.new_offsets == {}
+        assert len(book_store.offsets) == start + len(shard)
+    assert all(book_url in book_store for book_url in books_dict)
+    book_store.close()
@@ -0,0 +1,115 @@
+import numpy as np
+import pytest
+from book import Book
+from fixture_books import create_books, build_index
+from index import IndexReader
+from metrics import metrics
+from vectorization import BookPreprocessor, BookVectorizer
+
+BOOK_COUNT = 400
+FIELD_WEIGHTS = [None, (0.8, 0.2), (0.1, 0.9), (1.0, 0.0), (0.0, 1.0)]
+
+
+@pytest.fixture(autouse=True)
+def clear_metrics():
+    metrics.clear()
+    yield
+    metrics.clear()
+
+
+@pytest.fixture(scope="module")
+def book_vectorizer(tmp_path_factory) -> BookVectorizer:
+    location = str(tmp_path_factory.mktemp("index") / "books.index")
+    build_index(create_books(BOOK_COUNT), location)
+    return BookVectorizer(index_file=location)
+
+
+def get_query_books() -> list[Book]:
+    '''
+        Returns indexed books, among them copies of other books, books without a description
+        or genres, and books that are not indexed
+    '''
+    books = list(create_books(BOOK_COUNT).values())
+    query_books = [books[book_id] for book_id in (0, 8, 9, 22, 57, 105, 199, 240)]
+    assert any(book.description == "" for book in query_books)
+    assert any(book.genres == [] for book in query_books)
+    return query_books + [
+        Book("new.Book", "New", "dragon castle dragon unknownword", [], [], ["Fantasy"]),
+        Book("empty.Book", "Empty", "", [], [], []),
+        Book("unknown.Book", "Unknown", "nothing indexed here", [], [], ["Cooking"])
+    ]
+
+
+def assert_same_ranking(results: list, expected: list):
+    assert [book_url for _, book_url in results] == [
+        book_url for _, book_url in expected]
+    assert [score for score, _ in results] == pytest.approx(
+        [score for score, _ in expected], abs=1e-9)
+
+
+@pytest.mark.parametrize("engine", ["maxscore", "threshold"])
+@pytest.mark.parametrize("field_weights", FIELD_WEIGHTS)
+@pytest.mark.parametrize("k", [1, 18, 60])
+def test_engine_equals_exhaustive(book_vectorizer, engine, field_weights, k):
+    for book in get_query_books():
+        # The book itself and its copy are excluded
+        for excluded_urls in ([], [book.url, "8.Book", "not-indexed.Book"]):
+            expected = book_vectorizer.calculate_top_k_similarities(
+                book, k=k, excluded_urls=excluded_urls, engine='exhaustive', field_weights=field_weights)
+            results = book_vectorizer.calculate_top_k_similarities(
+                book, k=k, excluded_urls=excluded_urls, engine=engine, field_weights=field_weights)
+            assert len(results) == k
+            assert not set(excluded_urls) & {book_url for _, book_url in results}
+            assert_same_ranking(results, expected)
+
+
+@pytest.mark.parametrize("engine", ["maxscore", "threshold"])
+def test_tied_books_are_ranked_by_url(book_vectorizer, engine):
+    books_dict = create_books(BOOK_COUNT)
+    # 9.Book is a copy of 8.Book, both score the same
+    results = book_vectorizer.calculate_top_k_similarities(
+        books_dict["8.Book"], k=2, engine=engine)
+    assert [book_url for _, book_url in results] == ["9.Book", "8.Book"]
+    assert results[0][0] == pytest.approx(results[1][0])
+
+
+@pytest.mark.parametrize("engine", ["maxscore", "threshold"])
+def test_negative_field_weights_are_rejected(book_vectorizer, engine):
+    book = create_books(1)["0.Book"]
+    with pytest.raises(ValueError, match="non-negative"):
+        book_vectorizer.calculate_top_k_similarities(
+            book, engine=engine, field_weights=(-1.0, 1.0))
+
+
+def test_unknown_engine_is_rejected(book_vectorizer):
+    book = create_books(1)["0.Book"]
+    with pytest.raises(ValueError, match="Unknown engine typo"):
+        book_vectorizer.calculate_top_k_similarities(book, engine='typo')
+
+
+def test_parallel_preprocessing_equals_serial(tmp_path):
+    books_dict = create_books(BOOK_COUNT)
+    serial_preprocessor = BookPreprocessor(books_dict=books_dict)
+    serial_preprocessor.preprocess_books(processes=1)
+    parallel_preprocessor = BookPreprocessor(books_dict=books_dict)
+    parallel_preprocessor.preprocess_books(processes=3)
+    for content_type in ('description', 'genre'):
+        serial_data = getattr(serial_preprocessor, f"{content_type}_data")
+        parallel_data = getattr(parallel_preprocessor, f"{content_type}_data")
+        assert list(parallel_data.vocabulary) == list(serial_data.vocabulary)
+        assert parallel_data.book_urls == serial_data.book_urls
+        assert parallel_data.postings == serial_data.postings
+        assert parallel_data.posting_frequencies == serial_data.posting_frequencies
+        assert parallel_data.doc_frequencies == serial_data.doc_frequencies
+
+    # Both indexes have the same arrays
+    (tmp_path / "serial").mkdir()
+    (tmp_path / "parallel").mkdir()
+    build_index(books_dict, str(tmp_path / "serial" / "books.index"), processes=1)
+    build_index(books_dict, str(tmp_path / "parallel" / "books.index"), processes=3)
+    serial_reader = IndexReader(str(tmp_path / "serial" / "books.index"))
+    parallel_reader = IndexReader(str(tmp_path / "parallel" / "books.index"))
+    assert parallel_reader.checksum == serial_reader.checksum
+    assert list(parallel_reader.sections) == list(serial_reader.sections)
+    for name, array in serial_reader.sections.items():
+        assert np.array_equal(parallel_reader.get_array(name), array)
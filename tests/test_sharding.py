@@ -0,0 +1,85 @@
+import os
+import pytest
+from fixture_books import create_books, build_index
+from metrics import metrics
+from sharding import ShardCoordinator, SHARD_ENGINES
+from vectorization import BookVectorizer
+
+QUERY_COUNT = 12
+
+
+@pytest.fixture(autouse=True)
+def clear_metrics():
+    metrics.clear()
+    yield
+    metrics.clear()
+
+
+@pytest.fixture
+def index_file(tmp_path):
+    location = str(tmp_path / "books.index")
+    build_index(create_books(300), location)
+    return location
+
+
+def assert_same_top_k(shard_coordinator: ShardCoordinator, index_file: str, k: int = 18):
+    book_vectorizer = BookVectorizer(index_file=index_file)
+    books_dict = create_books(300)
+    for book in list(books_dict.values())[:QUERY_COUNT]:
+        for engine in SHARD_ENGINES:
+            expected = book_vectorizer.calculate_top_k_similarities(
+                book, k=k, excluded_urls=[book.url], engine='exhaustive')
+            results = shard_coordinator.calculate_top_k_similarities(
+                book, k=k, excluded_urls=[book.url], engine=engine)
+            assert [book_url for _, book_url in results] == [
+                book_url for _, book_url in expected]
+            assert [score for score, _ in results] == pytest.approx(
+                [score for score, _ in expected])
+
+
+def test_sharded_top_k_is_exact_before_and_after_rebalance(index_file):
+    shard_coordinator = ShardCoordinator(index_file, shard_count=3)
+    try:
+        assert_same_top_k(shard_coordinator, index_file)
+        shard_coordinator.assign([5, 1, 1])
+        assert [shard_client.end - shard_client.start
+                for shard_client in shard_coordinator.shard_clients] != [100, 100, 100]
+        assert_same_top_k(shard_coordinator, index_file)
+        assert shard_coordinator.rebalance()
+        assert shard_coordinator.shard_clients[-1].end == 300
+        assert_same_top_k(shard_coordinator, index_file)
+    finally:
+        shard_coordinator.close()
+
+
+def test_failed_reassignment_serves_the_previous_rows(tmp_path, index_file):
+    other_index_file = str(tmp_path / "other" / "books.index")
+    os.makedirs(os.path.dirname(other_index_file))
+    build_index(create_books(200, seed=1), other_index_file)
+    shard_coordinator = ShardCoordinator(index_file, shard_count=2)
+    try:
+        ranges = [(shard_client.start, shard_client.end)
+                  for shard_client in shard_coordinator.shard_clients]
+        # Workers map index_file, its checksum is not the one of the other index
+        with pytest.raises(RuntimeError, match="previous rows"):
+            shard_coordinator.assign([1, 3], BookVectorizer(index_file=other_index_file))
+        assert [(shard_client.start, shard_client.end)
+                for shard_client in shard_coordinator.shard_clients] == ranges
+        assert_same_top_k(shard_coordinator, index_file)
+
+        # The previous rows cannot be loaded either once the file is replaced
+        old_vectorizer = shard_coordinator.book_vectorizer
+        os.replace(other_index_file, index_file)
+        with pytest.raises(RuntimeError, match="no query is answered"):
+            shard_coordinator.assign([1, 3], old_vectorizer)
+        book = create_books(1)["0.Book"]
+        with pytest.raises(RuntimeError, match="not assigned"):
+            shard_coordinator.calculate_top_k_similarities(book)
+
+        # A full reassignment serves queries again
+        shard_coordinator.load_index()
+        assert shard_coordinator.book_vectorizer.get_index_version() == BookVectorizer(
+            index_file=index_file).get_index_version()
+        assert len(shard_coordinator.calculate_top_k_similarities(book)) == 18
+    finally:
+        shard_coordinator.close()
@@ -0,0 +1,26 @@
+from vectorization import BookData
+
+
+def test_book_added_again_keeps_one_posting_per_term():
+    book_data = BookData('description')
+    book_data.add_book_tokens("1.Book", ["dragon", "castle", "dragon"])
+    book_data.add_book_tokens("2.Book", ["dragon", "river"])
+    book_data.add_book_tokens("3.Book", ["river"])
+    # Added again after other books, with a known and a new term of the book
+    book_data.add_book_tokens("1.Book", ["dragon", "river"])
+
+    assert book_data.book_urls == ["1.Book", "2.Book", "3.Book"]
+    dragon_postings, dragon_frequencies = book_data.get_postings("dragon")
+    assert list(dragon_postings) == [0, 1]
+    assert list(dragon_frequencies) == [3, 1]
+    river_postings, river_frequencies = book_data.get_postings("river")
+    assert list(river_postings) == [0, 1, 2]
+    assert list(river_frequencies) == [1, 1, 1]
+    assert book_data.doc_frequency["dragon"] == 2
+    assert book_data.doc_frequency["river"] == 3
+    assert book_data.doc_frequency["castle"] == 1
+    assert book_data.get_term_frequency("river", "1.Book") == 1
+
+    # Entries are grouped by term with one entry per book
+    book_ids, term_ids, frequencies = book_data.get_entries()
+    assert len(book_ids) == len(term_ids) == len(frequencies) == 6